@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Memory benchmark for the DupCleaner file table.
+
+It compares the peak RSS used to store the files of a scan:
+  - dict: the old representation, a dictionary using the full file name
+    as key and the os.stat_result as value.
+  - table: the compact FileTable.
+
+Every mode runs in its own process, so the peak RSS is not shared.
+
+Usage:
+  python benchmarks/bench_memory.py [--files N] [--files-per-folder N]
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from dupcleaner import FileTable  # noqa: E402
+
+
+def peak_rss():
+    """
+    Function to get the peak RSS of the current process
+    :return: Peak RSS in bytes
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def synthetic_files(files, files_per_folder):
+    """
+    Generator of synthetic file names and stat results
+    :param files: Number of files
+    :param files_per_folder: Number of files in every folder
+    :return: Iterator of tuples (file name, os.stat_result)
+    """
+    for idx in range(files):
+        folder = idx // files_per_folder
+        path = '/srv/archive/{:04}/{:06}/IMG_{:08}.jpg'.format(
+            folder % 1000, folder, idx)
+        yield path, os.stat_result((0o100644, 1000000 + idx, 2049, 1, 1000,
+                                    1000, 4096 + idx % 65536,
+                                    1600000000, 1600000000, 1600000000,
+                                    1600000000, 1600000000, 1600000000,
+                                    1600000000 * 10 ** 9,
+                                    1600000000 * 10 ** 9,
+                                    1600000000 * 10 ** 9))
+
+
+def run_mode(mode, files, files_per_folder):
+    """
+    Function to store the synthetic files using one representation
+    :param mode: "dict" or "table"
+    :param files: Number of files
+    :param files_per_folder: Number of files in every folder
+    :return: Peak RSS increment in bytes
+    """
+    base = peak_rss()
+    if mode == 'dict':
+        store = {}
+        for path, st in synthetic_files(files, files_per_folder):
+            store[path] = st
+    else:
+        store = FileTable()
+        for path, st in synthetic_files(files, files_per_folder):
+            store.add(path, st)
+
+    return peak_rss() - base
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Peak RSS of the DupCleaner file table.')
+    parser.add_argument('--files', type=int, default=1000000,
+                        help='Number of synthetic files.')
+    parser.add_argument('--files-per-folder', type=int, default=200,
+                        help='Number of files in every folder.')
+    parser.add_argument('--mode', choices=['dict', 'table'],
+                        help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.mode:
+        print(run_mode(arguments.mode, arguments.files,
+                       arguments.files_per_folder))
+        return
+
+    print("Files: {}".format(arguments.files))
+    results = {}
+    for mode in ('dict', 'table'):
+        out = subprocess.run([sys.executable, __file__, '--mode', mode,
+                              '--files', str(arguments.files),
+                              '--files-per-folder',
+                              str(arguments.files_per_folder)],
+                             check=True, capture_output=True, text=True)
+        results[mode] = int(out.stdout)
+        print("{:6} peak RSS: {:8.1f} MiB ({:.1f} MiB per million files)"
+              .format(mode, results[mode] / 2 ** 20,
+                      results[mode] / 2 ** 20 * 10 ** 6 / arguments.files))
+
+    print("Reduction: {:.1f}x".format(results['dict'] /
+                                      max(results['table'], 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite for DupCleaner.
+
+It creates a seeded synthetic tree (see treegen.py), runs
+DupCleaner.get_duplicated() on it and reports the time of every phase,
+files/s, MB/s and the peak memory. The result is checked against the
+expected duplicated files of the tree.
+
+The report can be saved as baseline and compared with a stored baseline,
+failing if a metric is slower than the tolerance allows.
+
+The tree is in the page cache after the first run, so the results are
+warm cache results unless --drop-caches is used (root needed).
+
+Usage:
+  python benchmarks/bench_suite.py [--files N] [--seed N] ...
+      [--baseline FILE] [--save-baseline] [--tolerance 0.2]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dupcleaner import DupCleaner, parse_size  # noqa: E402
+from treegen import generate_tree, add_arguments  # noqa: E402
+
+# Metrics compared with the baseline. True if bigger is better.
+METRICS = {'wall': False, 'files_s': True, 'mb_s': True,
+           'peak_memory': False}
+
+
+def max_rss():
+    """
+    Function to get the peak RSS of the current process
+    :return: Peak RSS in bytes
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def drop_caches():
+    """
+    Function to drop the page cache (Linux, root needed)
+    :return: None
+    """
+    subprocess.run(['sync'], check=False)
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+
+def run_once(root, options, memory=False):
+    """
+    Function to run DupCleaner.get_duplicated() on the tree
+    :param root: Tree folder
+    :param options: Dictionary with the DupCleaner arguments
+    :param memory: Boolean value to measure the peak memory (slower)
+    :return: Tuple, DupCleaner statistics, duplicated files and peak
+             memory in bytes (0 if not measured)
+    """
+    cleaner = DupCleaner([root], **options)
+    if memory:
+        tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        duplicated = cleaner.get_duplicated()
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return cleaner.get_stats(), duplicated, peak
+
+
+def run_suite(root, manifest, options, repeat, cold):
+    """
+    Function to run the benchmark
+    :param root: Tree folder
+    :param manifest: Manifest of the tree, from generate_tree
+    :param options: Dictionary with the DupCleaner arguments
+    :param repeat: Number of runs, the best one is reported
+    :param cold: Boolean value to drop the page cache before every run
+    :return: Report dictionary
+    """
+    best = None
+    for _ in range(repeat):
+        if cold:
+            drop_caches()
+        stats, duplicated, _ = run_once(root, options)
+        if best is None or stats['wall'] < best['wall']:
+            best = stats
+
+    _, _, peak = run_once(root, options, memory=True)
+
+    files = sum(len(x) for x in duplicated.values())
+    if len(duplicated) != manifest['groups'] or \
+            files != manifest['duplicated_files']:
+        raise RuntimeError("Wrong result: {} groups, {} files. Expected: "
+                           "{} groups, {} files".format(
+                            len(duplicated), files, manifest['groups'],
+                            manifest['duplicated_files']))
+
+    read_bytes = sum(x['bytes'] for x in best['phases'].values())
+    return {'tree': manifest['arguments'],
+            'options': options,
+            'wall': best['wall'],
+            'cpu': best['cpu'],
+            'files_s': best['files'] / best['wall'],
+            'mb_s': manifest['bytes'] / 1e6 / best['wall'],
+            'read_bytes': read_bytes,
+            'peak_memory': peak,
+            'max_rss': max_rss(),
+            'phases': {x: y['wall'] for x, y in best['phases'].items()}}
+
+
+def compare_baseline(report, baseline, tolerance):
+    """
+    Function to compare a report with the baseline
+    :param report: Report dictionary
+    :param baseline: Baseline report dictionary
+    :param tolerance: Allowed relative regression, like 0.2 (20%)
+    :return: List of regressions (text)
+    """
+    regressions = []
+    if report['tree'] != baseline['tree'] or \
+            report['options'] != baseline['options']:
+        regressions.append("The baseline uses other tree or options")
+        return regressions
+
+    for metric, bigger_better in METRICS.items():
+        old, new = baseline[metric], report[metric]
+        if bigger_better:
+            failed = new < old * (1 - tolerance)
+        else:
+            failed = new > old * (1 + tolerance)
+        if failed:
+            regressions.append("{}: {:.4g} (baseline {:.4g})".format(
+                metric, new, old))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DupCleaner benchmarks.')
+    add_arguments(parser)
+    parser.add_argument('--root', type=str, default=None,
+                        help='New folder for the tree, kept after the run. '
+                             'A temporary folder is used and removed by '
+                             'default.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='DupCleaner parallel jobs.')
+    parser.add_argument('--compare', type=str, default='hash',
+                        choices=['hash', 'bytes'],
+                        help='DupCleaner compare method.')
+    parser.add_argument('--hash', type=str, action='append', default=None,
+                        help='DupCleaner checksum algorithm.')
+    parser.add_argument('--memory-limit', type=str, default='0',
+                        help='DupCleaner memory limit, like 64M.')
+    parser.add_argument('--device-jobs', type=int, default=0,
+                        help='DupCleaner parallel jobs per device.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs, the best one is reported.')
+    parser.add_argument('--drop-caches', action='store_true',
+                        help='Drop the page cache before every run.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Baseline JSON file.')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save the report as baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed regression against the baseline.')
+    arguments = parser.parse_args()
+
+    root = arguments.root or tempfile.mkdtemp(prefix='dupbench-')
+    try:
+        manifest = generate_tree(root, arguments.files, arguments.sizes,
+                                 arguments.dup_ratio,
+                                 arguments.hardlink_ratio,
+                                 arguments.prefix_ratio, arguments.depth,
+                                 arguments.fanout, arguments.seed)
+        options = {'jobs': arguments.jobs, 'compare': arguments.compare,
+                   'algorithms': arguments.hash,
+                   'memory_limit': parse_size(arguments.memory_limit),
+                   'device_jobs': arguments.device_jobs}
+        report = run_suite(root, manifest, options, arguments.repeat,
+                           arguments.drop_caches)
+    finally:
+        if not arguments.root:
+            shutil.rmtree(root)
+
+    print(json.dumps(report, indent=2))
+
+    if arguments.baseline and arguments.save_baseline:
+        with open(arguments.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    elif arguments.baseline:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_baseline(report, baseline,
+                                       arguments.tolerance)
+        for regression in regressions:
+            print("REGRESSION: {}".format(regression), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Output order check for DupCleaner.
+
+It creates a seeded synthetic tree (see treegen.py) and runs
+DupCleaner.get_duplicated() with one job, with N jobs and with the
+external memory mode (--memory-limit). The groups, and the files of every
+group, must be returned in the same order.
+
+The command exits with 1 if the results are not the same.
+
+Usage:
+  python benchmarks/check_order.py [--jobs N] [--memory-limit SIZE] ...
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dupcleaner import DupCleaner, parse_size  # noqa: E402
+from treegen import generate_tree, add_arguments  # noqa: E402
+
+
+def get_groups(root, **options):
+    """
+    Function to get the duplicated files of a DupCleaner run, in order
+    :param root: Tree folder
+    :param options: DupCleaner arguments
+    :return: List of tuples (key, list of files)
+    """
+    cleaner = DupCleaner([root], **options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return list(cleaner.get_duplicated().items())
+
+
+def compare(name, expected, groups):
+    """
+    Function to compare the groups of a run with the expected groups
+    :param name: Name of the run
+    :param expected: Expected list of groups, see get_groups
+    :param groups: List of groups, see get_groups
+    :return: True if the groups are the same, in the same order
+    """
+    moved = sum(x != y for x, y in zip(expected, groups))
+    print("{}: {} groups, {} in other position".format(name, len(groups),
+                                                      moved))
+    return groups == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the DupCleaner output order.')
+    add_arguments(parser)
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='Parallel jobs compared with one job.')
+    parser.add_argument('--memory-limit', type=str, default='4K',
+                        help='Memory limit of the external memory mode, '
+                             'small to use many sorted runs.')
+    arguments = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='duporder-')
+    try:
+        generate_tree(root, arguments.files, arguments.sizes,
+                      arguments.dup_ratio, arguments.hardlink_ratio,
+                      arguments.prefix_ratio, arguments.depth,
+                      arguments.fanout, arguments.seed)
+        expected = get_groups(root)
+        ok = compare("{} jobs".format(arguments.jobs), expected,
+                     get_groups(root, jobs=arguments.jobs))
+        ok &= compare("Memory limit {}".format(arguments.memory_limit),
+                      expected, get_groups(root, memory_limit=parse_size(
+                          arguments.memory_limit)))
+    finally:
+        shutil.rmtree(root)
+
+    if not ok:
+        print("ERROR: The groups are not in the same order", file=sys.stderr)
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
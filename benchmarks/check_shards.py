@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+Shard and merge check for DupCleaner.
+
+It creates a seeded synthetic tree (see treegen.py), splits the top
+level entries of the tree in N shards and runs one DupCleaner process
+per shard (--write-shard), in parallel. Then the shard files are merged
+and the duplicated files are compared with a single process run.
+
+The two hosts case merges the shards with a copy of them from other host
+(the host of the header is changed). Every file must be grouped with its
+copy in the other host, reported as host:/path.
+
+The command exits with 1 if the results are not the same.
+
+Usage:
+  python benchmarks/check_shards.py [--shards N] [--files N] [--seed N] ...
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dupcleaner import DupCleaner, HOST_SEPARATOR, \
+    read_shard  # noqa: E402
+from treegen import generate_tree, add_arguments  # noqa: E402
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'dupcleaner.py')
+
+
+def get_groups(cleaner):
+    """
+    Function to get the duplicated files of a DupCleaner run. The files
+    are identified by device and inode, because any path of a set of hard
+    links can be reported.
+    :param cleaner: DupCleaner object
+    :return: Set of groups, every group is a frozenset of (st_dev, st_ino)
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        duplicated = cleaner.get_duplicated()
+
+    groups = set()
+    for lst_files in duplicated.values():
+        groups.add(frozenset((st.st_dev, st.st_ino)
+                             for st in map(os.stat, lst_files)))
+    return groups
+
+
+def run_shards(root, shards, work_dir):
+    """
+    Function to run one DupCleaner process per shard, in parallel
+    :param root: Tree folder
+    :param shards: Number of shards
+    :param work_dir: Folder for the shard files
+    :return: List of shard files
+    """
+    entries = sorted(os.path.join(root, x) for x in os.listdir(root))
+    lst_shards = []
+    procs = []
+    for idx in range(shards):
+        shard_entries = entries[idx::shards]
+        if not shard_entries:
+            continue
+        file_name = os.path.join(work_dir, 'shard{}.jsonl'.format(idx))
+        lst_shards.append(file_name)
+        procs.append(subprocess.Popen(
+            [sys.executable, SCRIPT, '-r', '--write-shard', file_name] +
+            shard_entries, stdout=subprocess.DEVNULL))
+
+    for proc in procs:
+        if proc.wait():
+            raise RuntimeError("Shard process failed")
+
+    return lst_shards
+
+
+def copy_shard(file_name, new_file_name, host):
+    """
+    Function to copy a shard file, changing the host of the header
+    :param file_name: Shard file
+    :param new_file_name: New shard file
+    :param host: Host of the new shard file
+    :return: None
+    """
+    with open(file_name) as f, open(new_file_name, 'w') as f_new:
+        header = json.loads(f.readline())
+        header['host'] = host
+        f_new.write(json.dumps(header) + '\n')
+        shutil.copyfileobj(f, f_new)
+
+
+def check_hosts(lst_shards, work_dir, host='check-other-host'):
+    """
+    Function to merge the shard files with a copy of them from other
+    host. Every physical file is grouped with its copy in the other host
+    :param lst_shards: List of shard files
+    :param work_dir: Folder for the copies of the shard files
+    :param host: Name of the other host
+    :return: Number of groups, or None if the groups are not valid
+    """
+    lst_copies = []
+    for idx, file_name in enumerate(lst_shards):
+        lst_copies.append(os.path.join(work_dir, 'host{}.jsonl'.format(idx)))
+        copy_shard(file_name, lst_copies[-1], host)
+
+    cleaner = DupCleaner([], shard_inputs=lst_shards + lst_copies)
+    with contextlib.redirect_stdout(io.StringIO()):
+        duplicated = cleaner.get_duplicated()
+
+    prefix = host + HOST_SEPARATOR
+    for lst_files in duplicated.values():
+        local = {x for x in lst_files if not x.startswith(prefix)}
+        remote = {x[len(prefix):] for x in lst_files if x.startswith(prefix)}
+        if not local or local != remote:
+            return None
+
+    # One group for every content, with or without copies in the host
+    contents = {(x[0], tuple(x[1])) for y in lst_shards
+                for x in read_shard(y)}
+    return len(duplicated) if len(duplicated) == len(contents) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the DupCleaner shard and merge mode.')
+    add_arguments(parser)
+    parser.add_argument('--shards', type=int, default=4,
+                        help='Number of shard processes.')
+    arguments = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='dupshards-')
+    root = os.path.join(work_dir, 'tree')
+    try:
+        generate_tree(root, arguments.files, arguments.sizes,
+                      arguments.dup_ratio, arguments.hardlink_ratio,
+                      arguments.prefix_ratio, arguments.depth,
+                      arguments.fanout, arguments.seed)
+
+        start = time.perf_counter()
+        expected = get_groups(DupCleaner([root]))
+        single_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        lst_shards = run_shards(root, arguments.shards, work_dir)
+        shards_time = time.perf_counter() - start
+        start = time.perf_counter()
+        merged = get_groups(DupCleaner([], shard_inputs=lst_shards))
+        merge_time = time.perf_counter() - start
+        host_groups = check_hosts(lst_shards, work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    print("Single process: {} groups, {:.2f} s".format(len(expected),
+                                                      single_time))
+    print("{} shards: {} groups, {:.2f} s (shards) + {:.2f} s (merge)".format(
+        len(lst_shards), len(merged), shards_time, merge_time))
+    print("Two hosts: {} groups".format(host_groups))
+    if merged != expected:
+        print("ERROR: The merged groups are not the same", file=sys.stderr)
+        sys.exit(1)
+    if host_groups is None:
+        print("ERROR: The files are not grouped with the copies of the "
+              "other host", file=sys.stderr)
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+Seeded generator of synthetic trees for the DupCleaner benchmarks.
+
+The same arguments and seed always create the same tree:
+  - files: number of paths
+  - sizes: size distribution, "fixed:SIZE", "uniform:MIN:MAX" or
+    "lognormal:MU:SIGMA" (sizes in bytes, log of bytes for lognormal)
+  - dup_ratio: fraction of files that are copies of another file
+  - hardlink_ratio: fraction of files that are hard links to another file
+  - prefix_ratio: fraction of files with the same size and prefix as
+    another file, but different content at the end
+  - depth / fanout: folder tree shape
+
+Usage:
+  python benchmarks/treegen.py DIR [--files N] [--seed N] ...
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+from collections import Counter
+
+
+def parse_sizes(spec):
+    """
+    Function to parse a size distribution
+    :param spec: "fixed:SIZE", "uniform:MIN:MAX" or "lognormal:MU:SIGMA"
+    :return: Function to get a size using a random.Random
+    """
+    name, *values = spec.split(':')
+    if name == 'fixed' and len(values) == 1:
+        size = int(values[0])
+        return lambda rnd: size
+    if name == 'uniform' and len(values) == 2:
+        low, high = int(values[0]), int(values[1])
+        return lambda rnd: rnd.randint(low, high)
+    if name == 'lognormal' and len(values) == 2:
+        mu, sigma = float(values[0]), float(values[1])
+        return lambda rnd: int(rnd.lognormvariate(mu, sigma))
+
+    raise ValueError("Size distribution {} not valid".format(spec))
+
+
+def folder_names(depth, fanout):
+    """
+    Function to get the relative folder names of the tree
+    :param depth: Number of folder levels
+    :param fanout: Number of sub folders in every folder
+    :return: List of relative folder names
+    """
+    folders = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [os.path.join(x, 'd{}'.format(y)) for x in level
+                 for y in range(fanout)]
+        folders.extend(level)
+
+    return folders
+
+
+def generate_tree(root, files=1000, sizes='lognormal:9:2', dup_ratio=0.2,
+                  hardlink_ratio=0.0, prefix_ratio=0.05, depth=3, fanout=4,
+                  seed=1):
+    """
+    Function to create a synthetic tree
+    :param root: Folder for the tree, created if needed
+    :param files: Number of paths
+    :param sizes: Size distribution
+    :param dup_ratio: Fraction of files that are copies of another file
+    :param hardlink_ratio: Fraction of files that are hard links
+    :param prefix_ratio: Fraction of files that only match the prefix of
+           another file
+    :param depth: Number of folder levels
+    :param fanout: Number of sub folders in every folder
+    :param seed: Random seed
+    :return: Manifest dictionary, with the arguments and the expected
+             result (groups of physical files with the same content and
+             sets of hard links)
+    """
+    rnd = random.Random(seed)
+    get_size = parse_sizes(sizes)
+    folders = folder_names(depth, fanout)
+    for folder in folders:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    contents = {}
+    inodes = {}
+    originals = []
+    total_bytes = 0
+    for idx in range(files):
+        path = os.path.join(root, rnd.choice(folders),
+                            'f{:07}.bin'.format(idx))
+        kind = rnd.random()
+        if originals and kind < hardlink_ratio:
+            source = rnd.choice(originals)
+            os.link(source, path)
+            contents[path] = contents[source]
+            inodes[path] = inodes[source]
+            continue
+
+        if originals and kind < hardlink_ratio + dup_ratio:
+            with open(rnd.choice(originals), 'rb') as f:
+                data = f.read()
+        elif originals and kind < hardlink_ratio + dup_ratio + prefix_ratio:
+            with open(rnd.choice(originals), 'rb') as f:
+                data = f.read()
+            cut = len(data) // 2
+            data = data[:cut] + rnd.randbytes(len(data) - cut)
+        else:
+            data = rnd.randbytes(get_size(rnd))
+
+        with open(path, 'wb') as f:
+            f.write(data)
+        originals.append(path)
+        contents[path] = hashlib.md5(data).hexdigest()
+        inodes[path] = path
+        total_bytes += len(data)
+
+    # Hard links are one physical file, only the first path is reported
+    groups = {}
+    for path, digest in contents.items():
+        if inodes[path] == path:
+            groups.setdefault(digest, []).append(path)
+    dup_groups = [sorted(x) for x in groups.values() if len(x) > 1]
+
+    return {'arguments': {'files': files, 'sizes': sizes,
+                          'dup_ratio': dup_ratio,
+                          'hardlink_ratio': hardlink_ratio,
+                          'prefix_ratio': prefix_ratio, 'depth': depth,
+                          'fanout': fanout, 'seed': seed},
+            'bytes': total_bytes,
+            'groups': len(dup_groups),
+            'duplicated_files': sum(len(x) for x in dup_groups),
+            'hardlink_sets': sum(1 for x in Counter(inodes.values()).values()
+                                 if x > 1)}
+
+
+def add_arguments(parser):
+    """
+    Function to include the generator arguments in a parser
+    :param parser: argparse.ArgumentParser
+    :return: None
+    """
+    parser.add_argument('--files', type=int, default=1000,
+                        help='Number of paths.')
+    parser.add_argument('--sizes', type=str, default='lognormal:9:2',
+                        help='Size distribution: fixed:SIZE, uniform:MIN:MAX '
+                             'or lognormal:MU:SIGMA.')
+    parser.add_argument('--dup-ratio', type=float, default=0.2,
+                        help='Fraction of files that are copies.')
+    parser.add_argument('--hardlink-ratio', type=float, default=0.0,
+                        help='Fraction of files that are hard links.')
+    parser.add_argument('--prefix-ratio', type=float, default=0.05,
+                        help='Fraction of files that only match the prefix '
+                             'of another file.')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Number of folder levels.')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='Number of sub folders in every folder.')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Create a synthetic tree for the DupCleaner benchmarks.')
+    parser.add_argument('root', type=str, help='Folder for the tree.')
+    add_arguments(parser)
+    arguments = parser.parse_args()
+
+    manifest = generate_tree(arguments.root, arguments.files,
+                             arguments.sizes, arguments.dup_ratio,
+                             arguments.hardlink_ratio, arguments.prefix_ratio,
+                             arguments.depth, arguments.fanout,
+                             arguments.seed)
+    print(json.dumps(manifest, indent=2))
+
+
+if __name__ == '__main__':
+    main()
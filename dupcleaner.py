@@ -8,13 +8,452 @@ https://www.kix.es/
 https://www.github.com/thekix/dupcleaner
 """
 import hashlib
+import cProfile
 import argparse
 import sys
 import io
 import time
 import os
-from os.path import isfile, isdir, abspath, islink, \
-    getmtime, getctime, getsize, dirname
+import sqlite3
+import json
+import socket
+import errno
+import shutil
+import re
+import mmap
+import struct
+import heapq
+import marshal
+import tempfile
+import fnmatch
+import stat
+import zipfile
+import tarfile
+import selectors
+import signal
+import threading
+import asyncio
+from contextlib import contextmanager, suppress
+from collections import deque
+from array import array
+from functools import partial
+from itertools import groupby, chain
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    CancelledError
+from os.path import isfile, isdir, abspath
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, reflinks are not supported
+    fcntl = None
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1
+except (ImportError, OSError, AttributeError):
+    # Not Linux, the daemon only uses the periodic rescan
+    libc = None
+
+# Bytes read from the head and from the tail of the files in the sample stage
+SAMPLE_SIZE = 4096
+# Algorithm used to calculate the checksum in the sample stage
+SAMPLE_ALGORITHM = 'md5'
+# Buffer size used to read the files
+BLOCK_SIZE = 262144
+# Max number of checksums stored in the persistent cache
+CACHE_SIZE = 50000000
+# Max number of files open at once comparing the files content. Bigger
+# groups are compared using the checksums
+MAX_OPEN_FILES = 256
+# Min seconds between two progress lines
+PROGRESS_INTERVAL = 1.0
+# Names used in the output for the checksum algorithms
+ALGORITHM_LABELS = {'md5': 'MD5', 'sha1': 'SHA-1'}
+# Linux ioctl to share the data of a file with a new file (btrfs, XFS)
+FICLONE = 0x40049409
+# Linux ioctl to get the physical extents of a file
+FS_IOC_FIEMAP = 0xC020660B
+# Methods to replace a duplicated file with a link. "auto" uses a reflink
+# and falls back to a hard link if the filesystem does not support them
+LINK_METHODS = ('auto', 'reflink', 'hardlink')
+# Files removed or linked by every task executing a plan
+PLAN_BATCH_SIZE = 256
+# First line of the reference index files
+INDEX_MAGIC = b'DUPCLEANER-INDEX\n'
+# Format name in the header of the shard files
+SHARD_FORMAT = 'dupcleaner-shard'
+# Estimated memory used by a record in the external sorter, plus the
+# length of its strings
+RECORD_OVERHEAD = 256
+# Multipliers of the size suffixes, like 512M
+SIZE_SUFFIXES = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+# Size of the segments of the files using tree checksums
+SEGMENT_SIZE = 64 * 2 ** 20
+# Last item of the tree keys, followed by the segment size, so the tree
+# checksums never match the checksums of the whole file
+TREE_MARKER = b'tree:'
+# Separator between the archive and the member name in the member paths,
+# like archive.zip!/inner/path
+ARCHIVE_SEPARATOR = '!' + os.sep
+# Archive types by file name suffix
+ARCHIVE_SUFFIXES = {'.zip': 'zip', '.tar': 'tar', '.tar.gz': 'tar',
+                    '.tgz': 'tar', '.tar.bz2': 'tar', '.tbz2': 'tar',
+                    '.tar.xz': 'tar', '.txz': 'tar'}
+# Seconds between two full rescans of the daemon
+DAEMON_RESCAN = 3600
+# Seconds to wait after a change before updating the daemon index, so
+# the files being written are read once
+DAEMON_DELAY = 1.0
+# Seconds to wait for a client of the daemon
+DAEMON_TIMEOUT = 10
+# Times the daemon reads again a file that could not be read
+DAEMON_RETRIES = 3
+# Latencies kept by the daemon to calculate the percentiles
+LATENCY_SAMPLES = 1000
+# Flag of the inode numbers of the archive members. They are not real
+# inodes, but unique numbers for the cache and the hard links
+MEMBER_INO = 1 << 63
+# Separator of the host and the path of the files of other hosts, in the
+# merged shards, like host:/path, and flag of their inode numbers
+HOST_SEPARATOR = ':'
+REMOTE_INO = 1 << 62
+
+
+def fadvise(f, advice, offset=0, length=0):
+    """
+    Function to give a hint about the file access to the kernel, using
+    posix_fadvise, if available.
+    :param f: Open file
+    :param advice: Name of the os.POSIX_FADV_* constant, like "SEQUENTIAL"
+    :param offset: Start of the file region
+    :param length: Length of the file region, zero for the whole file
+    :return: None
+    """
+    if hasattr(os, 'posix_fadvise'):
+        # The archive members do not have a file descriptor
+        with suppress(OSError, AttributeError):
+            os.posix_fadvise(f.fileno(), offset, length,
+                             getattr(os, 'POSIX_FADV_' + advice))
+
+
+def archive_type(file_name):
+    """
+    Function to get the archive type of a file, using its name.
+    :param file_name: File name
+    :return: "zip", "tar" or None if the file is not an archive
+    """
+    name = file_name.lower()
+    for suffix, kind in ARCHIVE_SUFFIXES.items():
+        if name.endswith(suffix):
+            return kind
+
+    return None
+
+
+def archive_members(file_name):
+    """
+    Generator to read the regular files of an archive using only the
+    member headers: the zip central directory, or the tar headers (the
+    compressed tar files are decompressed to reach them, but the members
+    data is not hashed).
+    :param file_name: Archive file
+    :return: Iterator of tuples (member name, size, mtime in ns)
+    """
+    if archive_type(file_name) == 'zip':
+        with zipfile.ZipFile(file_name) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                    yield info.filename, info.file_size, int(mtime * 1e9)
+    else:
+        with tarfile.open(file_name) as tf:
+            for info in tf:
+                if info.isfile():
+                    yield info.name, info.size, int(info.mtime * 1e9)
+
+
+def member_ino(st, name):
+    """
+    Function to get the inode number of an archive member: a hash of the
+    archive device, inode and mtime and the member name, with the
+    MEMBER_INO flag, so the cache is not used if the archive changes.
+    :param st: os.stat_result of the archive
+    :param name: Member name
+    :return: Inode number
+    """
+    digest = hashlib.md5('{}:{}:{}:{}'.format(
+        st.st_dev, st.st_ino, st.st_mtime_ns, name).encode())
+    return MEMBER_INO | (int.from_bytes(digest.digest()[:8], 'big') &
+                         (MEMBER_INO - 1))
+
+
+def split_member(file_name):
+    """
+    Function to split the path of an archive member.
+    :param file_name: Path like archive.zip!/inner/path
+    :return: Tuple (archive, member name), or None if the path is not an
+             archive member
+    """
+    archive, sep, name = file_name.partition(ARCHIVE_SEPARATOR)
+    if not sep or archive_type(archive) is None:
+        return None
+
+    return archive, name.replace(os.sep, '/')
+
+
+def is_archive_member(file_name):
+    """
+    Function to check if a path is an archive member. The archive members
+    are read only.
+    :param file_name: File name
+    :return: True if the path is an archive member
+    """
+    return split_member(file_name) is not None and \
+        not os.path.lexists(file_name)
+
+
+def read_only(file_name):
+    """
+    Function to check if a path is read only: an archive member, or a
+    file of other host found in the merged shards (host:/path).
+    :param file_name: File name
+    :return: Reason, "archive member" or "other host", or None if the
+             file can be changed
+    """
+    if is_archive_member(file_name):
+        return 'archive member'
+
+    host, sep, path = file_name.partition(HOST_SEPARATOR)
+    if sep and host and os.sep not in host and path.startswith(os.sep) \
+            and not os.path.lexists(file_name):
+        return 'other host'
+
+    return None
+
+
+@contextmanager
+def open_file(file_name, buffering=0):
+    """
+    Function to open a file to read it in binary mode. The archive members
+    (like archive.zip!/inner/path) are read from the archive, without
+    extracting them.
+    :param file_name: File name, or a file already open (see
+           archive_files), used as is
+    :param buffering: Buffering of the regular files, see open
+    :return: Context manager with the open file
+    """
+    if not isinstance(file_name, str):
+        yield file_name
+        return
+
+    try:
+        f = open(file_name, "rb", buffering=buffering)
+    except OSError:
+        member = split_member(file_name)
+        if member is None:
+            raise
+    else:
+        with f:
+            yield f
+        return
+
+    archive, name = member
+    try:
+        if archive_type(archive) == 'zip':
+            with zipfile.ZipFile(archive) as zf, zf.open(name) as f:
+                yield f
+            return
+
+        with tarfile.open(archive) as tf:
+            # Read the headers until the member, without going back
+            for info in tf:
+                if info.name == name and info.isfile():
+                    with tf.extractfile(info) as f:
+                        yield f
+                    return
+    except (KeyError, zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+        raise OSError(errno.EIO, str(e), file_name) from None
+
+    raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                            file_name)
+
+
+def read_chunk(f, size):
+    """
+    Function to read a chunk of a file. The unbuffered reads can return
+    fewer bytes than requested before the end of the file, so the file is
+    read until the chunk is complete or the end of the file.
+    :param f: Open file
+    :param size: Size of the chunk
+    :return: Chunk (bytes), shorter than size only at the end of the file
+    """
+    data = f.read(size)
+    if len(data) == size or not data:
+        return data
+
+    chunks = [data]
+    size -= len(data)
+    while size and (data := f.read(size)):
+        chunks.append(data)
+        size -= len(data)
+
+    return b''.join(chunks)
+
+
+def archive_files(archive, names):
+    """
+    Generator to read some members of an archive, opening the archive
+    once. The tar archives are read sequentially, once, so the
+    compressed archives are not decompressed again for every member.
+    :param archive: Archive file
+    :param names: Set of member names
+    :return: Iterator of tuples (member name, open file), in the archive
+             order for the tar archives. The file is only valid until the
+             next item
+    """
+    try:
+        if archive_type(archive) == 'zip':
+            with zipfile.ZipFile(archive) as zf:
+                for name in names:
+                    with zf.open(name) as f:
+                        yield name, f
+            return
+
+        names = set(names)
+        with tarfile.open(archive) as tf:
+            for info in tf:
+                if info.name in names and info.isfile():
+                    names.discard(info.name)
+                    with tf.extractfile(info) as f:
+                        yield info.name, f
+    except (KeyError, zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+        raise OSError(errno.EIO, str(e), archive) from None
+
+    if names:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                archive + ARCHIVE_SEPARATOR + names.pop())
+
+
+def archive_digests(function, archive, names, *iterables):
+    """
+    Function to calculate the checksums of some members of an archive,
+    reading the archive once (see archive_files).
+    :param function: Function to calculate the checksums of a file, like
+           file_digests. The first argument is the open member
+    :param archive: Archive file
+    :param names: List of member names
+    :param iterables: Extra lists of arguments for the function
+    :return: List of results of the function, in the names order
+    """
+    positions = {}
+    for n, name in enumerate(names):
+        positions.setdefault(name, []).append(n)
+
+    results = [None] * len(names)
+    for name, f in archive_files(archive, positions):
+        ret = function(f, *[x[positions[name][0]] for x in iterables])
+        for n in positions[name]:
+            results[n] = ret
+
+    return results
+
+
+def try_digests(function, *args):
+    """
+    Function to calculate the checksums of a file, returning the error
+    instead of raising it, so one file does not stop a batch of files.
+    :param function: Function to calculate the checksums, like
+           file_digests
+    :param args: Arguments of the function
+    :return: Result of the function, or the OSError
+    """
+    try:
+        return function(*args)
+    except OSError as e:
+        return e
+
+
+def file_digests(file_name, algorithms, block_size=BLOCK_SIZE,
+                 drop_cache=False):
+    """
+    Function to calculate multiple checksums for a file, reading the file
+    only once. The file is read into a reused buffer and every block
+    updates all the checksums.
+    :param file_name: File to get the checksums
+    :param algorithms: List of hashlib algorithm names
+    :param block_size: Size of the read buffer
+    :param drop_cache: Boolean value to read the file as sequential and to
+           remove it from the page cache after reading it
+    :return: Tuple, list of checksums (bytes) in the algorithms order and
+             bytes read
+    """
+    hashes = [hashlib.new(x) for x in algorithms]
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    read_bytes = 0
+
+    with open_file(file_name) as f:
+        if drop_cache:
+            fadvise(f, 'SEQUENTIAL')
+        while size := f.readinto(buffer):
+            read_bytes += size
+            for file_hash in hashes:
+                file_hash.update(view[:size])
+        if drop_cache:
+            fadvise(f, 'DONTNEED')
+
+    return tuple(x.digest() for x in hashes), read_bytes
+
+
+def segment_digests(file_name, offset, length, algorithms,
+                    block_size=BLOCK_SIZE, drop_cache=False):
+    """
+    Function to calculate multiple checksums for a segment of a file, the
+    leaves of the tree checksums. Every call opens the file, so the
+    segments of a file can be read in parallel.
+    :param file_name: File to get the checksums
+    :param offset: Start of the segment
+    :param length: Length of the segment
+    :param algorithms: List of hashlib algorithm names
+    :param block_size: Size of the read buffer
+    :param drop_cache: Boolean value to remove the segment from the page
+           cache after reading it
+    :return: Tuple, list of checksums (bytes) in the algorithms order and
+             bytes read
+    """
+    hashes = [hashlib.new(x) for x in algorithms]
+    buffer = bytearray(max(min(block_size, length), 1))
+    view = memoryview(buffer)
+    read_bytes = 0
+
+    with open_file(file_name) as f:
+        f.seek(offset)
+        while read_bytes < length:
+            size = f.readinto(view[:length - read_bytes])
+            if not size:
+                break
+            read_bytes += size
+            for file_hash in hashes:
+                file_hash.update(view[:size])
+        if drop_cache:
+            fadvise(f, 'DONTNEED', offset, length)
+
+    return tuple(x.digest() for x in hashes), read_bytes
+
+
+def tree_digests(algorithms, leaves):
+    """
+    Function to calculate the tree checksums of a file from its leaves:
+    for every algorithm, the checksum of the leaf checksums.
+    :param algorithms: List of hashlib algorithm names
+    :param leaves: List of segment checksums, see segment_digests
+    :return: Tuple, checksums (bytes) in the algorithms order
+    """
+    return tuple(hashlib.new(x, b''.join(y[n] for y in leaves)).digest()
+                 for n, x in enumerate(algorithms))
 
 
 def md5(file_name):
@@ -23,14 +462,7 @@ def md5(file_name):
     :param file_name: File to get the MD5 sum
     :return: MD5 sum in hexadecimal
     """
-    block_size = 8192
-
-    with open(file_name, "rb") as f:
-        file_hash = hashlib.md5()
-        while chunk := f.read(block_size):
-            file_hash.update(chunk)
-
-    return file_hash.hexdigest()
+    return file_digests(file_name, ('md5', ))[0][0].hex()
 
 
 def sha1(file_name):
@@ -39,538 +471,5244 @@ def sha1(file_name):
     :param file_name: File to get the SHA1 sum
     :return: SHA-1 sum in hexadecimal
     """
-    block_size = 8192
+    return file_digests(file_name, ('sha1', ))[0][0].hex()
+
+
+def sample_digests(file_name, file_size, sample_size=SAMPLE_SIZE,
+                   drop_cache=False):
+    """
+    Function to calculate a quick checksum using only the head and the
+    tail of a file. Used to discard candidates before the full checksum.
+    :param file_name: File to get the sample sum
+    :param file_size: Size of the file in bytes
+    :param sample_size: Bytes read from the head and from the tail
+    :param drop_cache: Boolean value to remove the file from the page
+           cache after reading it
+    :return: Tuple, list with the sample checksum (bytes) and bytes read
+    """
+    file_hash = hashlib.new(SAMPLE_ALGORITHM)
 
-    with open(file_name, "rb") as f:
-        file_hash = hashlib.sha1()
-        while chunk := f.read(block_size):
-            file_hash.update(chunk)
+    with open_file(file_name, -1) as f:
+        head = f.read(sample_size)
+        file_hash.update(head)
+        read_bytes = len(head)
+        if file_size > 2 * sample_size:
+            f.seek(file_size - sample_size)
+            tail = f.read(sample_size)
+            file_hash.update(tail)
+            read_bytes += len(tail)
+        if drop_cache:
+            fadvise(f, 'DONTNEED')
 
-    return file_hash.hexdigest()
+    return (file_hash.digest(), ), read_bytes
 
 
-def dupcleaner_menu():
+def physical_offset(file_name):
     """
-    This function provides a method to get from the user the arguments
-    used by the class DupCleaner.
+    Function to get the physical offset of the first extent of a file in
+    its device, using the FIEMAP ioctl (Linux). Reading the files in this
+    order reduces the seeks in rotational disks.
+    :param file_name: File
+    :return: Physical offset in bytes. OSError is raised if the
+             filesystem does not support it
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP),
+                      file_name)
 
-    :return: A tuple with these arguments:
-      folders: List of folders o files to check
-      rw: Boolean value to enable the write mode and delete files
-      recursive: Boolean value to enable recursive mode and deep in folders
-      test: When write mode is enabled, if this boolean argument is
-            enabled files are not removed.
-      machine_mode: Boolean value to get the list en machine readable mode,
-                    using the pipe as separator.
-      list_align: Boolean value to disable the output info alignment
-      verbose: Verbose calculating the MD5 and SHA-1 checksums
-      l_md5: Boolean value to calculate the checksum using MD5
-      l_sha1: Boolean value to calculate the checksum using SHA-1
+    # struct fiemap with room for one struct fiemap_extent
+    request = bytearray(struct.pack('=QQIIII', 0, 2 ** 64 - 1, 0, 0, 1, 0) +
+                        bytes(56))
+    with open(file_name, 'rb') as f:
+        fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+
+    mapped_extents = struct.unpack_from('=I', request, 20)[0]
+    return struct.unpack_from('=Q', request, 40)[0] if mapped_extents else 0
+
+
+def block_device(dev):
     """
-    parser = argparse.ArgumentParser(description='Check for duplicated files.')
-    parser.add_argument('folders', metavar='<files or folders>', type=str,
-                        nargs='+', help='list of file and folders to check.')
-    parser.add_argument('-r', action='store_true',
-                        help='Recursive. Deep in the directories.')
-    parser.add_argument('--write', action='store_true',
-                        help='List duplicated files. Do not remove.')
-    parser.add_argument('-m', action='store_true',
-                        help='List duplicated in machine readable mode. '
-                             'Only for list mode (default).')
-    parser.add_argument('-l', action='store_true',
-                        help='Do not align the extra info.')
-    parser.add_argument('-v', action='store_true',
-                        help='Verbose calculating the MD5 and SHA-1 checksums.')
-    parser.add_argument('--sha1', action='store_true',
-                        help='Use SHA-1 to calculate the checksum.')
-    parser.add_argument('--md5', action='store_true',
-                        help='Use MD5 to calculate the checksum (default).')
-    parser.add_argument('--test', action='store_true',
-                        help='Do not remove files, only test the process. '
-                             'Only for write mode.')
+    Function to get the block device of a filesystem and if it is a
+    rotational disk, from /sys/dev/block (Linux).
+    :param dev: Device number (st_dev)
+    :return: Tuple, names of the device (the partition and its disk, like
+             ("sda1", "sda")) and rotational flag, or ((), None) if the
+             device is not a block device
+    """
+    path = '/sys/dev/block/{}:{}'.format(os.major(dev), os.minor(dev))
+    if not os.path.exists(path):
+        return (), None
 
-    arguments = parser.parse_args()
+    path = os.path.realpath(path)
+    # The partitions do not have the queue folder of their disk
+    disk = path if os.path.isdir(os.path.join(path, 'queue')) else \
+        os.path.dirname(path)
+    try:
+        with open(os.path.join(disk, 'queue', 'rotational')) as f:
+            rotational = f.read().strip() == '1'
+    except OSError:
+        rotational = None
 
-    # Set the values in the class
-    recursive = True if arguments.r else False
-    l_sha1 = True if arguments.sha1 else False
-    l_md5 = True if arguments.md5 else False
-    test = True if arguments.test else False
-    rw = True if arguments.write else False
-    machine_mode = True if arguments.m else False
-    list_align = False if arguments.l else True
-    verbose = True if arguments.v else False
+    return (os.path.basename(path), os.path.basename(disk)), rotational
 
-    folders = arguments.folders
 
-    return folders, rw, recursive, test, machine_mode, list_align, verbose, l_md5, l_sha1
+def reflink(source, target):
+    """
+    Function to create the new file "target" sharing the data of "source"
+    (copy on write), using the FICLONE ioctl. No data is copied.
+    :param source: Existing file
+    :param target: New file name, it must not exist
+    :return: None. OSError is raised if the filesystem does not support it
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP),
+                      target)
 
+    with open(source, 'rb') as src, open(target, 'xb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
 
-class DupCleaner:
-    def __init__(self, folders, write_mode=False, recursive=True,
-                 test_mode=False, machine_mode=False, full_list_align=True,
-                 verbose=False, md5_sum=True, sha1_sum=False):
-        """
-        Init function for DupCleaner. Set the parameters to run the class.
 
-        The "folder" argument is mandatory.
+def link_file(source, target, method='auto'):
+    """
+    Function to replace the file "target" with a link to "source", so both
+    paths share the storage. The link is created using a temporary name in
+    the target folder and renamed to the target name, so the target path
+    always exists. A reflink keeps the target permissions and times.
+    :param source: File to keep
+    :param target: File replaced by the link
+    :param method: "auto", "reflink" or "hardlink"
+    :return: Link type created, "reflink" or "hardlink"
+    """
+    if method not in LINK_METHODS:
+        raise ValueError("Link method {} not valid".format(method))
 
-        :param folders: List of folders o files to check
-        :param write_mode: Boolean value to enable the write mode and delete
-               files
-        :param recursive: Boolean value to enable recursive mode and deep in
-               folders
-        :param test_mode: When write mode is enabled, if this boolean argument
-               is enabled
-               files are not removed.
-        :param machine_mode: Boolean value to get the list en machine readable
-               mode, using the pipe as separator.
-        :param full_list_align: Boolean value to disable the output info
-               alignment
-        :param md5_sum: Boolean value to calculate the checksum using MD5
-        :param sha1_sum: Boolean value to calculate the checksum using SHA-1
+    folder, name = os.path.split(target)
+    tmp_file = os.path.join(folder, '.{}.{}.dupcleaner'.format(
+        name, os.getpid()))
+    link_type = None
+    try:
+        if method != 'hardlink':
+            try:
+                reflink(source, tmp_file)
+                st = os.stat(target)
+                shutil.copystat(target, tmp_file)
+                with suppress(OSError):
+                    os.chown(tmp_file, st.st_uid, st.st_gid)
+                link_type = 'reflink'
+            except OSError:
+                with suppress(FileNotFoundError):
+                    os.remove(tmp_file)
+                if method == 'reflink':
+                    raise
+
+        if not link_type:
+            os.link(source, tmp_file)
+            link_type = 'hardlink'
+
+        os.replace(tmp_file, target)
+    except OSError:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_file)
+        raise
+
+    return link_type
+
+
+def keep_rule(rule):
+    """
+    Function to get the sort key function of a rule used to select the
+    file kept in every group. The file with the smallest key is kept.
+    :param rule: "oldest", "newest", "shortest", "prefix:PATH" or
+           "regex:PATTERN"
+    :return: Function using the path and the modification time (ns) of a
+             file, that returns its sort key
+    """
+    name, _, value = rule.partition(':')
+    if name == 'oldest' and not value:
+        return lambda path, mtime_ns: mtime_ns
+    if name == 'newest' and not value:
+        return lambda path, mtime_ns: -mtime_ns
+    if name == 'shortest' and not value:
+        return lambda path, mtime_ns: len(path)
+    if name == 'prefix' and value:
+        prefix = os.path.join(abspath(value), '')
+        return lambda path, mtime_ns: not path.startswith(prefix)
+    if name == 'regex' and value:
+        pattern = re.compile(value)
+        return lambda path, mtime_ns: not pattern.search(path)
+
+    raise ValueError("Keep rule {} not valid".format(rule))
+
+
+def device_limit(text):
+    """
+    Function to parse the number of jobs of a device.
+    :param text: "DEVICE=N", the device is a block device name (like sda
+           or nvme0n1) or a path in the device
+    :return: Tuple, device (name, or st_dev of a path) and number of jobs
+    """
+    name, _, jobs = text.rpartition('=')
+    if not name or not jobs.isdigit() or int(jobs) < 1:
+        raise ValueError("Device limit {} not valid".format(text))
+    if name.startswith(os.sep):
+        try:
+            name = os.stat(name).st_dev
+        except OSError as e:
+            raise ValueError("Device limit {} not valid: {}".format(
+                text, e)) from None
+
+    return name, int(jobs)
+
+
+def read_shard_header(file_name):
+    """
+    Function to read the header of a shard file written by
+    DupCleaner.write_shard.
+    :param file_name: Shard file
+    :return: Header dictionary, with the checksum algorithms, the host
+             and the folders of the shard
+    """
+    with open(file_name) as f:
+        header = json.loads(f.readline() or '{}')
+
+    if header.get('format') != SHARD_FORMAT:
+        raise ValueError("File {} is not a shard file".format(file_name))
+    return header
+
+
+def read_shard(file_name):
+    """
+    Generator to read the records of a shard file, sorted by size,
+    checksums and path.
+    :param file_name: Shard file
+    :return: Iterator of lists [size, list of checksums (hex), path,
+             mtime_ns, ctime_ns, st_dev, st_ino]
+    """
+    read_shard_header(file_name)
+    with open(file_name) as f:
+        f.readline()
+        for line in f:
+            yield json.loads(line)
+
+
+def merge_shards(file_names):
+    """
+    Generator to merge shard files into groups of files with the same
+    size and checksums, in any shard. The files are merged as streams,
+    only the current record of every shard and the current group are
+    in memory. A path of the same host found in multiple shards is used
+    once.
+    :param file_names: List of shard files
+    :return: Iterator of lists of records, with 2 or more files. The host
+             of the shard is appended to every record
+    """
+    def host_records(file_name):
+        host = read_shard_header(file_name).get('host') or ''
+        for record in read_shard(file_name):
+            yield record + [host]
+
+    merged = heapq.merge(*[host_records(x) for x in file_names],
+                         key=lambda x: (x[0], x[1], x[2], x[7]))
+    for _, records in groupby(merged, key=lambda x: (x[0], x[1])):
+        lst_records = []
+        for record in records:
+            if not lst_records or (lst_records[-1][2], lst_records[-1][7]) \
+                    != (record[2], record[7]):
+                lst_records.append(record)
+        if len(lst_records) > 1:
+            yield lst_records
+
+
+def split_group(records):
+    """
+    Function to check if a group of records (like a group of groupby)
+    has more than one record, reading only two records, so the big groups
+    are not stored in memory.
+    :param records: Iterator of records
+    :return: Tuple, first record and iterator of all the records, or None
+             if the group only has one record
+    """
+    first = next(records)
+    second = next(records, None)
+    if second is None:
+        return first, None
+
+    return first, chain((first, second), records)
+
+
+def parse_size(text):
+    """
+    Function to parse a size in bytes, with an optional suffix
+    :param text: Size, like 1048576, 512K, 512M or 2G
+    :return: Size in bytes
+    """
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+
+    return int(text)
+
+
+def read_filter_file(file_name):
+    """
+    Function to read the filter rules of a file, one rule per line. The
+    empty lines and the lines starting with "#" are not used.
+    :param file_name: Filter rules file
+    :return: List of rules, see WalkFilter
+    """
+    with open(file_name) as f:
+        return [x.strip() for x in f
+                if x.strip() and not x.lstrip().startswith('#')]
+
+
+def daemon_request(socket_path, request):
+    """
+    Function to send a request to a daemon (see DupDaemon) and get the
+    response.
+    :param socket_path: Unix socket of the daemon
+    :param request: Request dictionary, like {"op": "groups"}
+    :return: Response dictionary
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+def sqlite_int(value):
+    """
+    Function to store unsigned 64 bits values (device and inode numbers)
+    in the signed 64 bits integers used by SQLite.
+    :param value: Unsigned integer
+    :return: Signed integer with the same bits
+    """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class DigestCache:
+    def __init__(self, file_name, max_entries=CACHE_SIZE, max_age=0):
         """
-        self.in_folders = folders
-        self.write_mode = write_mode
-        self.recursive = recursive
-        self.test_mode = test_mode
-        self.machine_mode = machine_mode
-        self.md5 = md5_sum
-        self.sha1 = sha1_sum
-        self.full_list_align = full_list_align
-        self.verbose = verbose
+        Init function for DigestCache. Persistent cache of checksums stored
+        in a SQLite database.
 
-        # Set the default values
-        if not self.md5 and not self.sha1:
-            self.md5 = True
+        The checksums are stored using the device, inode, size and
+        modification time (ns) of the file as key, so a checksum is only
+        used if the file was not modified.
 
-        # Show some warnings
-        if not self.write_mode and self.test_mode:
-            print("WARNING: Parameter test_mode "
-                  "does not have effect in list mode.")
+        :param file_name: SQLite database file
+        :param max_entries: Max number of checksums stored. The least
+               recently used checksums are removed.
+        :param max_age: Remove the checksums not used in these days.
+               Zero to keep them.
+        """
+        self.file_name = file_name
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.run_time = int(time.time())
+        self.used = []
 
-        if self.write_mode and self.machine_mode:
-            print("WARNING: Parameter machine_mode "
-                  "does not have effect in write mode.")
-            self.machine_mode = False
+        self.db = sqlite3.connect(file_name)
+        self.db.execute("CREATE TABLE IF NOT EXISTS digests ("
+                        "dev INTEGER, ino INTEGER, size INTEGER, "
+                        "mtime_ns INTEGER, algorithm TEXT, digest BLOB, "
+                        "path TEXT, last_used INTEGER, "
+                        "PRIMARY KEY (dev, ino, algorithm))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS digests_last_used "
+                        "ON digests (last_used)")
 
-        if self.machine_mode and self.full_list_align:
-            print("WARNING: Parameters machine_mode "
-                  "and list align used for output.")
-            print("* Using machine mode.")
-            self.full_list_align = False
+    def get(self, file_key, algorithm):
+        """
+        Get the checksum for a file, if the file was not modified.
 
-        # Set global variables
-        self.files = {}
-        self.checksums = {}
-        self.def_action_folder = {}
+        :param file_key: Tuple (st_dev, st_ino, st_size, st_mtime_ns)
+        :param algorithm: Checksum algorithm name
+        :return: Checksum (bytes) or None if not found
+        """
+        dev, ino, size, mtime_ns = file_key
+        key = (sqlite_int(dev), sqlite_int(ino), algorithm)
+        row = self.db.execute(
+            "SELECT size, mtime_ns, digest FROM digests "
+            "WHERE dev = ? AND ino = ? AND algorithm = ?", key).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            self.misses += 1
+            return None
 
-    def __get_files__(self, files):
+        self.hits += 1
+        self.used.append(key)
+        return row[2]
+
+    def put(self, file_key, algorithm, digest, path):
         """
-        This function find the all files in the files and folders included
-        in the "files" argument and store the value in the "self.files"
-        dictionary.
+        Store the checksum for a file.
 
-        :param files: List of files and folders
+        :param file_key: Tuple (st_dev, st_ino, st_size, st_mtime_ns)
+        :param algorithm: Checksum algorithm name
+        :param digest: Checksum (bytes)
+        :param path: File name, used to prune the cache
         :return: None
         """
-        for file_name in os.listdir(files):
-            # Do not include symbolic links files
-            full_name = files + file_name
-            if isfile(full_name) and not islink(full_name):
-                self.files[full_name] = self.files.get(full_name, 0) + 1
-            elif isdir(full_name):
-                if self.recursive:
-                    self.__get_files__(full_name + os.sep)
-                else:
-                    pass
-            else:
-                print("File {} not included".format(full_name))
+        dev, ino, size, mtime_ns = file_key
+        self.db.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (sqlite_int(dev), sqlite_int(ino), size, mtime_ns, algorithm,
+             digest, path, self.run_time))
 
-    def __get_full_path__(self):
+    def prune(self):
         """
-        This function sets the full path for the input folders.
+        Remove the checksums for files that no longer exist or were
+        modified. The archive members are valid if their archive exists
+        and was not modified (see member_ino).
 
-        For example, for a file:
-          - file.txt -> /home/kix/file.txt
-        For a folder:
-          - . -> /home/kix/
+        :return: Number of removed checksums
+        """
+        removed = []
+        for row in self.db.execute("SELECT dev, ino, size, mtime_ns, path "
+                                   "FROM digests").fetchall():
+            # The MEMBER_INO flag of the members is stored as a negative
+            # inode number, see sqlite_int
+            member = split_member(row[4]) if row[1] < 0 else None
+            try:
+                if member is not None:
+                    st = os.stat(member[0])
+                    valid = (sqlite_int(st.st_dev),
+                             sqlite_int(member_ino(st, member[1]))) == \
+                        row[:2]
+                else:
+                    st = os.stat(row[4])
+                    valid = (sqlite_int(st.st_dev), sqlite_int(st.st_ino),
+                             st.st_size, st.st_mtime_ns) == row[:4]
+            except OSError:
+                valid = False
+            if not valid:
+                removed.append(row[:2])
+
+        self.db.executemany("DELETE FROM digests WHERE dev = ? AND ino = ?",
+                            removed)
+        self.db.commit()
+        return len(removed)
+
+    def evict(self):
+        """
+        Remove the checksums not used in max_age days and the least
+        recently used checksums over max_entries.
 
         :return: None
         """
-        lst_ret = []
+        if self.max_age:
+            self.db.execute("DELETE FROM digests WHERE last_used < ?",
+                            (self.run_time - self.max_age * 86400,))
+
+        count = self.db.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute("DELETE FROM digests WHERE rowid IN ("
+                            "SELECT rowid FROM digests "
+                            "ORDER BY last_used LIMIT ?)",
+                            (count - self.max_entries,))
+
+    def save(self):
+        """
+        Update the last used time for the cache hits and save the cache,
+        keeping it open.
+
+        :return: None
+        """
+        self.db.executemany("UPDATE digests SET last_used = ? "
+                            "WHERE dev = ? AND ino = ? AND algorithm = ?",
+                            [(self.run_time, ) + k for k in self.used])
+        self.used = []
+        self.db.commit()
+        self.run_time = int(time.time())
+
+    def close(self):
+        """
+        Update the last used time for the cache hits, apply the eviction
+        and save the cache.
+
+        :return: None
+        """
+        self.save()
+        self.evict()
+        self.db.commit()
+        self.db.close()
+
+
+class RunStats:
+    def __init__(self, progress=False, interval=PROGRESS_INTERVAL,
+                 stream=None, callback=None):
+        """
+        Init function for RunStats. Wall and CPU time, files and bytes
+        processed for every phase of a run, and the progress line.
+
+        :param progress: Boolean value to print the progress line
+        :param interval: Min seconds between two progress lines
+        :param stream: Stream for the progress line, sys.stderr by default
+        :param callback: Function called with the progress dictionary
+               (see get_progress) instead of printing the progress line
+        """
+        self.phases = {}
+        self.counters = {}
+        self.show_progress = progress
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.callback = callback
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.last_progress = 0
+        self.progress_start = (0, 0, 0)
+        self.phase_name = None
+        # Files and bytes to process and processed, used for the ETA
+        self.total = [0, 0]
+        self.done = [0, 0]
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager to measure the wall and CPU time of a phase. The
+        same phase can be measured multiple times, the times are added.
+
+        :param name: Phase name
+        :return: None
+        """
+        values = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0,
+                                               'files': 0, 'bytes': 0})
+        old_name = self.phase_name
+        self.phase_name = name
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            values['wall'] += time.perf_counter() - start_wall
+            values['cpu'] += time.process_time() - start_cpu
+            self.phase_name = old_name
+
+    def add(self, name, files=0, read_bytes=0):
+        """
+        Add files and bytes processed to a phase.
+
+        :param name: Phase name
+        :param files: Number of files processed
+        :param read_bytes: Number of bytes read
+        :return: None
+        """
+        values = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0,
+                                               'files': 0, 'bytes': 0})
+        values['files'] += files
+        values['bytes'] += read_bytes
+
+    def set_total(self, files, work_bytes):
+        """
+        Set the work to do for the progress line and the ETA.
+
+        :param files: Number of files to process
+        :param work_bytes: Number of bytes to process
+        :return: None
+        """
+        self.total = [files, work_bytes]
+        self.done = [0, 0]
+        self.progress_start = (time.perf_counter(), 0, 0)
+
+    def advance(self, files=0, work_bytes=0):
+        """
+        Add processed work and print the progress line.
+
+        :param files: Number of files processed
+        :param work_bytes: Number of bytes processed (read or discarded)
+        :return: None
+        """
+        self.done[0] += files
+        self.done[1] += work_bytes
+        self.progress()
+
+    def get_progress(self, now):
+        """
+        Return the progress of the run.
+
+        :param now: Current time, from time.perf_counter
+        :return: Dictionary with the phase, the files and bytes processed
+                 and to process (zero if not known yet), the throughput
+                 (bytes/s and files/s) and the ETA in seconds (None if
+                 not known)
+        """
+        elapsed = now - self.progress_start[0]
+        rate = (self.done[1] - self.progress_start[2]) / elapsed \
+            if elapsed else 0
+        files_rate = (self.done[0] - self.progress_start[1]) / elapsed \
+            if elapsed else 0
+        return {'phase': self.phase_name,
+                'files': self.done[0], 'total_files': self.total[0],
+                'bytes': self.done[1], 'total_bytes': self.total[1],
+                'bytes_s': rate, 'files_s': files_rate,
+                'eta': (self.total[1] - self.done[1]) / rate
+                if rate and self.total[0] else None}
+
+    def progress(self):
+        """
+        Print the progress line, or call the callback, if enabled and the
+        interval is elapsed.
+
+        :return: None
+        """
+        if not self.show_progress:
+            return
+
+        now = time.perf_counter()
+        if now - self.last_progress < self.interval:
+            return
+
+        if not self.last_progress:
+            self.last_progress = now
+            self.progress_start = (now, self.done[0], self.done[1])
+            return
+
+        self.last_progress = now
+        state = self.get_progress(now)
+        if self.callback is not None:
+            self.callback(state)
+            return
+
+        if not self.total[0]:
+            text = "{}: {} files".format(self.phase_name, self.done[0])
+        else:
+            text = "{}: {}/{} files {:.1f}/{:.1f} MB {:.1f} MB/s " \
+                   "{:.0f} files/s".format(
+                    self.phase_name, self.done[0], self.total[0],
+                    self.done[1] / 1e6, self.total[1] / 1e6,
+                    state['bytes_s'] / 1e6, state['files_s'])
+            if state['eta'] is not None:
+                eta = int(state['eta'])
+                text += " ETA {}:{:02}:{:02}".format(
+                    eta // 3600, eta // 60 % 60, eta % 60)
+        self.stream.write("\r" + text + "\033[K")
+        self.stream.flush()
+
+    def finish(self):
+        """
+        End the progress line, if printed.
+
+        :return: None
+        """
+        if self.show_progress and self.last_progress and \
+                self.callback is None:
+            self.stream.write("\r\033[K")
+            self.stream.flush()
+        self.last_progress = 0
+
+    def report(self):
+        """
+        Return the statistics of the run.
+
+        :return: Dictionary with the phases and the counters
+        """
+        phases = {}
+        for name, values in self.phases.items():
+            phases[name] = dict(values)
+            wall = values['wall']
+            phases[name]['mb_s'] = values['bytes'] / 1e6 / wall if wall else 0
+            phases[name]['files_s'] = values['files'] / wall if wall else 0
+
+        ret = {'wall': time.perf_counter() - self.start_wall,
+               'cpu': time.process_time() - self.start_cpu,
+               'phases': phases}
+        ret.update(self.counters)
+        return ret
+
+
+class FileTable:
+    """
+    Compact table of files. Every file is identified by its index in the
+    table. The folder names are stored only once, the file names are
+    stored as bytes in a single buffer and the stat values in typed arrays.
+
+    Hard links to the same inode are one physical file. The first path
+    found is the primary file, the other paths are stored as its links.
+    """
+    __slots__ = ('folders', 'folder_ids', 'folder', 'names', 'name_end',
+                 'size', 'mtime_ns', 'ctime_ns', 'dev', 'ino', 'inodes',
+                 'links', 'linked')
+
+    def __init__(self):
+        """
+        Init function for FileTable. Creates an empty table.
+        """
+        self.folders = []
+        self.folder_ids = {}
+        self.folder = array('L')
+        self.names = bytearray()
+        self.name_end = array('Q')
+        self.size = array('Q')
+        self.mtime_ns = array('q')
+        self.ctime_ns = array('q')
+        self.dev = array('Q')
+        self.ino = array('Q')
+        # Only for files with more than one hard link:
+        # (st_dev, st_ino) -> primary file
+        self.inodes = {}
+        # Primary file -> array of the other paths (hard links)
+        self.links = {}
+        # Set of the files that are hard links of a primary file
+        self.linked = set()
+
+    def __len__(self):
+        return len(self.size)
+
+    def add(self, path, st):
+        """
+        Include a file in the table.
+
+        :param path: Full file name
+        :param st: os.stat_result of the file
+        :return: Index of the file in the table
+        """
+        folder, name = os.path.split(path)
+        folder_id = self.folder_ids.get(folder)
+        if folder_id is None:
+            folder_id = len(self.folders)
+            self.folder_ids[folder] = folder_id
+            self.folders.append(folder)
+
+        self.folder.append(folder_id)
+        self.names += os.fsencode(name)
+        self.name_end.append(len(self.names))
+        self.size.append(st.st_size)
+        self.mtime_ns.append(st.st_mtime_ns)
+        self.ctime_ns.append(st.st_ctime_ns)
+        self.dev.append(st.st_dev)
+        self.ino.append(st.st_ino)
+        idx = len(self.size) - 1
+
+        if st.st_nlink > 1:
+            primary = self.inodes.setdefault((st.st_dev, st.st_ino), idx)
+            if primary != idx:
+                self.links.setdefault(primary, array('Q')).append(idx)
+                self.linked.add(idx)
+
+        return idx
+
+    def dirname(self, idx):
+        """
+        Return the folder name of a file.
+
+        :param idx: Index of the file
+        :return: Folder name
+        """
+        return self.folders[self.folder[idx]]
+
+    def path(self, idx):
+        """
+        Return the full file name of a file.
+
+        :param idx: Index of the file
+        :return: Full file name
+        """
+        start = self.name_end[idx - 1] if idx else 0
+        name = os.fsdecode(bytes(self.names[start:self.name_end[idx]]))
+        return os.path.join(self.folders[self.folder[idx]], name)
+
+    def file_info(self, idx):
+        """
+        Return the information of a file as a dictionary.
+
+        :param idx: Index of the file
+        :return: Dictionary with the path, size, mtime and ctime (seconds),
+                 and the hard links of the file, if any
+        """
+        info = {'path': self.path(idx), 'size': self.size[idx],
+                'mtime': self.mtime_ns[idx] / 1e9,
+                'ctime': self.ctime_ns[idx] / 1e9}
+        if idx in self.links:
+            info['links'] = [self.path(x) for x in self.links[idx]]
+        return info
+
+    def is_member(self, idx):
+        """
+        Check if a file is an archive member.
+
+        :param idx: Index of the file
+        :return: True if the file is an archive member
+        """
+        return self.ino[idx] >= MEMBER_INO
+
+    def is_read_only(self, idx):
+        """
+        Check if a file is read only: an archive member, or a file of
+        other host (merged shards).
+
+        :param idx: Index of the file
+        :return: True if the file is read only
+        """
+        return bool(self.ino[idx] & (MEMBER_INO | REMOTE_INO))
+
+    def cache_key(self, idx):
+        """
+        Return the key used in the checksums cache for a file.
+
+        :param idx: Index of the file
+        :return: Tuple (st_dev, st_ino, st_size, st_mtime_ns)
+        """
+        return self.dev[idx], self.ino[idx], self.size[idx], \
+            self.mtime_ns[idx]
+
+
+class DigestIndex:
+    def __init__(self, file_name):
+        """
+        Init function for DigestIndex. Reference index of a tree, written
+        by DigestIndex.write: sorted records of size and checksums, used
+        to check other files against the tree without reading it again.
+
+        The records are fixed size, the size is stored in big endian, so
+        the file is mapped in memory and searched using binary search.
+
+        :param file_name: Index file
+        """
+        self.file_name = file_name
+        self.file = open(file_name, 'rb')
+        if self.file.readline() != INDEX_MAGIC:
+            self.file.close()
+            raise ValueError("File {} is not an index file".format(
+                file_name))
+
+        header = json.loads(self.file.readline())
+        self.algorithms = tuple(header['algorithms'])
+        self.record_size = header['record_size']
+        self.offset = self.file.tell()
+        self.count = (os.fstat(self.file.fileno()).st_size - self.offset) \
+            // self.record_size
+        self.data = mmap.mmap(self.file.fileno(), 0,
+                              access=mmap.ACCESS_READ) if self.count else b''
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, item):
+        """
+        Check if a file is in the index.
+
+        :param item: Tuple (size, tuple of checksums)
+        :return: True if found
+        """
+        l_size, key = item
+        return self.__find__(struct.pack('>Q', l_size) + b''.join(key))
+
+    def has_size(self, l_size):
+        """
+        Check if the index includes files with this size.
+
+        :param l_size: Size in bytes
+        :return: True if found
+        """
+        return self.__find__(struct.pack('>Q', l_size))
+
+    def __find__(self, value):
+        """
+        Binary search of a record starting with value.
+
+        :param value: Record or record prefix (bytes)
+        :return: True if found
+        """
+        length = len(value)
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            start = self.offset + mid * self.record_size
+            if self.data[start:start + length] < value:
+                low = mid + 1
+            else:
+                high = mid
+
+        start = self.offset + low * self.record_size
+        return low < self.count and self.data[start:start + length] == value
+
+    def close(self):
+        """
+        Close the index file.
+
+        :return: None
+        """
+        if self.count:
+            self.data.close()
+        self.file.close()
+
+    @staticmethod
+    def write(file_name, algorithms, records):
+        """
+        Write an index file. The records are sorted and the repeated
+        records (files with the same content) are stored once.
+
+        :param file_name: Index file
+        :param algorithms: List of checksum algorithm names
+        :param records: Iterable of tuples (size, tuple of checksums)
+        :return: Number of records written
+        """
+        lst_records = sorted({struct.pack('>Q', x) + b''.join(y)
+                              for x, y in records})
+        record_size = 8 + sum(hashlib.new(x).digest_size
+                              for x in algorithms)
+        with open(file_name, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(json.dumps({'algorithms': list(algorithms),
+                                'record_size': record_size}).encode() + b'\n')
+            for record in lst_records:
+                f.write(record)
+
+        return len(lst_records)
+
+
+class ExternalSorter:
+    def __init__(self, memory_limit, tmp_dir=None):
+        """
+        Init function for ExternalSorter. Sorts more records (tuples)
+        than fit in memory: the records are sorted in memory up to the
+        memory limit and written to disk as a sorted run. Reading the
+        records, the runs are merged (k-way merge).
+
+        :param memory_limit: Max bytes of records in memory (estimated)
+        :param tmp_dir: Folder for the runs, the system default if None
+        """
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.records = []
+        self.used = 0
+        self.runs = []
+        self.count = 0
+        # Runs written, for the statistics
+        self.written_runs = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, record):
+        """
+        Include a record. Only strings, bytes, numbers and tuples of them
+        are supported.
+
+        :param record: Tuple
+        :return: None
+        """
+        self.records.append(record)
+        self.count += 1
+        self.used += RECORD_OVERHEAD + sum(len(x) for x in record
+                                           if isinstance(x, (str, bytes)))
+        if self.used >= self.memory_limit:
+            self.__spill__()
+
+    def __spill__(self):
+        """
+        Write the records in memory as a sorted run.
+
+        :return: None
+        """
+        if not self.records:
+            return
+
+        self.records.sort()
+        run = tempfile.TemporaryFile(dir=self.tmp_dir)
+        for record in self.records:
+            marshal.dump(record, run)
+        run.seek(0)
+        self.runs.append(run)
+        self.written_runs += 1
+        self.records = []
+        self.used = 0
+
+    @staticmethod
+    def __read_run__(run):
+        """
+        Generator to read the records of a run.
+
+        :param run: Run file
+        :return: Iterator of records
+        """
+        while True:
+            try:
+                yield marshal.load(run)
+            except EOFError:
+                break
+        run.close()
+
+    def __iter__(self):
+        """
+        Get the sorted records. The sorter is empty after reading them.
+
+        :return: Iterator of records
+        """
+        if not self.runs:
+            self.records.sort()
+            records, self.records = self.records, []
+            self.used = self.count = 0
+            return iter(records)
+
+        self.__spill__()
+        runs, self.runs = self.runs, []
+        self.count = 0
+        return heapq.merge(*[self.__read_run__(x) for x in runs])
+
+    def close(self):
+        """
+        Remove the runs not read.
+
+        :return: None
+        """
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.records = []
+
+
+class WalkFilter:
+    """
+    Rules to prune the walk, compiled once. The rules are text, like
+    "exclude:node_modules":
+      - exclude:GLOB / include:GLOB: file or folder names (or relative
+        paths, if the pattern includes a path separator)
+      - exclude-regex:PATTERN / include-regex:PATTERN: regular expression
+        searched in the relative paths
+      - min-size:SIZE / max-size:SIZE: size of the files, like 1M
+      - max-depth:N: folder levels walked below the input folders
+      - type:EXT[,EXT...]: extensions of the files, like jpg,png
+
+    The exclude rules are used for files and folders, the excluded
+    folders are not read. The include and type rules are only used for
+    files: if set, only the files matching any of them are included. Only
+    the size rules need the stat result of the files.
+    """
+
+    def __init__(self, rules):
+        """
+        Init function for WalkFilter.
+
+        :param rules: List of rules
+        """
+        patterns = {'exclude': ([], []), 'include': ([], [])}
+        self.min_size = 0
+        self.max_size = None
+        self.max_depth = None
+        self.extensions = set()
+        for rule in rules:
+            name, _, value = rule.partition(':')
+            try:
+                if not value:
+                    raise ValueError
+                if name in patterns and os.sep in value:
+                    patterns[name][1].append(
+                        '^' + fnmatch.translate(value.strip(os.sep)))
+                elif name in patterns:
+                    patterns[name][0].append(fnmatch.translate(value))
+                elif name in ('exclude-regex', 'include-regex'):
+                    patterns[name[:-6]][1].append(re.compile(value).pattern)
+                elif name == 'min-size':
+                    self.min_size = parse_size(value)
+                elif name == 'max-size':
+                    self.max_size = parse_size(value)
+                elif name == 'max-depth':
+                    self.max_depth = int(value)
+                elif name == 'type':
+                    self.extensions.update('.' + x.strip().lstrip('.').lower()
+                                           for x in value.split(','))
+                else:
+                    raise ValueError
+            except (ValueError, re.error):
+                raise ValueError("Filter rule {} not valid".format(
+                    rule)) from None
+
+        self.exclude = [self.__compile__(x) for x in patterns['exclude']]
+        self.include = [self.__compile__(x) for x in patterns['include']]
+        self.has_include = any(self.include)
+
+    @staticmethod
+    def __compile__(patterns):
+        """
+        Compile a list of patterns as one regular expression.
+
+        :param patterns: List of regular expressions
+        :return: Compiled regular expression, or None if the list is empty
+        """
+        if not patterns:
+            return None
+
+        return re.compile('|'.join('(?:{})'.format(x) for x in patterns))
+
+    @staticmethod
+    def __match__(regexes, name, path):
+        """
+        Check the name and the relative path of a file or folder.
+
+        :param regexes: List, names and paths regular expressions
+        :param name: File or folder name
+        :param path: Relative path
+        :return: True if the name or the path matches
+        """
+        names, paths = regexes
+        return (names is not None and names.match(name) is not None) or \
+            (paths is not None and paths.search(path) is not None)
+
+    def skip_folder(self, name, path, depth):
+        """
+        Check if a folder must not be read.
+
+        :param name: Folder name
+        :param path: Relative path of the folder
+        :param depth: Level of the folder below the input folder (1 for
+               its sub folders)
+        :return: True if the folder is pruned
+        """
+        if self.max_depth is not None and depth > self.max_depth:
+            return True
+
+        return self.__match__(self.exclude, name, path)
+
+    def skip_file(self, name, path):
+        """
+        Check if a file is pruned by its name, before the stat call.
+
+        :param name: File name
+        :param path: Relative path of the file
+        :return: True if the file is pruned
+        """
+        if self.__match__(self.exclude, name, path):
+            return True
+        if self.extensions and \
+                os.path.splitext(name)[1].lower() not in self.extensions:
+            return True
+
+        return self.has_include and not self.__match__(self.include, name,
+                                                       path)
+
+    def skip_size(self, size):
+        """
+        Check if a file is pruned by its size.
+
+        :param size: Size of the file
+        :return: True if the file is pruned
+        """
+        return size < self.min_size or \
+            (self.max_size is not None and size > self.max_size)
+
+
+class Inotify:
+    """
+    Minimal inotify binding (Linux, using ctypes) to watch folders. The
+    events of the files in the watched folders are read as paths.
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+        IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self):
+        """
+        Init function for Inotify. OSError is raised if inotify is not
+        available.
+        """
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify not available")
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # Watch descriptor -> folder, and folder -> watch descriptor
+        self.watches = {}
+        self.folders = {}
+
+    def add(self, folder):
+        """
+        Watch a folder.
+
+        :param folder: Folder name
+        :return: None
+        """
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), folder)
+        self.watches[wd] = folder
+        self.folders[folder] = wd
+
+    def read(self):
+        """
+        Read the pending events.
+
+        :return: List of tuples (path, event mask). The path is the
+                 watched folder for the events of the folder itself.
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        ret = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            folder = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                # Removed folder, the kernel removes the watch
+                if self.watches.pop(wd, None) is not None:
+                    self.folders.pop(folder, None)
+                continue
+            if folder is None and not mask & self.IN_Q_OVERFLOW:
+                continue
+            path = os.path.join(folder, os.fsdecode(name)) if name \
+                else folder
+            ret.append((path, mask))
+
+        return ret
+
+    def close(self):
+        """
+        Close the inotify file descriptor.
+
+        :return: None
+        """
+        os.close(self.fd)
+
+
+class LatencyStats:
+    """
+    Count, mean and max of a latency, and the percentiles of the last
+    samples, in seconds.
+    """
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        """
+        Init function for LatencyStats.
+
+        :param samples: Number of samples kept for the percentiles
+        """
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=samples)
+
+    def add(self, seconds):
+        """
+        Add a sample.
+
+        :param seconds: Latency in seconds
+        :return: None
+        """
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def report(self):
+        """
+        Return the statistics as a dictionary.
+
+        :return: Dictionary with the count, mean, max, p50 and p99
+        """
+        samples = sorted(self.samples)
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': samples[len(samples) // 2] if samples else 0.0,
+                'p99': samples[len(samples) * 99 // 100] if samples
+                else 0.0}
+
+
+class DupGroup:
+    """
+    Group of files with the same checksums.
+    """
+    __slots__ = ('key', 'files')
+
+    def __init__(self, key, files):
+        """
+        Init function for DupGroup.
+
+        :param key: Tuple of checksums (bytes)
+        :param files: Array of file indexes in the FileTable
+        """
+        self.key = key
+        self.files = files
+
+
+def dupcleaner_arguments():
+    """
+    This function parses the command line arguments of the application.
+    The options only used by the application, like --daemon, are not
+    arguments of the class DupCleaner.
+
+    :return: argparse.Namespace with the arguments
+    """
+    parser = argparse.ArgumentParser(description='Check for duplicated files.')
+    parser.add_argument('folders', metavar='<files or folders>', type=str,
+                        nargs='*', help='list of file and folders to check.')
+    parser.add_argument('-r', action='store_true',
+                        help='Recursive. Deep in the directories.')
+    parser.add_argument('--write', action='store_true',
+                        help='List duplicated files. Do not remove.')
+    parser.add_argument('-m', action='store_true',
+                        help='List duplicated in machine readable mode. '
+                             'Only for list mode (default).')
+    parser.add_argument('-l', action='store_true',
+                        help='Do not align the extra info.')
+    parser.add_argument('-v', action='store_true',
+                        help='Verbose calculating the MD5 and SHA-1 checksums.')
+    parser.add_argument('--sha1', action='store_true',
+                        help='Use SHA-1 to calculate the checksum.')
+    parser.add_argument('--md5', action='store_true',
+                        help='Use MD5 to calculate the checksum (default).')
+    parser.add_argument('--test', action='store_true',
+                        help='Do not remove files, only test the process. '
+                             'Only for write mode.')
+    parser.add_argument('--cache', metavar='FILE', type=str, default=None,
+                        help='Store the checksums in this cache file and '
+                             'reuse them for not modified files.')
+    parser.add_argument('--cache-size', metavar='N', type=int,
+                        default=CACHE_SIZE,
+                        help='Max number of checksums in the cache file.')
+    parser.add_argument('--cache-max-age', metavar='DAYS', type=int,
+                        default=0,
+                        help='Remove the checksums not used in these days.')
+    parser.add_argument('--cache-prune', action='store_true',
+                        help='Remove the checksums of deleted or modified '
+                             'files from the cache file.')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='Number of files processed in parallel.')
+    parser.add_argument('--processes', action='store_true',
+                        help='Use processes instead of threads for the '
+                             'parallel jobs.')
+    parser.add_argument('--hash', metavar='ALGORITHM', type=str,
+                        action='append', default=[],
+                        choices=sorted(x for x in hashlib.algorithms_available
+                                       if not x.startswith('shake_')),
+                        help='Use this hashlib algorithm to calculate the '
+                             'checksum, like blake2b. It can be repeated, '
+                             'the first one is the primary key.')
+    parser.add_argument('--block-size', metavar='BYTES', type=int,
+                        default=BLOCK_SIZE,
+                        help='Buffer size used to read the files.')
+    parser.add_argument('--format', type=str, default='text',
+                        choices=['text', 'ndjson'],
+                        help='Output format. ndjson prints every group as a '
+                             'JSON object as soon as it is found.')
+    parser.add_argument('--compare', type=str, default='hash',
+                        choices=['hash', 'bytes'],
+                        help='Compare the files with the same size using the '
+                             'checksums (default) or their content, byte '
+                             'by byte.')
+    parser.add_argument('--progress', action='store_true',
+                        help='Print the progress and the ETA in stderr.')
+    parser.add_argument('--stats', metavar='FILE', type=str, default=None,
+                        help='Write the statistics of the run in this JSON '
+                             'file.')
+    parser.add_argument('--profile', metavar='FILE', type=str, default=None,
+                        help='Write the cProfile statistics of the run in '
+                             'this file.')
+    parser.add_argument('--link', metavar='METHOD', type=str, default=None,
+                        choices=LINK_METHODS,
+                        help='Write mode. Replace the duplicated files with '
+                             'links to the kept file instead of removing '
+                             'them: reflink, hardlink or auto (reflink if '
+                             'supported, else hard link).')
+    parser.add_argument('--link-all', action='store_true',
+                        help='Write mode. Replace all the duplicated files '
+                             'with links to the first file of every group, '
+                             'without the actions menu. Uses --link or '
+                             'auto.')
+    parser.add_argument('--keep', metavar='RULE', type=str, action='append',
+                        default=[],
+                        help='Write mode. Keep one file of every group '
+                             'using this rule and remove (or link) the '
+                             'others, without the actions menu: oldest, '
+                             'newest, shortest, prefix:PATH or '
+                             'regex:PATTERN. It can be repeated, the next '
+                             'rules break the ties.')
+    parser.add_argument('--plan', metavar='FILE', type=str, default=None,
+                        help='Write the actions selected by the --keep rules '
+                             'in this NDJSON file, for review. No file is '
+                             'removed.')
+    parser.add_argument('--execute-plan', metavar='FILE', type=str,
+                        default=None,
+                        help='Write mode. Execute the actions of this plan '
+                             'file. The folders are not checked.')
+    parser.add_argument('--write-index', metavar='FILE', type=str,
+                        default=None,
+                        help='Write a reference index file with the size and '
+                             'the checksums of all the files.')
+    parser.add_argument('--index', metavar='FILE', type=str, action='append',
+                        default=[],
+                        help='List the files already stored in the tree of '
+                             'this reference index file. It can be '
+                             'repeated. In write mode, these files are '
+                             'removed.')
+    parser.add_argument('--write-shard', metavar='FILE', type=str,
+                        default=None,
+                        help='Write a shard file with the size, the '
+                             'checksums and the path of all the files, to '
+                             'merge it later with the shards of other '
+                             'folders or hosts.')
+    parser.add_argument('--merge', metavar='FILE', type=str, action='append',
+                        default=[],
+                        help='Get the duplicated files from these shard '
+                             'files, instead of the folders. It can be '
+                             'repeated.')
+    parser.add_argument('--memory-limit', metavar='SIZE', type=parse_size,
+                        default=0,
+                        help='Group the files using sorted runs on disk, '
+                             'using this memory (like 512M), for scans '
+                             'bigger than the memory.')
+    parser.add_argument('-x', '--one-file-system', action='store_true',
+                        help='Do not include the folders in other '
+                             'filesystems (mount points).')
+    parser.add_argument('--device-jobs', metavar='N', type=int, default=0,
+                        help='Read the files of every device (disk) with '
+                             'N parallel jobs, in physical order. The '
+                             'rotational disks use 1 job.')
+    parser.add_argument('--device-limit', metavar='DEV=N', type=str,
+                        action='append', default=[],
+                        help='Number of jobs of a device (like sda=2 or '
+                             '/mnt/disk=2), with --device-jobs. It can be '
+                             'repeated.')
+    parser.add_argument('--drop-page-cache', action='store_true',
+                        help='Remove the files read from the page cache, '
+                             'to keep the cache of other programs.')
+    parser.add_argument('--tree-threshold', metavar='SIZE', type=parse_size,
+                        default=0,
+                        help='Use tree checksums for the files of this size '
+                             'or bigger (like 1G): the segments are read in '
+                             'parallel and the files stop being read when a '
+                             'segment differs.')
+    parser.add_argument('--segment-size', metavar='SIZE', type=parse_size,
+                        default=SEGMENT_SIZE,
+                        help='Segment size of the tree checksums (default '
+                             '64M).')
+    parser.add_argument('--filter', metavar='RULE', type=str, action='append',
+                        default=[],
+                        help='Prune the walk using this rule: exclude:GLOB, '
+                             'include:GLOB, exclude-regex:PATTERN, '
+                             'include-regex:PATTERN, min-size:SIZE, '
+                             'max-size:SIZE, max-depth:N or type:EXT. It '
+                             'can be repeated.')
+    parser.add_argument('--filter-file', metavar='FILE', type=str,
+                        default=None,
+                        help='Read the rules to prune the walk from this '
+                             'file, one rule per line.')
+    parser.add_argument('--archives', action='store_true',
+                        help='Include the files stored in zip and tar '
+                             'archives, without extracting them, like '
+                             'archive.zip!/inner/path. They are never '
+                             'removed.')
+    parser.add_argument('--find', metavar='FILE', type=str, action='append',
+                        default=[],
+                        help='Find only the copies of this file in the '
+                             'folders. Only the files with its size are '
+                             'read. It can be repeated.')
+    parser.add_argument('--max-matches', metavar='N', type=int, default=0,
+                        help='Stop after finding N copies, using --find.')
+    parser.add_argument('--daemon', metavar='SOCKET', type=str, default=None,
+                        help='Keep the checksums of the files in memory, '
+                             'update them with the filesystem changes and '
+                             'answer queries in this Unix socket.')
+    parser.add_argument('--rescan-interval', metavar='SECONDS', type=int,
+                        default=DAEMON_RESCAN,
+                        help='Seconds between two full rescans, in daemon '
+                             'mode.')
+
+    arguments = parser.parse_args()
+    if not arguments.folders and not arguments.execute_plan \
+            and not arguments.merge:
+        parser.error('the following arguments are required: '
+                     '<files or folders>')
+    if arguments.block_size < 1:
+        parser.error('argument --block-size: invalid size: {}'.format(
+            arguments.block_size))
+    if arguments.segment_size < 1:
+        parser.error('argument --segment-size: invalid size: {}'.format(
+            arguments.segment_size))
+
+    return arguments
+
+
+def dupcleaner_menu(arguments=None):
+    """
+    This function provides a method to get from the user the arguments
+    used by the class DupCleaner.
+
+    :param arguments: Arguments parsed by dupcleaner_arguments, or None
+           to parse the command line
+    :return: A tuple with these arguments:
+      folders: List of folders o files to check
+      rw: Boolean value to enable the write mode and delete files
+      recursive: Boolean value to enable recursive mode and deep in folders
+      test: When write mode is enabled, if this boolean argument is
+            enabled files are not removed.
+      machine_mode: Boolean value to get the list en machine readable mode,
+                    using the pipe as separator.
+      list_align: Boolean value to disable the output info alignment
+      verbose: Verbose calculating the MD5 and SHA-1 checksums
+      l_md5: Boolean value to calculate the checksum using MD5
+      l_sha1: Boolean value to calculate the checksum using SHA-1
+      cache_file: Persistent checksums cache file or None
+      cache_size: Max number of checksums in the cache
+      cache_max_age: Remove checksums not used in these days (0, keep)
+      cache_prune: Boolean value to remove the checksums of deleted files
+      jobs: Number of files processed in parallel
+      processes: Boolean value to use processes for the parallel jobs
+      algorithms: List of hashlib algorithms or None (use l_md5 / l_sha1)
+      block_size: Buffer size used to read the files
+      output_format: Output format, "text" or "ndjson"
+      compare: Compare method for the files with the same size, "hash" or
+               "bytes"
+      progress: Boolean value to print the progress in stderr
+      stats_file: JSON file for the statistics of the run or None
+      profile_file: File for the cProfile statistics or None
+      link_mode: Method to replace the duplicated files with links, "auto",
+                 "reflink" or "hardlink", or None
+      link_all: Boolean value to replace all the duplicated files with
+                links, without the actions menu
+      keep: List of rules to select the file kept in every group, or None
+      plan_file: File for the plan of the actions, or None
+      plan_input: Plan file to execute, or None
+      index_file: Reference index file to write, or None
+      index_inputs: List of reference index files to check the files
+                    against, or None
+      shard_file: Shard file to write, or None
+      shard_inputs: List of shard files to merge, or None
+      memory_limit: Max memory in bytes used to group the files, or zero
+      one_filesystem: Boolean value to stay in the filesystem of every
+                      input folder
+      device_jobs: Number of files read in parallel in every device, or
+                   zero
+      device_limits: List of numbers of jobs of some devices, or None
+      drop_page_cache: Boolean value to remove the files read from the
+                       page cache
+      tree_threshold: Min size of the files using tree checksums, or zero
+      segment_size: Size of the segments of the tree checksums
+      filters: List of rules to prune the walk, or None
+      filter_file: File with rules to prune the walk, or None
+      archives: Boolean value to include the members of the archives
+      find_targets: List of files to find their copies, or None
+      max_matches: Max number of copies found, or zero
+    """
+    if arguments is None:
+        arguments = dupcleaner_arguments()
+
+    # Set the values in the class
+    recursive = True if arguments.r else False
+    l_sha1 = True if arguments.sha1 else False
+    l_md5 = True if arguments.md5 else False
+    test = True if arguments.test else False
+    rw = True if arguments.write else False
+    machine_mode = True if arguments.m else False
+    list_align = False if arguments.l else True
+    verbose = True if arguments.v else False
+    cache_prune = True if arguments.cache_prune else False
+    processes = True if arguments.processes else False
+    progress = True if arguments.progress else False
+    link_all = True if arguments.link_all else False
+    one_filesystem = True if arguments.one_file_system else False
+    drop_page_cache = True if arguments.drop_page_cache else False
+    archives = True if arguments.archives else False
+    link_mode = arguments.link or ('auto' if link_all else None)
+
+    # Algorithms selected with --hash, plus --md5 / --sha1
+    algorithms = arguments.hash.copy()
+    if arguments.hash and l_md5:
+        algorithms.append('md5')
+    if arguments.hash and l_sha1:
+        algorithms.append('sha1')
+
+    folders = arguments.folders
+
+    return folders, rw, recursive, test, machine_mode, list_align, verbose, \
+        l_md5, l_sha1, arguments.cache, arguments.cache_size, \
+        arguments.cache_max_age, cache_prune, arguments.jobs, processes, \
+        algorithms or None, arguments.block_size, arguments.format, \
+        arguments.compare, progress, arguments.stats, arguments.profile, \
+        link_mode, link_all, arguments.keep or None, arguments.plan, \
+        arguments.execute_plan, arguments.write_index, \
+        arguments.index or None, arguments.write_shard, \
+        arguments.merge or None, arguments.memory_limit, one_filesystem, \
+        arguments.device_jobs, arguments.device_limit or None, \
+        drop_page_cache, arguments.tree_threshold, \
+        arguments.segment_size, arguments.filter or None, \
+        arguments.filter_file, archives, arguments.find or None, \
+        arguments.max_matches
+
+
+class DupCleaner:
+    def __init__(self, folders, write_mode=False, recursive=True,
+                 test_mode=False, machine_mode=False, full_list_align=True,
+                 verbose=False, md5_sum=True, sha1_sum=False,
+                 cache_file=None, cache_size=CACHE_SIZE, cache_max_age=0,
+                 cache_prune=False, jobs=1, processes=False,
+                 algorithms=None, block_size=BLOCK_SIZE,
+                 output_format='text', compare='hash', progress=False,
+                 stats_file=None, profile_file=None, link_mode=None,
+                 link_all=False, keep=None, plan_file=None, plan_input=None,
+                 index_file=None, index_inputs=None, shard_file=None,
+                 shard_inputs=None, memory_limit=0, one_filesystem=False,
+                 device_jobs=0, device_limits=None, drop_page_cache=False, tree_threshold=0,
+                 segment_size=SEGMENT_SIZE, filters=None, filter_file=None,
+                 archives=False, find_targets=None, max_matches=0):
+        """
+        Init function for DupCleaner. Set the parameters to run the class.
+
+        The "folder" argument is mandatory.
+
+        :param folders: List of folders o files to check
+        :param write_mode: Boolean value to enable the write mode and delete
+               files
+        :param recursive: Boolean value to enable recursive mode and deep in
+               folders
+        :param test_mode: When write mode is enabled, if this boolean argument
+               is enabled
+               files are not removed.
+        :param machine_mode: Boolean value to get the list en machine readable
+               mode, using the pipe as separator.
+        :param full_list_align: Boolean value to disable the output info
+               alignment
+        :param md5_sum: Boolean value to calculate the checksum using MD5
+        :param sha1_sum: Boolean value to calculate the checksum using SHA-1
+        :param cache_file: Persistent checksums cache file. None to
+               disable the cache.
+        :param cache_size: Max number of checksums in the cache file
+        :param cache_max_age: Remove the checksums not used in these days.
+               Zero to keep them.
+        :param cache_prune: Boolean value to remove the checksums of
+               deleted or modified files from the cache file
+        :param jobs: Number of files processed in parallel
+        :param processes: Boolean value to use processes instead of threads
+               for the parallel jobs
+        :param algorithms: List of hashlib algorithms used to calculate the
+               checksums, the first one is the primary key. If set, md5_sum
+               and sha1_sum are not used.
+        :param block_size: Buffer size used to read the files
+        :param output_format: Output format, "text" (default) or "ndjson"
+               to print the groups as JSON objects while they are found
+        :param compare: Method to compare the files with the same size,
+               "hash" (default) to use the checksums or "bytes" to compare
+               the files content
+        :param progress: Boolean value to print the progress in stderr
+        :param stats_file: JSON file to write the statistics of the run
+        :param profile_file: File to write the cProfile statistics of the
+               run (used by the application)
+        :param link_mode: Replace the duplicated files with links to the
+               kept file instead of removing them, "auto" (reflink if the
+               filesystem supports it, else hard link), "reflink" or
+               "hardlink". None to disable.
+        :param link_all: Boolean value to replace all the duplicated files
+               with links, without the actions menu (used by the
+               application)
+        :param keep: List of rules to select the file kept in every group
+               in the plan of actions: "oldest", "newest", "shortest",
+               "prefix:PATH" or "regex:PATTERN". The next rules break the
+               ties, and the first file of the group is kept if all the
+               rules tie.
+        :param plan_file: NDJSON file to write the plan of actions
+        :param plan_input: NDJSON plan file to execute (used by the
+               application)
+        :param index_file: Reference index file to write (used by the
+               application)
+        :param index_inputs: List of reference index files. If set, only
+               the files stored in the indexed trees are listed (or
+               removed in write mode), grouped by checksums. The checksum
+               algorithms are read from the index files.
+        :param shard_file: Shard file to write (used by the application)
+        :param shard_inputs: List of shard files. If set, the duplicated
+               files are read from the shard files, written by other
+               processes or hosts, instead of the folders. The checksum
+               algorithms are read from the shard files.
+        :param memory_limit: If set, the files are grouped using sorted
+               runs on disk (external sort) and this memory limit, in
+               bytes, instead of the in memory file table. Only the
+               duplicated files are stored in memory. Zero to disable.
+        :param one_filesystem: Boolean value to not include the folders
+               in other filesystems than the input folder (mount points)
+        :param device_jobs: If set, the files are read grouped by device
+               (st_dev), using this number of threads for every device,
+               in physical order (FIEMAP extents, or inodes if not
+               supported). Zero to use the jobs workers pool. The
+               rotational disks use one thread.
+        :param device_limits: List of "DEVICE=N" with the number of
+               threads of some devices (see device_limit), instead of
+               device_jobs
+        :param drop_page_cache: Boolean value to read the files with the
+               sequential access hint and remove them from the page cache
+               after reading them (posix_fadvise)
+        :param tree_threshold: If set, the files of this size or bigger
+               use tree checksums: the files are split in segments of
+               segment_size bytes, read in parallel, and the key is the
+               checksum of the segment checksums (leaves). The files with
+               the same size stop being read when their segments differ.
+               The tree keys never match the checksums of the whole file.
+               Zero to disable.
+        :param segment_size: Size of the segments of the tree checksums
+        :param filters: List of rules to prune the walk, see WalkFilter.
+               The excluded folders are not read and the excluded files
+               are not stat'ed or read. The input files are always
+               included.
+        :param filter_file: File with rules to prune the walk, one rule
+               per line, used with the filters
+        :param archives: Boolean value to include the regular files stored
+               in the zip and tar archives (members), using paths like
+               archive.zip!/inner/path. The members are read from the
+               archives, nothing is extracted, and they are never removed
+               or replaced in write mode.
+        :param find_targets: List of files to find their copies in the
+               folders, using find_copies (used by the application)
+        :param max_matches: Max number of copies found by find_copies.
+               Zero to find all the copies.
+        """
+        self.in_folders = folders
+        self.write_mode = write_mode
+        self.recursive = recursive
+        self.test_mode = test_mode
+        self.machine_mode = machine_mode
+        self.md5 = md5_sum
+        self.sha1 = sha1_sum
+        self.full_list_align = full_list_align
+        self.verbose = verbose
+        self.cache_file = cache_file
+        self.cache_size = cache_size
+        self.cache_max_age = cache_max_age
+        self.cache_prune = cache_prune
+        self.jobs = jobs
+        self.processes = processes
+        self.block_size = block_size
+        self.output_format = output_format
+        self.compare = compare
+        self.progress = progress
+        self.stats_file = stats_file
+        self.profile_file = profile_file
+        self.link_mode = link_mode
+        self.link_all = link_all
+        self.keep = keep or []
+        self.plan_file = plan_file
+        self.plan_input = plan_input
+        self.index_file = index_file
+        self.index_inputs = index_inputs or []
+        self.shard_file = shard_file
+        self.shard_inputs = shard_inputs or []
+        self.memory_limit = memory_limit
+        self.one_filesystem = one_filesystem
+        self.device_jobs = device_jobs
+        self.device_limits = device_limits or []
+        self.drop_page_cache = drop_page_cache
+        self.tree_threshold = tree_threshold
+        self.segment_size = segment_size
+        self.filters = filters or []
+        self.filter_file = filter_file
+        self.archives = archives
+        self.find_targets = find_targets or []
+        self.max_matches = max_matches
+
+        # Set the default values
+        if not self.md5 and not self.sha1:
+            self.md5 = True
+
+        if algorithms:
+            self.algorithms = tuple(x.lower() for x in algorithms)
+            self.md5 = 'md5' in self.algorithms
+            self.sha1 = 'sha1' in self.algorithms
+        else:
+            self.algorithms = tuple(x for x, y in (('md5', self.md5),
+                                                   ('sha1', self.sha1)) if y)
+
+        # The checksums must use the index and shard files algorithms
+        input_algorithms = set()
+        for file_name in self.index_inputs:
+            index = DigestIndex(file_name)
+            input_algorithms.add(index.algorithms)
+            index.close()
+        for file_name in self.shard_inputs:
+            input_algorithms.add(tuple(
+                read_shard_header(file_name)['algorithms']))
+        if len(input_algorithms) > 1:
+            raise ValueError("The index or shard files use different "
+                             "algorithms")
+        if input_algorithms:
+            self.algorithms = input_algorithms.pop()
+            self.md5 = 'md5' in self.algorithms
+            self.sha1 = 'sha1' in self.algorithms
+
+        if self.link_mode and self.link_mode not in LINK_METHODS:
+            raise ValueError("Link method {} not valid".format(
+                self.link_mode))
+
+        self.keep_rules = [keep_rule(x) for x in self.keep]
+        self.device_jobs_by_device = dict(device_limit(x)
+                                          for x in self.device_limits)
+
+        if self.filter_file:
+            self.filters = self.filters + read_filter_file(self.filter_file)
+        self.walk_filter = WalkFilter(self.filters) if self.filters else None
+
+        if self.block_size <= 0:
+            raise ValueError("Block size {} not valid".format(
+                self.block_size))
+        if self.segment_size <= 0:
+            raise ValueError("Segment size {} not valid".format(
+                self.segment_size))
+
+        for algorithm in self.algorithms:
+            if algorithm not in hashlib.algorithms_available \
+                    or algorithm.startswith('shake_'):
+                raise ValueError("Algorithm {} not supported".format(
+                    algorithm))
+
+        # Output labels. MD5 and SHA-1 are always printed, as usual
+        if set(self.algorithms) <= set(ALGORITHM_LABELS):
+            self.key_algorithms = tuple(ALGORITHM_LABELS)
+        else:
+            self.key_algorithms = self.algorithms
+
+        # Show some warnings
+        if not self.write_mode and self.test_mode and not self.plan_input:
+            self.__warning__("Parameter test_mode "
+                             "does not have effect in list mode.")
+
+        if self.write_mode and self.machine_mode:
+            self.__warning__("Parameter machine_mode "
+                             "does not have effect in write mode.")
+            self.machine_mode = False
+
+        if not self.write_mode and self.plan_input:
+            self.__warning__("Parameter plan_input "
+                             "without write mode, using test mode.")
+            self.test_mode = True
+
+        if self.index_inputs and self.link_mode:
+            self.__warning__("Parameter link_mode "
+                             "does not have effect with index files.")
+            self.link_mode = None
+
+        if self.memory_limit and (self.index_inputs or self.shard_inputs):
+            self.__warning__("Parameter memory_limit "
+                             "does not have effect with index or shard files.")
+            self.memory_limit = 0
+
+        if self.memory_limit and self.find_targets:
+            self.__warning__("Parameter memory_limit "
+                             "does not have effect with find_targets.")
+            self.memory_limit = 0
+
+        if self.find_targets and self.output_format != 'text':
+            self.__warning__("Parameter output_format "
+                             "does not have effect with find_targets.")
+            self.output_format = 'text'
+
+        if self.memory_limit and self.compare != 'hash':
+            self.__warning__("Parameter compare "
+                             "does not have effect with memory_limit.")
+            self.compare = 'hash'
+
+        if self.tree_threshold and (self.index_inputs or self.index_file or
+                                    self.shard_inputs or self.shard_file or
+                                    self.memory_limit):
+            self.__warning__("Parameter tree_threshold does not have effect "
+                             "with index or shard files or memory_limit.")
+            self.tree_threshold = 0
+
+        if self.index_inputs and self.compare != 'hash':
+            self.__warning__("Parameter compare "
+                             "does not have effect with index files.")
+            self.compare = 'hash'
+
+        if self.write_mode and self.output_format != 'text':
+            self.__warning__("Parameter output_format "
+                             "does not have effect in write mode.")
+            self.output_format = 'text'
+
+        if self.device_limits and not self.device_jobs:
+            self.__warning__("Parameter device_limits "
+                             "does not have effect without device_jobs.")
+
+        if self.machine_mode and self.full_list_align:
+            self.__warning__("Parameters machine_mode and list align used "
+                             "for output.\n* Using machine mode.")
+            self.full_list_align = False
+
+        # Set global variables
+        self.files = FileTable()
+        self.checksums = {}
+        self.def_action_folder = {}
+        # Bytes not read thanks to each candidate filtering stage
+        self.saved_bytes = {'hardlinks': 0, 'size': 0, 'sample': 0}
+        # Folders and files pruned by the filters, and bytes of the files
+        # pruned by their size
+        self.pruned = {'folders': 0, 'files': 0, 'bytes': 0}
+        # Bytes read comparing the files content and bytes read by the
+        # full checksums
+        self.compare_bytes = [0, 0]
+        # Bytes read by the tree checksums and bytes of the files, and
+        # leaves of the groups using tree checksums
+        self.tree_bytes = [0, 0]
+        self.tree_leaves = {}
+        # Statistics of the run, and function to get the progress instead
+        # of printing it
+        self.run_stats = RunStats()
+        self.progress_callback = None
+        # Event set to stop the run (see AsyncDupCleaner)
+        self.cancel_event = None
+        # Longest file name in self.checksums, to align the output
+        self.max_file_name_len = 0
+        # Files with the same size processed together
+        self.batch_size = max(self.jobs, 1) * 64
+        # Checksums cache, and number of __open_cache__ calls not closed
+        # yet: it is only closed by the last one
+        self.cache = None
+        self.cache_users = 0
+        # Reference indexes, open while the files are checked
+        self.indexes = []
+        # Workers pool for the parallel jobs
+        self.executor = None
+        # Workers pools for every device, and devices without FIEMAP
+        self.device_executors = {}
+        self.no_fiemap = set()
+        self.chunk_size = 1 if not processes else 16
+
+    def __warning__(self, text):
+        """
+        Print a warning about the parameters.
+
+        :param text: Message to print, without the "WARNING: " prefix
+        :return: None
+        """
+        print("WARNING: " + text)
+
+    def __info__(self, text):
+        """
+        Print an informative message. Using the NDJSON output format, the
+        message is printed in stderr, so stdout only includes the groups.
+
+        :param text: Message to print
+        :return: None
+        """
+        print(text, file=sys.stdout if self.output_format == 'text'
+              else sys.stderr)
+
+    def __scan_folder__(self, folder, visited):
+        """
+        Read the entries of a folder using os.scandir. The folder is not
+        read if it is in the visited set, to avoid loops with symbolic
+        links.
+
+        :param folder: Folder to read
+        :param visited: Set of (st_dev, st_ino) of the visited folders
+        :return: List of entries, in reverse order
+        """
+        try:
+            st = os.stat(folder)
+            if (st.st_dev, st.st_ino) in visited:
+                return []
+            visited.add((st.st_dev, st.st_ino))
+            with os.scandir(folder) as it:
+                entries = list(it)
+        except OSError as e:
+            self.__info__("Folder {} not included: {}".format(folder, e))
+            return []
+
+        entries.reverse()
+        return entries
+
+    def __walk__(self, files):
+        """
+        Generator to walk a file or a folder, without recursion. For every
+        regular file (symbolic links are not included), it yields the
+        file name and its stat result, so the file is stat'ed only once.
+
+        :param files: File or folder (ending with os.sep)
+        :return: Iterator of tuples (file name, os.stat_result)
+        """
+        if not files.endswith(os.sep):
+            st = os.stat(files)
+            yield files, st
+            if self.archives and archive_type(files):
+                yield from self.__walk_archive__(
+                    files, st, len(os.path.dirname(files)) + 1)
+            return
+
+        visited = set()
+        root_dev = os.stat(files).st_dev
+        walk_filter = self.walk_filter
+        stack = [self.__scan_folder__(files, visited)]
+        while stack:
+            if not stack[-1]:
+                stack.pop()
+                continue
+
+            entry = stack[-1].pop()
+            if entry.is_file(follow_symlinks=False):
+                if walk_filter is None:
+                    st = entry.stat(follow_symlinks=False)
+                    yield entry.path, st
+                    if self.archives and archive_type(entry.name):
+                        yield from self.__walk_archive__(entry.path, st,
+                                                         len(files))
+                    continue
+                if walk_filter.skip_file(entry.name,
+                                         entry.path[len(files):]):
+                    self.pruned['files'] += 1
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if walk_filter.skip_size(st.st_size):
+                    self.pruned['files'] += 1
+                    self.pruned['bytes'] += st.st_size
+                    continue
+                yield entry.path, st
+                if self.archives and archive_type(entry.name):
+                    yield from self.__walk_archive__(entry.path, st,
+                                                     len(files))
+            elif entry.is_dir():
+                if walk_filter is not None and self.recursive and \
+                        walk_filter.skip_folder(entry.name,
+                                                entry.path[len(files):],
+                                                len(stack)):
+                    self.pruned['folders'] += 1
+                elif self.one_filesystem and \
+                        entry.stat().st_dev != root_dev:
+                    self.__info__("Folder {} not included: other "
+                                  "filesystem".format(entry.path))
+                elif self.recursive:
+                    stack.append(self.__scan_folder__(entry.path + os.sep,
+                                                      visited))
+            else:
+                self.__info__("File {} not included".format(entry.path))
+
+    def __walk_archive__(self, archive, st, root_len):
+        """
+        Generator to read the members of an archive, using only the member
+        headers, so the members are pruned by the filters before reading
+        them. Every member gets an inode number from the archive device,
+        inode and mtime and the member name, with the MEMBER_INO flag, so
+        the cache is not used if the archive changes and the members of
+        hard linked archives are hard links too.
+
+        :param archive: Archive file
+        :param st: os.stat_result of the archive
+        :param root_len: Length of the input folder, to get the relative
+               paths for the filters
+        :return: Iterator of tuples (member path, os.stat_result)
+        """
+        walk_filter = self.walk_filter
+        try:
+            for name, size, mtime_ns in archive_members(archive):
+                path = archive + ARCHIVE_SEPARATOR + name.replace('/', os.sep)
+                if walk_filter is not None and \
+                        (walk_filter.skip_file(os.path.basename(path),
+                                               path[root_len:]) or
+                         walk_filter.skip_size(size)):
+                    self.pruned['files'] += 1
+                    continue
+                ino = member_ino(st, name)
+                yield path, os.stat_result((
+                    stat.S_IFREG | 0o444, ino, st.st_dev, st.st_nlink,
+                    st.st_uid, st.st_gid, size, mtime_ns // 10 ** 9,
+                    mtime_ns // 10 ** 9, mtime_ns // 10 ** 9,
+                    mtime_ns / 1e9, mtime_ns / 1e9, mtime_ns / 1e9,
+                    mtime_ns, mtime_ns, mtime_ns))
+        except (OSError, zipfile.BadZipFile, tarfile.TarError,
+                EOFError) as e:
+            self.__info__("Archive {} not included: {}".format(archive, e))
+
+    def __get_files__(self, files):
+        """
+        This function find the all files in the files and folders included
+        in the "files" argument and store the value in the "self.files"
+        table (FileTable), with its stat values.
+
+        :param files: List of files and folders
+        :return: None
+        """
+        for full_name, st in self.__walk__(files):
+            if self.__cancelled__():
+                raise CancelledError
+            self.files.add(full_name, st)
+            self.run_stats.advance(1)
+
+    def __get_full_path__(self):
+        """
+        This function sets the full path for the input folders.
+
+        For example, for a file:
+          - file.txt -> /home/kix/file.txt
+        For a folder:
+          - . -> /home/kix/
+
+        :return: None
+        """
+        lst_ret = []
         for l_files in self.in_folders:
             if isfile(l_files):
                 lst_ret.append(abspath(l_files))
             elif isdir(l_files):
                 lst_ret.append(abspath(l_files) + os.sep)
             else:
-                print("File {} not found".format(l_files))
+                self.__info__("File {} not found".format(l_files))
+
+        # Do not include the same file twice (repeated or nested folders)
+        self.in_folders = []
+        for l_files in lst_ret:
+            if not any(self.__is_included__(l_files, x) for x in lst_ret
+                       if x != l_files) and l_files not in self.in_folders:
+                self.in_folders.append(l_files)
+
+    def __is_included__(self, l_files, folder):
+        """
+        Check if a file or folder is walked as part of another folder.
+
+        :param l_files: File or folder (ending with os.sep)
+        :param folder: Input folder (ending with os.sep) or file
+        :return: True if l_files is included in folder
+        """
+        if not folder.endswith(os.sep) or not l_files.startswith(folder):
+            return False
+
+        if self.recursive:
+            return True
+
+        # Only the files in the same folder
+        return not l_files.endswith(os.sep) and \
+            os.sep not in l_files[len(folder):]
+
+    def __get_size_candidates__(self):
+        """
+        First filtering stage. Group the files by size and discard the
+        files with a unique size, because they cannot have duplicates.
+
+        The hard links are not included, only the primary file is used.
+
+        :return: Dictionary using the size as key and the array of
+                 candidate files as value.
+        """
+        linked = self.files.linked
+        sizes = {}
+        for idx, l_size in enumerate(self.files.size):
+            if idx not in linked:
+                sizes[l_size] = sizes.get(l_size, 0) + 1
+
+        candidates = {}
+        for idx, l_size in enumerate(self.files.size):
+            if idx in linked:
+                self.saved_bytes['hardlinks'] += l_size
+            elif sizes[l_size] > 1:
+                candidates.setdefault(l_size, array('Q')).append(idx)
+            else:
+                self.saved_bytes['size'] += l_size
+
+        return candidates
+
+    def __get_index_candidates__(self):
+        """
+        First filtering stage using the reference indexes. Discard the
+        files with a size not found in the indexes, because they cannot
+        be stored in the indexed trees.
+
+        The hard links are not included, only the primary file is used.
+
+        :return: Dictionary using the size as key and the array of
+                 candidate files as value.
+        """
+        linked = self.files.linked
+        sizes = {}
+        candidates = {}
+        for idx, l_size in enumerate(self.files.size):
+            if idx in linked:
+                self.saved_bytes['hardlinks'] += l_size
+                continue
+
+            found = sizes.get(l_size)
+            if found is None:
+                found = sizes[l_size] = any(x.has_size(l_size)
+                                            for x in self.indexes)
+            if found:
+                candidates.setdefault(l_size, array('Q')).append(idx)
+            else:
+                self.saved_bytes['size'] += l_size
+
+        return candidates
+
+    def __get_sample_candidates__(self, candidates):
+        """
+        Second filtering stage. For every group of files with the same size,
+        calculate a checksum using only the head and the tail of the files
+        and discard the files with a unique sample checksum.
+
+        Small files are not sampled, the sample would read the full file.
+
+        :param candidates: Dictionary of files grouped by size
+        :return: Sorted list with the files that need the full checksum
+        """
+        lst_ret = set()
+        lst_sample = []
+        for l_size, lst_files in candidates.items():
+            if l_size <= 2 * SAMPLE_SIZE:
+                lst_ret.update(lst_files)
+            else:
+                lst_sample.extend(lst_files)
+
+        lst_checksums = self.__get_checksums__(
+            'sample', ('sample', ), partial(
+                sample_digests, drop_cache=self.drop_page_cache), lst_sample,
+            [self.files.size[x] for x in lst_sample])
+
+        samples = {}
+        read_bytes = {}
+        for l_file, (l_sample, read_bytes[l_file]) in zip(lst_sample,
+                                                           lst_checksums):
+            l_key = (self.files.size[l_file], l_sample)
+            samples.setdefault(l_key, []).append(l_file)
+
+        for (l_size, _), lst_files in samples.items():
+            if len(lst_files) > 1:
+                lst_ret.update(lst_files)
+            else:
+                self.saved_bytes['sample'] += l_size - read_bytes[lst_files[0]]
+                self.run_stats.advance(1, l_size)
+
+        return sorted(lst_ret)
+
+    def __map__(self, function, *iterables):
+        """
+        Apply the function to every item in the iterables, using the
+        workers pool if enabled. The results keep the iterables order.
+
+        :param function: Function to apply
+        :param iterables: Iterables with the function arguments
+        :return: Iterator of results
+        """
+        if self.executor is None:
+            return map(function, *iterables)
+
+        return self.executor.map(function, *iterables,
+                                 chunksize=self.chunk_size)
+
+    def __get_checksums__(self, phase, algorithms, function, lst_files,
+                          *args):
+        """
+        Get the checksums for a list of files from the cache. The checksums
+        not found (or all, if the cache is disabled) are calculated using
+        the workers pool and stored in the cache.
+
+        :param phase: Phase name, for the statistics
+        :param algorithms: List of checksum algorithm names, used in the
+               cache
+        :param function: Function to calculate the checksums. It returns
+               a tuple (list of checksums, bytes read).
+        :param lst_files: List of files (indexes) to get the checksums
+        :param args: Extra lists of arguments for the function
+        :return: List of tuples (list of checksums, bytes read), in
+                 the lst_files order
+        """
+        return self.__calc_checksums__(
+            phase, algorithms, function, len(lst_files),
+            lambda x: self.files.path(lst_files[x]),
+            lambda x: self.files.cache_key(lst_files[x]), *args)
+
+    def __physical_order__(self, dev, ino, path):
+        """
+        Get the sort key of a file to read the files of a device in
+        physical order: the offset of the first extent (FIEMAP) or, if
+        the filesystem does not support it, the inode number.
+
+        :param dev: Device of the file
+        :param ino: Inode of the file
+        :param path: File name
+        :return: Tuple, sort key
+        """
+        if dev not in self.no_fiemap and ino < MEMBER_INO:
+            try:
+                return physical_offset(path), ino
+            except OSError:
+                self.no_fiemap.add(dev)
+
+        return 0, ino
+
+    def __get_device_jobs__(self, dev):
+        """
+        Return the number of threads reading a device: its device limit
+        (by st_dev, partition or disk name), one for a rotational disk or
+        self.device_jobs.
+
+        :param dev: Device number (st_dev)
+        :return: Number of threads
+        """
+        names, rotational = block_device(dev)
+        for name in (dev, ) + names:
+            if name in self.device_jobs_by_device:
+                jobs = self.device_jobs_by_device[name]
+                break
+        else:
+            jobs = 1 if rotational else self.device_jobs
+
+        if self.verbose:
+            self.__info__("Device {}: {} jobs".format(
+                names[0] if names else dev, jobs))
+        return jobs
+
+    def __map_devices__(self, function, lst_inodes, lst_paths, *iterables):
+        """
+        Apply the function to every file, like __map__, scheduling the
+        reads by device: every device has its own threads pool
+        (see __get_device_jobs__) and its files are submitted in
+        physical order, so the devices are read in parallel and the
+        rotational disks do not seek between files.
+
+        :param function: Function to apply, the first argument is the
+               file name
+        :param lst_inodes: List of (st_dev, st_ino) of the files
+        :param lst_paths: List of file names
+        :param iterables: Extra lists of arguments for the function
+        :return: Iterator of results, in the lst_paths order
+        """
+        devices = {}
+        for n, (dev, ino) in enumerate(lst_inodes):
+            devices.setdefault(dev, []).append(
+                (self.__physical_order__(dev, ino, lst_paths[n]), n))
+
+        futures = [None] * len(lst_paths)
+        for dev, lst_files in devices.items():
+            executor = self.device_executors.get(dev)
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=self.__get_device_jobs__(dev))
+                self.device_executors[dev] = executor
+            for _, n in sorted(lst_files):
+                futures[n] = executor.submit(function, lst_paths[n],
+                                             *[x[n] for x in iterables])
+
+        return (x.result() for x in futures)
+
+    def __calc_checksums__(self, phase, algorithms, function, count,
+                           get_path, get_cache_key, *args, errors=None):
+        """
+        Get the checksums for a list of files, see __get_checksums__. The
+        files are not read from self.files, the functions get_path and
+        get_cache_key return the path and the cache key of every file.
+
+        :param phase: Phase name, for the statistics
+        :param algorithms: List of checksum algorithm names
+        :param function: Function to calculate the checksums
+        :param count: Number of files
+        :param get_path: Function to get the path of the n-th file
+        :param get_cache_key: Function to get the cache key of the n-th
+               file
+        :param args: Extra lists of arguments for the function
+        :param errors: Dictionary to store the error of every file not
+               read (index -> OSError) instead of raising it, or None
+        :return: List of tuples (list of checksums, bytes read), None for
+                 the files with errors
+        """
+        archive_function = partial(archive_digests, function)
+        if errors is not None:
+            function = partial(try_digests, function)
+            archive_function = partial(try_digests, archive_function)
+        lst_ret = [None] * count
+        lst_idx = []
+        # Archive -> list of files, the members of every archive are read
+        # by one job
+        archives = {}
+        for idx in range(count):
+            digests = None
+            if self.cache is not None:
+                digests = tuple(self.cache.get(get_cache_key(idx), x)
+                                for x in algorithms)
+            if digests is not None and None not in digests:
+                lst_ret[idx] = digests, 0
+                self.run_stats.add(phase, files=1)
+            elif get_cache_key(idx)[1] >= MEMBER_INO:
+                archives.setdefault(split_member(get_path(idx))[0],
+                                    []).append(idx)
+            else:
+                lst_idx.append(idx)
+
+        lst_paths = [get_path(idx) for idx in lst_idx]
+        lst_args = [[x[idx] for idx in lst_idx] for x in args]
+        if self.device_jobs:
+            results = self.__map_devices__(
+                function, [get_cache_key(idx)[:2] for idx in lst_idx],
+                lst_paths, *lst_args)
+        else:
+            results = self.__map__(function, lst_paths, *lst_args)
+        results = zip(lst_idx, results)
+        if archives:
+            lst_archives = list(archives.values())
+            archive_results = self.__map__(
+                archive_function, list(archives),
+                [[split_member(get_path(x))[1] for x in y]
+                 for y in lst_archives],
+                *[[[x[idx] for idx in y] for y in lst_archives]
+                  for x in args])
+            # An error reading the archive is the error of every member
+            archive_results = ([x] * len(y) if isinstance(x, OSError)
+                               else x for x, y in zip(archive_results,
+                                                      lst_archives))
+            results = chain(results, (x for y in zip(
+                lst_archives, archive_results) for x in zip(*y)))
+
+        for idx, ret in results:
+            if self.__cancelled__():
+                raise CancelledError
+            if isinstance(ret, OSError):
+                errors[idx] = ret
+                continue
+            lst_ret[idx] = ret
+            self.run_stats.add(phase, 1, ret[1])
+            if phase == 'checksums':
+                self.run_stats.advance(1, ret[1])
+            if self.cache is not None:
+                for algorithm, digest in zip(algorithms, ret[0]):
+                    self.cache.put(get_cache_key(idx), algorithm, digest,
+                                   get_path(idx))
+
+        return lst_ret
+
+    def __open_executor__(self):
+        """
+        Create the workers pool used to calculate the checksums, if more
+        than one job is requested. Threads are used by default, because
+        hashlib releases the GIL, or processes if selected.
+
+        :return: None
+        """
+        if self.jobs < 2:
+            return
+
+        if self.processes:
+            self.executor = ProcessPoolExecutor(max_workers=self.jobs)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def __close_executor__(self):
+        """
+        Wait for the workers and remove the workers pools. If the run is
+        cancelled, the pending files are not read.
+
+        :return: None
+        """
+        cancelled = self.__cancelled__()
+        for executor in self.device_executors.values():
+            executor.shutdown(cancel_futures=cancelled)
+        self.device_executors = {}
+        self.no_fiemap = set()
+
+        if self.executor is None:
+            return
+
+        self.executor.shutdown(cancel_futures=cancelled)
+        self.executor = None
+
+    def __cancelled__(self):
+        """
+        Check if the run is cancelled, see self.cancel_event.
+
+        :return: True if the run is cancelled
+        """
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def __open_indexes__(self):
+        """
+        Open the reference index files, if any.
+
+        :return: None
+        """
+        self.indexes = [DigestIndex(x) for x in self.index_inputs]
+
+    def __close_indexes__(self):
+        """
+        Close the reference index files.
+
+        :return: None
+        """
+        for index in self.indexes:
+            index.close()
+        self.indexes = []
+
+    def __open_cache__(self):
+        """
+        Open the persistent checksums cache, if enabled. If the cache is
+        already open, it is used, without pruning it again.
+
+        :return: None
+        """
+        if not self.cache_file:
+            return
+
+        self.cache_users += 1
+        if self.cache is not None:
+            return
+        self.cache = DigestCache(self.cache_file, self.cache_size,
+                                 self.cache_max_age)
+        if self.cache_prune:
+            removed = self.cache.prune()
+            if self.verbose:
+                self.__info__("Removed {} checksums from the cache".format(
+                    removed))
+
+    def __close_cache__(self):
+        """
+        Save and close the persistent checksums cache, if enabled. If it
+        was opened more times, it is only saved.
+
+        :return: None
+        """
+        if self.cache is None:
+            return
+
+        self.cache_users -= 1
+        if self.cache_users:
+            self.cache.save()
+            return
+        self.run_stats.counters['cache'] = {'hits': self.cache.hits,
+                                            'misses': self.cache.misses}
+        if self.verbose:
+            self.__info__("Checksums cache. Hits: {} Misses: {}".format(
+                self.cache.hits, self.cache.misses))
+        self.cache.close()
+        self.cache = None
+
+    def __get_files_checksums__(self, candidates):
+        """
+        This function calculates the checksums for a batch of files grouped
+        by size, using the selected algorithms (MD5 by default).
+        It stores the duplicated files in the dictionary self.checksums
+        using the tuple of checksums (bytes) as key and a DupGroup
+        with the files (indexes in self.files) as value.
+
+        Every file is read only once, for all the algorithms.
+
+        Only the files that pass the sample stage are fully read, the
+        others cannot have duplicates. Using reference indexes, there is
+        no sample stage, the indexes only store the full checksums.
+
+        :param candidates: Dictionary of files grouped by size
+        :return: List of the new DupGroups with duplicated files
+        """
+        # Keep the self.files order, so the groups order does not change
+        if self.indexes:
+            lst_files = sorted(x for y in candidates.values() for x in y)
+        else:
+            with self.run_stats.phase('sample'):
+                lst_files = self.__get_sample_candidates__(candidates)
+
+        groups = {}
+        if self.compare == 'bytes':
+            with self.run_stats.phase('compare'):
+                lst_files = self.__get_compare_groups__(lst_files, groups)
+
+        if self.tree_threshold:
+            with self.run_stats.phase('tree'):
+                lst_files = self.__get_tree_groups__(lst_files, groups)
+
+        function = partial(file_digests, algorithms=self.algorithms,
+                           block_size=self.block_size,
+                           drop_cache=self.drop_page_cache)
+        with self.run_stats.phase('checksums'):
+            lst_checksums = self.__get_checksums__(
+                'checksums', self.algorithms, function, lst_files)
+
+        with self.run_stats.phase('group'):
+            return self.__add_groups__(groups, lst_files, lst_checksums)
+
+    def __add_groups__(self, groups, lst_files, lst_checksums):
+        """
+        Group the files by their checksums and get the groups with
+        duplicated files. Using reference indexes, the groups with files
+        stored in the indexed trees are included, even with only one file.
+
+        :param groups: Dictionary of DupGroups already found
+        :param lst_files: List of files (indexes)
+        :param lst_checksums: List of checksums, in the lst_files order
+        :return: List of the new DupGroups with duplicated files
+        """
+        for k, (l_new_key, _) in zip(lst_files, lst_checksums):
+            if groups.get(l_new_key) is None:
+                groups[l_new_key] = DupGroup(l_new_key, array('Q', [k]))
+            else:
+                groups[l_new_key].files.append(k)
+
+            if self.verbose:
+                self.__info__("Processing file. {} Name: {}".format(
+                    self.__format_key__(l_new_key), self.files.path(k)))
+
+        # Remove files without duplicates
+        lst_ret = []
+        for k, v in sorted(groups.items(), key=lambda x: x[1].files[0]):
+            if self.indexes:
+                l_size = self.files.size[v.files[0]]
+                if not any((l_size, k) in x for x in self.indexes):
+                    continue
+            elif len(v.files) < 2:
+                continue
+
+            lst_ret.append(v)
+            self.max_file_name_len = max(
+                self.max_file_name_len,
+                self.__get_max_file_name_len__(v.files))
+
+        return lst_ret
+
+    def __get_compare_groups__(self, lst_files, groups):
+        """
+        Compare the content of the files with the same size, instead of
+        using the checksums. The groups with too many files to keep them
+        open and the archive members are not compared, they use the
+        checksums.
+
+        :param lst_files: List of files (indexes)
+        :param groups: Dictionary to store the new DupGroups
+        :return: List of files (indexes) not compared
+        """
+        sizes = {}
+        lst_ret = []
+        for l_file in lst_files:
+            if self.files.is_member(l_file):
+                lst_ret.append(l_file)
+            else:
+                sizes.setdefault(self.files.size[l_file], []).append(l_file)
+
+        for l_size, lst_size in sizes.items():
+            if len(lst_size) > MAX_OPEN_FILES:
+                lst_ret.extend(lst_size)
+                continue
+
+            for key, lst_group in self.__compare_files__(lst_size, l_size):
+                groups[key] = DupGroup(key, array('Q', lst_group))
+                if self.verbose:
+                    for l_file in lst_group:
+                        self.__info__("Processing file. {} Name: {}".format(
+                            self.__format_key__(key),
+                            self.files.path(l_file)))
+
+        return sorted(lst_ret)
+
+    def __get_tree_groups__(self, lst_files, groups):
+        """
+        Group the files bigger than self.tree_threshold using the tree
+        checksums. The keys are the tree checksums plus the tree marker
+        with the segment size, so they are never mixed with the checksums
+        of the whole files.
+
+        :param lst_files: List of files (indexes)
+        :param groups: Dictionary to store the new DupGroups
+        :return: List of files (indexes) smaller than the threshold
+        """
+        sizes = {}
+        lst_ret = []
+        for l_file in lst_files:
+            l_size = self.files.size[l_file]
+            if l_size < self.tree_threshold:
+                lst_ret.append(l_file)
+            else:
+                sizes.setdefault(l_size, []).append(l_file)
+
+        marker = TREE_MARKER + str(self.segment_size).encode()
+        for l_size, lst_size in sizes.items():
+            for root, lst_group, leaves in self.__tree_files__(lst_size,
+                                                               l_size):
+                key = root + (marker, )
+                groups[key] = DupGroup(key, array('Q', lst_group))
+                if leaves is not None and len(lst_group) > 1:
+                    self.tree_leaves[key] = leaves
+                if self.verbose:
+                    for l_file in lst_group:
+                        self.__info__("Processing file. {} Name: {}".format(
+                            self.__format_key__(key),
+                            self.files.path(l_file)))
+
+        return lst_ret
+
+    def __tree_files__(self, lst_files, l_size):
+        """
+        Get the tree checksums of a group of files with the same size. The
+        segments of all the files are read in parallel, self.jobs segments
+        of every file at a time, and the group is split when the leaves
+        differ. A file without any other equal file is not read anymore.
+
+        If some tree checksums are in the cache, the other files are read
+        completely, because the leaves of the cached files are unknown.
+
+        :param lst_files: List of files (indexes) with the same size
+        :param l_size: Size of the files
+        :return: List of tuples (tree checksums, list of files, leaves or
+                 None if the checksums are from the cache)
+        """
+        algorithms = ['tree:{}:{}'.format(x, self.segment_size)
+                      for x in self.algorithms]
+        roots = {}
+        lst_todo = []
+        for l_file in lst_files:
+            digests = None
+            if self.cache is not None:
+                digests = tuple(self.cache.get(self.files.cache_key(l_file),
+                                               x) for x in algorithms)
+            if digests is not None and None not in digests:
+                roots.setdefault(digests, [[], None])[0].append(l_file)
+                self.run_stats.add('tree', files=1)
+                self.run_stats.advance(1, l_size)
+            else:
+                lst_todo.append(l_file)
+
+        function = partial(segment_digests, algorithms=self.algorithms,
+                           block_size=self.block_size,
+                           drop_cache=self.drop_page_cache)
+        offsets = range(0, l_size, self.segment_size)
+        step = max(self.jobs, 1)
+        early = not roots
+        leaves = {x: [] for x in lst_todo}
+        read = dict.fromkeys(lst_todo, 0)
+        done = []
+        work = [lst_todo] if lst_todo else []
+        for start in range(0, len(offsets), step):
+            lst_tasks = [(x, y) for lst_group in work for x in lst_group
+                         for y in offsets[start:start + step]]
+            results = self.__map__(
+                function, [self.files.path(x) for x, _ in lst_tasks],
+                [y for _, y in lst_tasks],
+                [min(self.segment_size, l_size - y) for _, y in lst_tasks])
+            for (l_file, _), (digests, read_bytes) in zip(lst_tasks,
+                                                          results):
+                leaves[l_file].append(digests)
+                read[l_file] += read_bytes
+                self.run_stats.add('tree', read_bytes=read_bytes)
+                self.run_stats.advance(0, read_bytes)
+
+            # Split the groups by the new leaves
+            new_work = []
+            for lst_group in work:
+                if not early:
+                    new_work.append(lst_group)
+                    continue
+                parts = {}
+                for l_file in lst_group:
+                    parts.setdefault(tuple(leaves[l_file][start:]),
+                                     []).append(l_file)
+                for lst_part in parts.values():
+                    if len(lst_part) > 1:
+                        new_work.append(lst_part)
+                    else:
+                        done.append(lst_part[0])
+            work = new_work
+            if not work:
+                break
+
+        for lst_group in work:
+            for l_file in lst_group:
+                digests = tree_digests(self.algorithms, leaves[l_file])
+                roots.setdefault(digests, [[], leaves[l_file]])[0].append(
+                    l_file)
+                if self.cache is not None:
+                    for algorithm, digest in zip(algorithms, digests):
+                        self.cache.put(self.files.cache_key(l_file),
+                                       algorithm, digest,
+                                       self.files.path(l_file))
+            done.extend(lst_group)
+
+        for l_file in done:
+            self.tree_bytes[0] += read[l_file]
+            self.run_stats.add('tree', files=1)
+            self.run_stats.advance(1, l_size - read[l_file])
+        self.tree_bytes[1] += l_size * len(lst_todo)
+
+        return [(x, sorted(y), z) for x, (y, z) in roots.items()]
+
+    def get_tree_leaves(self, key):
+        """
+        This function returns the leaves of a group using tree checksums,
+        the checksums of every segment of the files.
+
+        :param key: Key of the group in self.checksums
+        :return: List of tuples of checksums (bytes), one for every
+                 segment, in the self.algorithms order. None if the key is
+                 not a tree key or the checksums were read from the cache.
+        """
+        return self.tree_leaves.get(key)
+
+    def __get_tree_segment__(self, key):
+        """
+        Return the segment size of a tree key.
+
+        :param key: Tuple of checksums (bytes), in the algorithms order
+        :return: Segment size, or None if the key is not a tree key
+        """
+        if len(key) > len(self.algorithms):
+            return int(key[-1][len(TREE_MARKER):])
+
+        return None
+
+    def __read_chunks__(self, lst_fds, size):
+        """
+        Read the next chunk from multiple files, using the threads pool
+        if enabled.
+
+        :param lst_fds: List of open files
+        :param size: Size of the chunk
+        :return: List of chunks (bytes)
+        """
+        if isinstance(self.executor, ThreadPoolExecutor) and len(lst_fds) > 2:
+            return list(self.executor.map(partial(read_chunk, size=size),
+                                          lst_fds))
+
+        return [read_chunk(f, size) for f in lst_fds]
+
+    def __compare_files__(self, lst_files, l_size):
+        """
+        Compare the content of a group of files with the same size. All
+        files are read chunk by chunk at the same time, and the group is
+        split when the chunks differ. A file without any other equal file
+        is not read anymore.
+
+        The checksums of the first file of every group are calculated
+        while reading, so the groups use the same keys as the checksums
+        mode, without reading the files again.
+
+        :param lst_files: List of files (indexes) with the same size
+        :param l_size: Size of the files
+        :return: List of tuples (key, list of files) with the duplicated
+                 files
+        """
+        fds = []
+        try:
+            for l_file in lst_files:
+                fds.append(open(self.files.path(l_file), 'rb', buffering=0))
+        except OSError:
+            for f in fds:
+                f.close()
+            raise
+
+        # Every work group: list of files, list of fds, checksums
+        work = [(list(lst_files), fds,
+                 [hashlib.new(x) for x in self.algorithms])]
+        offset = 0
+        read_bytes = 0
+        while offset < l_size and work:
+            size = min(self.block_size, l_size - offset)
+            new_work = []
+            for lst_group, lst_fds, hashes in work:
+                chunks = self.__read_chunks__(lst_fds, size)
+                read_bytes += sum(len(x) for x in chunks)
+                if all(x == chunks[0] for x in chunks[1:]):
+                    for file_hash in hashes:
+                        file_hash.update(chunks[0])
+                    new_work.append((lst_group, lst_fds, hashes))
+                    continue
+
+                # Split the group by the chunk content
+                parts = {}
+                for idx, chunk in enumerate(chunks):
+                    parts.setdefault(chunk, []).append(idx)
+                for chunk, lst_idx in parts.items():
+                    if len(lst_idx) < 2:
+                        lst_fds[lst_idx[0]].close()
+                        continue
+                    new_hashes = [x.copy() for x in hashes]
+                    for file_hash in new_hashes:
+                        file_hash.update(chunk)
+                    new_work.append(([lst_group[x] for x in lst_idx],
+                                     [lst_fds[x] for x in lst_idx],
+                                     new_hashes))
+
+            work = new_work
+            offset += size
+
+        self.compare_bytes[0] += read_bytes
+
+        lst_ret = []
+        for lst_group, lst_fds, hashes in work:
+            for f in lst_fds:
+                f.close()
+            lst_ret.append((tuple(x.digest() for x in hashes), lst_group))
+
+        self.compare_bytes[1] += l_size * len(lst_files)
+        self.run_stats.add('compare', len(lst_files), read_bytes)
+        self.run_stats.advance(len(lst_files), l_size * len(lst_files))
+        return lst_ret
+
+    def __print_saved_bytes__(self):
+        """
+        Print the bytes not read thanks to the candidate filtering stages.
+
+        :return: None
+        """
+        self.__info__("Bytes not read. Hard links: {} Size stage: {} "
+                      "Sample stage: {} Total: {}".format(
+                        self.saved_bytes['hardlinks'],
+                        self.saved_bytes['size'], self.saved_bytes['sample'],
+                        sum(self.saved_bytes.values())))
+        self.__info__("Reclaimable bytes: {}".format(
+            self.get_reclaimable_bytes()))
+        if self.walk_filter is not None:
+            self.__info__("Pruned by the filters. Folders: {} Files: {} "
+                          "Bytes (size rules): {}".format(
+                            self.pruned['folders'], self.pruned['files'],
+                            self.pruned['bytes']))
+        if self.compare == 'bytes':
+            self.__info__("Compare stage. Bytes read: {} of {} (full "
+                          "checksums)".format(*self.compare_bytes))
+        if self.tree_threshold:
+            self.__info__("Tree stage. Bytes read: {} of {} (full "
+                          "checksums)".format(*self.tree_bytes))
+
+    def __get_key_fields__(self, key):
+        """
+        Return the checksums in the key as hexadecimal strings, one for
+        every output label. The labels not used are empty strings.
+
+        :param key: Tuple of checksums (bytes), in the algorithms order
+        :return: List of checksums in hexadecimal
+        """
+        digests = dict(zip(self.algorithms, key))
+        return [digests[x].hex() if x in digests else ''
+                for x in self.key_algorithms]
+
+    def __get_key_dict__(self, key):
+        """
+        Return the key as a dictionary for the JSON output, with the
+        checksums in hexadecimal by algorithm. The tree keys include the
+        segment size as "tree".
+
+        :param key: Tuple of checksums (bytes), in the algorithms order
+        :return: Dictionary, like {"md5": "..."}
+        """
+        ret = dict(zip(self.algorithms, [x.hex() for x in key]))
+        segment = self.__get_tree_segment__(key)
+        if segment is not None:
+            ret['tree'] = segment
+
+        return ret
+
+    def __format_key__(self, key):
+        """
+        Return the key as text, using the labels of the algorithms.
+
+        :param key: Tuple of checksums (bytes), in the algorithms order
+        :return: Text with the checksums, like "MD5:... SHA-1:..."
+        """
+        text = ' '.join('{}:{}'.format(ALGORITHM_LABELS.get(x, x.upper()), y)
+                        for x, y in zip(self.key_algorithms,
+                                        self.__get_key_fields__(key)))
+        segment = self.__get_tree_segment__(key)
+        if segment is not None:
+            text += ' TREE:{}'.format(segment)
+
+        return text
+
+    def __print_output_header__(self, key):
+        """
+        Print the output header for a set of files with the same
+        checksums.
+
+        :param key: Checksums for the set of files. Not used in
+               machine mode.
+        :return: None
+        """
+        if self.machine_mode:
+            # Using tree checksums, the TREE column has the segment size of
+            # the tree keys
+            print('|'.join([ALGORITHM_LABELS.get(x, x.upper())
+                            for x in self.key_algorithms] +
+                           (["TREE"] if self.tree_threshold else []) +
+                           ["File", "Creation", "Last Modification", "Size"]))
+        else:
+            print("Files with key [{}]:".format(self.__format_key__(key)))
+
+    def __get_max_file_name_len__(self, lst_files):
+        """
+        Return the longest filename in the lst_files list.
+
+        :param lst_files: List of files (indexes).
+        :return: Numeric value of the longest file name
+        """
+        if self.machine_mode:
+            return 0
+
+        txt_len = 0
+        for l_file in lst_files:
+            f_len = len(self.files.path(l_file))
+            if f_len > txt_len:
+                txt_len = f_len
+
+        return txt_len
+
+    def __get_max_file_name_len_full__(self):
+        """
+        Return the longest filename for all files in the values
+        of the self.checksums dictionary. The value is updated when the
+        groups are found, so the groups are not read again.
+
+        :return: Numeric value of the longest file name
+        """
+        if self.machine_mode:
+            return 0
+
+        return self.max_file_name_len
+
+    def __print_list_files__(self, key, lst_files, max_file_name_len):
+        """
+        This function prints the list of files included in the list "lst_files"
+        with the same checksums.
+
+        The output will align the extra data (Date of creation, last
+        modification date and the size) using the max_file_name_len
+        argument for a global (all files) alignment or only for this
+        set (list) if max_file_name_len is zero.
+
+        :param key: Checksums for the list of files
+        :param lst_files: List of files (indexes) to print
+        :param max_file_name_len: Max file name length or zero
+        :return: None
+        """
+        if not max_file_name_len and not self.machine_mode:
+            max_file_name_len = self.__get_max_file_name_len__(lst_files)
+
+        for idx, l_idx in enumerate(lst_files):
+            l_file = self.files.path(l_idx)
+            l_size = self.files.size[l_idx]
+            l_last_mod = time.ctime(self.files.mtime_ns[l_idx] / 1e9)
+            l_creation = time.ctime(self.files.ctime_ns[l_idx] / 1e9)
+            if not self.machine_mode:
+                l_links = " Hard links: {}".format(
+                    len(self.files.links[l_idx])) \
+                    if l_idx in self.files.links else ""
+                print("[{}] ".format(idx + 1) +
+                      ("{:" + str(max_file_name_len + 2) + "} ").format(l_file)
+                      + "Created: {} Last Modification: {} Size: {}".format(
+                    l_last_mod, l_creation, l_size) + l_links)
+            else:
+                fields = self.__get_key_fields__(key)
+                if self.tree_threshold:
+                    segment = self.__get_tree_segment__(key)
+                    fields.append('' if segment is None else str(segment))
+                print('|'.join(fields + [l_file, l_creation, l_last_mod,
+                                         str(l_size)]))
+
+    @staticmethod
+    def __print_help__(link=False):
+        """
+        Prints the help for the actions menu
+
+        :param link: Boolean value to include the link options
+        :return: None
+        """
+        print("  <number>: Delete file with index number")
+        print("  f<number: Delete file with index and select it's "
+              "directory to remove by default")
+        if link:
+            print("  l<number: Keep file with index and replace the other "
+                  "files with links to it")
+        print("         n: Do not remove any file")
+        print("         A: Remove All files (WARNING, "
+              "you will lost all copies!!)")
+        print("         q: Quit!")
+
+    @staticmethod
+    def __print_action_menu__(lst_files, link=False):
+        """
+        Print the action menu for the list of files "lst_files".
+
+        The user will select the desired option:
+         - A number: Number of the file in the list
+         - f + number: Number of the file in the list and select the
+           directory as default directory for deletion.
+         - l + number: Number of the file to keep, the other files are
+           replaced with links to it (only if link is enabled).
+         - "A": All files
+         - "q": Quit
+         - "?": Help
+
+        :param lst_files: List of files to apply the actions
+        :param link: Boolean value to include the link options
+        :return: The selected option.
+        """
+        lst_options = []
+        lst_folder_options = []
+        lst_link_options = []
+        for idx, _ in enumerate(lst_files):
+            lst_options.append(idx + 1)
+            lst_folder_options.append('f{}'.format(idx + 1))
+            lst_link_options.append('l{}'.format(idx + 1))
+
+        lst_options.extend(lst_folder_options)
+        if link:
+            lst_options.extend(lst_link_options)
+
+        opc = input('{}, n, A, q, ?. Option: '.format(lst_options))
+        return opc
+
+    def __delete_file__(self, l_file):
+        """
+        This function is used to remove a file. If test-mode
+        is set, the file is not deleted.
+
+        :param l_file: File to be deleted.
+        :return: True if the file is removed. False if it fails.
+        """
+        reason = read_only(l_file)
+        if reason:
+            print('File {} not removed: {}'.format(l_file, reason))
+            return False
+
+        if self.test_mode:
+            print('File {} removed'.format(l_file))
+            return True
+
+        try:
+            os.remove(l_file)
+            print('File {} removed'.format(l_file))
+            return True
+        except OSError as e:
+            print("Error removing file: {}".format(e))
+            return False
+
+    def __link_file__(self, l_source, l_file):
+        """
+        This function is used to replace a file with a link to other
+        file with the same content. If test-mode is set, the file is not
+        replaced.
+
+        :param l_source: File to keep.
+        :param l_file: File to be replaced.
+        :return: Link type ("reflink" or "hardlink") if the file is
+                 replaced. None if it fails.
+        """
+        reason = read_only(l_source) or read_only(l_file)
+        if reason:
+            print('File {} not linked to {}: {}'.format(l_file, l_source,
+                                                        reason))
+            return None
+
+        if self.test_mode:
+            print('File {} linked to {}'.format(l_file, l_source))
+            return self.link_mode
+
+        try:
+            link_type = link_file(l_source, l_file, self.link_mode)
+            print('File {} linked to {} ({})'.format(l_file, l_source,
+                                                     link_type))
+            return link_type
+        except OSError as e:
+            print("Error linking file: {}".format(e))
+            return None
+
+    def __link_files__(self, l_source, lst_files):
+        """
+        This function replaces the files in the list with links to the
+        kept file. The hard links of a file are replaced too, so the
+        physical file is removed.
+
+        :param l_source: File (index) to keep.
+        :param lst_files: List of files (indexes) to be replaced.
+        :return: Tuple, files not replaced (or with a hard link not
+                 replaced) and dictionary with the number of paths
+                 replaced for every link type
+        """
+        ret_list = []
+        link_types = {}
+        for l_file in lst_files:
+            replaced = True
+            for l_idx in [l_file] + list(self.files.links.get(l_file, [])):
+                link_type = self.__link_file__(self.files.path(l_source),
+                                               self.files.path(l_idx))
+                if link_type:
+                    link_types[link_type] = link_types.get(link_type, 0) + 1
+                else:
+                    replaced = False
+            if not replaced:
+                ret_list.append(l_file)
+
+        return ret_list, link_types
+
+    def __take_auto_action__(self, lst_files):
+        """
+        This function apply auto deletion for the list of files.
+        This function checks if the files are in the default action
+        folders to delete their files.
+
+        If all folders for all files are in the default action list,
+        the function also checks that at least one file is not deleted.
+        Using reference indexes, the kept copies are in the indexed trees,
+        so all the files can be deleted.
+
+        :param lst_files: List of files (indexes) to delete.
+        :return: Remaining files
+        """
+        ret_list = []
+        changed = False
+
+        # Avoid remove all files, at least hold one.
+        max_deletion = len(lst_files) - (0 if self.index_inputs else 1)
+        deleted_files = 0
+
+        for l_file in lst_files:
+            l_path = self.files.dirname(l_file)
+            if self.def_action_folder.get(l_path) \
+                    and deleted_files < max_deletion:
+                print("Removing file automatically: {}".format(
+                    self.files.path(l_file)))
+                removed = self.__delete_file__(self.files.path(l_file))
+                if removed:
+                    deleted_files += 1
+                    changed = True
+            else:
+                ret_list.append(l_file)
+
+        return ret_list, changed
+
+    def __take_action__(self, key, lst_files, max_length):
+        """
+        This function takes actions (deletion) about the "lst_files" list.
+        Using reference indexes, the list only includes the files of the
+        new folders, so the menu is shown until all of them are removed.
+
+        :param key: Checksums for the "lst_files" list
+        :param lst_files: List of files (indexes) to apply actions.
+        :param max_length: Output max file name length
+        :return: Tuple, three elements:
+                 * Remaining files list,
+                 * More action needed boolean flag,
+                 * Quit selected flag.
+        """
+        # Apply automatic deletion
+        lst_files, changed = self.__take_auto_action__(lst_files)
+
+        # For the remaining files, get the options for the menu
+        file_valid_options = [str(x + 1) for x, _ in enumerate(lst_files)]
+        folder_valid_options = ['f' + str(x+1) for x, _ in enumerate(lst_files)]
+        link_valid_options = ['l' + str(x+1) for x, _ in enumerate(lst_files)
+                              if self.link_mode]
+        if changed:
+            self.__print_list_files__(key, lst_files, max_length)
+
+        # Files kept in the group, none using reference indexes
+        min_files = 0 if self.index_inputs else 1
+        while 1:
+            # Only the kept files remaining, exit
+            if len(lst_files) <= min_files:
+                return lst_files, False, False
+
+            # Print the action menu and get the selected option
+            opc = self.__print_action_menu__(lst_files,
+                                             bool(self.link_mode))
+
+            # Option is "No delete any files"
+            if opc.lower() == 'n':
+                # Return the remaining list, do not continue
+                return lst_files, False, False
+            elif opc == '?':
+                # Help request. Print the help, print the file list, ask again.
+                self.__print_help__(bool(self.link_mode))
+                self.__print_list_files__(
+                    key, lst_files, max_length)
+            elif opc.lower() == 'q':
+                # Quit selected!
+                return lst_files, False, True
+            elif opc in file_valid_options:
+                # File option selected. Delete the file
+                removed = self.__delete_file__(
+                    self.files.path(lst_files[int(opc) - 1]))
+                if removed:
+                    # Remove the file from the list
+                    lst_files.pop(int(opc) - 1)
+                # Print the new list. If only one file, will exist in next loop
+                if len(lst_files) > min_files:
+                    self.__print_list_files__(
+                        key, lst_files, max_length)
+            elif opc in folder_valid_options:
+                # File option selected and folder selected by default
+                # Get the file to delete
+                idx = int(opc.replace('f', '')) - 1
+                # Get the folder name and include it in the default folder list
+                folder = self.files.dirname(lst_files[idx])
+                self.def_action_folder[folder] = 1
+                # Delete the file, remove it from the list
+                removed = self.__delete_file__(self.files.path(lst_files[idx]))
+                if removed:
+                    lst_files.pop(idx)
+                    # Print the new list. If only one, will exist in next loop
+                if len(lst_files) > min_files:
+                    self.__print_list_files__(
+                        key, lst_files, max_length)
+            elif opc in link_valid_options:
+                # Keep the file, replace the other files with links to it
+                idx = int(opc.replace('l', '')) - 1
+                source = lst_files[idx]
+                not_linked, _ = self.__link_files__(
+                    source, lst_files[:idx] + lst_files[idx + 1:])
+                lst_files = [source] + not_linked
+                if len(lst_files) > 1:
+                    self.__print_list_files__(
+                        key, lst_files, max_length)
+            elif opc == 'A':
+                # Remove all files
+                re_check = input('SURE? (type "YES" to confirm or '
+                                 'any key to cancel) ')
+                if re_check == 'YES':
+                    new_lst_files = []
+                    for lf in lst_files:
+                        removed = self.__delete_file__(self.files.path(lf))
+                        if not removed:
+                            new_lst_files.append(lf)
+                    lst_files = new_lst_files
+            else:
+                print("No valid option")
+
+    def __print_hardlinks__(self):
+        """
+        Print the sets of hard links (paths to the same physical file).
+
+        :return: None
+        """
+        if not self.files.links or self.machine_mode:
+            return
+
+        print("Hard linked files found (not duplicated).")
+        for k, v in self.files.links.items():
+            print("Files with inode {}:".format(self.files.ino[k] &
+                                                ~REMOTE_INO))
+            for idx, l_file in enumerate([k] + list(v)):
+                print("[{}] {}".format(idx + 1, self.files.path(l_file)))
+
+    def __process_duplicated__(self, write_mode=False):
+        """
+        Function to process the duplicated files, in read only (for printing)
+        or write mode (for deletion)
+
+        :param write_mode: Flag to write mode, False by default.
+        :return: Cancel by user flag (True if canceled)
+        """
+        if not len(self.checksums):
+            if not write_mode:
+                self.__print_hardlinks__()
+            return False
+
+        # Get the filename max length to align the output
+        max_length = self.__get_max_file_name_len_full__() if \
+            self.full_list_align else 0
+
+        print("Files found in the index files." if self.index_inputs else
+              "Duplicated files found.")
+        # The machine mode header is printed only once
+        if self.machine_mode:
+            self.__print_output_header__(None)
+
+        for k, v in self.checksums.items():
+            if not self.machine_mode:
+                self.__print_output_header__(k)
+
+            lst_work = list(v.files)
+            again = True
+            while again:
+                self.__print_list_files__(k, lst_work, max_length)
+                if write_mode:
+                    lst_files, again, quit_flag = self.__take_action__(
+                        k, lst_work, max_length)
+                    v.files = array('Q', lst_files)
+                    if quit_flag:
+                        return True
+                else:
+                    again = False
+
+        if not write_mode:
+            self.__print_hardlinks__()
+
+    def print_duplicated(self):
+        """
+        This function prints the duplicated files on the screen
+        :return: Cancel by user flag. In this case, always is false.
+        """
+        return self.__process_duplicated__()
+
+    def remove_duplicated(self):
+        """
+        This function removes the duplicated files (using a menu).
+
+        :return: Cancel by user flag (True if canceled)
+        """
+        l_mode = self.write_mode
+        return self.__process_duplicated__(l_mode)
+
+    def link_duplicated(self):
+        """
+        This function replaces the duplicated files with links to the first
+        file of every group, without the actions menu. All the paths are
+        kept. The link method is self.link_mode ("auto" if not set).
+
+        :return: Dictionary with the files replaced, the number of files
+                 replaced for every link type, the files not replaced and
+                 the bytes freed
+        """
+        if not self.link_mode:
+            self.link_mode = 'auto'
+
+        ret = {'linked': 0, 'link_types': {}, 'failed': 0, 'freed_bytes': 0}
+        for v in self.checksums.values():
+            # The archive members and the files of other hosts are read
+            # only
+            members = [x for x in v.files if self.files.is_read_only(x)]
+            lst_files = [x for x in v.files
+                         if not self.files.is_read_only(x)]
+            if len(lst_files) < 2:
+                continue
+            source, *lst_files = lst_files
+            not_linked, link_types = self.__link_files__(source, lst_files)
+            for link_type, count in link_types.items():
+                ret['link_types'][link_type] = \
+                    ret['link_types'].get(link_type, 0) + count
+                ret['linked'] += count
+            ret['failed'] += len(not_linked)
+            ret['freed_bytes'] += self.files.size[source] * \
+                (len(lst_files) - len(not_linked))
+            v.files = array('Q', [source] + not_linked + members)
+
+        print("Files linked: {} ({}). Errors: {}. Bytes freed: {}".format(
+            ret['linked'], ', '.join('{}: {}'.format(x, y) for x, y in
+                                     ret['link_types'].items()),
+            ret['failed'], ret['freed_bytes']))
+        return ret
+
+    def __get_plan_batches__(self, plan, summary):
+        """
+        Generator to split the actions of a plan in batches. The kept
+        file is never included.
+
+        :param plan: Iterable of plan entries
+        :param summary: Summary dictionary, the groups are counted
+        :return: Iterator of lists of tuples (action, link method, file to
+                 keep, file, size)
+        """
+        batch = []
+        for entry in plan:
+            summary['groups'] += 1
+            # The plans without the link method use self.link_mode
+            method = entry.get('method') or self.link_mode or 'auto'
+            for l_file in entry['files']:
+                if l_file == entry['keep']:
+                    continue
+                batch.append((entry['action'], method, entry['keep'],
+                              l_file, entry['size']))
+                if len(batch) == PLAN_BATCH_SIZE:
+                    yield batch
+                    batch = []
+
+        if batch:
+            yield batch
+
+    def __run_plan_batch__(self, batch):
+        """
+        This function executes a batch of plan actions. Before removing or
+        linking a file, the function checks that the file and the kept
+        file (if any) still exist, with the size of the plan, and that
+        they are not the same physical file. The bytes are only freed if
+        the file has no other hard links.
+
+        :param batch: List of tuples (action, link method, file to keep,
+               file, size)
+        :return: List of tuples (file, action, bytes freed, status,
+                 message). The status is "done", "skipped" or "failed"
+        """
+        ret = []
+        for action, method, l_keep, l_file, l_size in batch:
+            # The archive members and the files of other hosts are read
+            # only, but they can be kept
+            keep_read_only = read_only(l_keep) if l_keep else None
+            reason = read_only(l_file) or (action == 'link' and
+                                           keep_read_only)
+            if reason:
+                ret.append((l_file, action, 0, 'skipped', reason))
+                continue
+
+            try:
+                st = os.stat(l_file)
+                st_keep = os.stat(l_keep) if l_keep and not keep_read_only \
+                    else None
+            except OSError as e:
+                ret.append((l_file, action, 0, 'skipped', str(e)))
+                continue
+
+            freed = l_size if st.st_nlink == 1 else 0
+            if st.st_size != l_size or (st_keep is not None and
+                                        st_keep.st_size != l_size):
+                ret.append((l_file, action, 0, 'skipped', 'size changed'))
+            elif st_keep is not None and \
+                    (st.st_dev, st.st_ino) == (st_keep.st_dev,
+                                               st_keep.st_ino):
+                ret.append((l_file, action, 0, 'skipped',
+                            'same file as {}'.format(l_keep)))
+            elif self.test_mode:
+                ret.append((l_file, action, freed, 'done', None))
+            else:
+                try:
+                    if action == 'link':
+                        link_file(l_keep, l_file, method)
+                    else:
+                        os.remove(l_file)
+                    ret.append((l_file, action, freed, 'done', None))
+                except (OSError, ValueError) as e:
+                    ret.append((l_file, action, 0, 'failed', str(e)))
+
+        return ret
+
+    def get_plan(self):
+        """
+        This function returns the plan of actions for the duplicated
+        files: the file kept in every group, selected using the keep
+        rules, and the files to remove (or link, if self.link_mode is
+        set).
+
+        :return: List of plan entries. Every entry is a dictionary with the
+                 key, the size, the action ("delete" or "link"), the link
+                 method (only to link), the file to keep (None using
+                 reference indexes) and the other files
+        """
+        action = 'link' if self.link_mode else 'delete'
+        plan = []
+        for key, v in self.checksums.items():
+            # The archive members and the files of other hosts are never
+            # removed. They can be the kept file, but the links need a
+            # local file
+            lst_idx = [x for x in v.files
+                       if not (self.files.is_read_only(x) and
+                               action == 'link')]
+            paths = [self.files.path(x) for x in lst_idx]
+            if self.index_inputs or not paths:
+                # The kept copies are in the indexed trees
+                keep, idx = None, None
+            else:
+                idx = min(range(len(paths)), key=lambda x: tuple(
+                    rule(paths[x], self.files.mtime_ns[lst_idx[x]])
+                    for rule in self.keep_rules) + (x, ))
+                keep = paths[idx]
+            lst_paths = [x for n, x in enumerate(paths)
+                         if n != idx and
+                         not self.files.is_read_only(lst_idx[n])]
+            if not lst_paths:
+                continue
+            entry = {'key': self.__get_key_dict__(key),
+                     'size': self.files.size[v.files[0]],
+                     'action': action}
+            if action == 'link':
+                entry['method'] = self.link_mode
+            entry['keep'] = keep
+            entry['files'] = lst_paths
+            plan.append(entry)
+
+        return plan
+
+    def write_plan(self, file_name=None):
+        """
+        This function writes the plan of actions as NDJSON, one JSON
+        object per group, to review (or edit) it before the execution.
+
+        :param file_name: Output file, self.plan_file by default
+        :return: Number of groups written
+        """
+        plan = self.get_plan()
+        with open(file_name or self.plan_file, 'w') as f:
+            for entry in plan:
+                f.write(json.dumps(entry) + '\n')
+
+        print("Plan written: {} groups, {} files, {} bytes".format(
+            len(plan), sum(len(x['files']) for x in plan),
+            sum(x['size'] * len(x['files']) for x in plan)))
+        return len(plan)
+
+    @staticmethod
+    def read_plan(file_name):
+        """
+        Generator to read a plan of actions written by write_plan.
+
+        :param file_name: NDJSON plan file
+        :return: Iterator of plan entries
+        """
+        with open(file_name) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def execute_plan(self, file_name=None):
+        """
+        This function executes a plan of actions, without the actions
+        menu. The files are removed (or linked) in batches, in parallel
+        using self.jobs threads. Files changed after the plan was created
+        are skipped. In test mode, no file is changed. The files are
+        linked with the method of the plan.
+
+        :param file_name: NDJSON plan file. By default, the plan is
+               created using the keep rules and the duplicated files.
+        :return: Summary dictionary: groups, files done (removed and
+                 linked), skipped and failed, bytes freed, wall time
+        """
+        plan = self.read_plan(file_name) if file_name else self.get_plan()
+        summary = {'groups': 0, 'done': 0, 'removed': 0, 'linked': 0,
+                   'skipped': 0, 'failed': 0, 'freed_bytes': 0, 'wall': 0.0}
+        start = time.perf_counter()
+
+        with self.run_stats.phase('action'), \
+                ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as executor:
+            for results in executor.map(
+                    self.__run_plan_batch__,
+                    self.__get_plan_batches__(plan, summary)):
+                for l_file, action, freed, status, message in results:
+                    summary[status] += 1
+                    if status == 'done':
+                        done = 'linked' if action == 'link' else 'removed'
+                        summary[done] += 1
+                        summary['freed_bytes'] += freed
+                        if self.test_mode or self.verbose:
+                            print('File {} {}'.format(l_file, done))
+                    elif status == 'skipped':
+                        print("File {} skipped: {}".format(l_file, message))
+                    else:
+                        print("Error processing file {}: {}".format(
+                            l_file, message))
+                self.run_stats.add('action', len(results))
+
+        summary['wall'] = time.perf_counter() - start
+        self.run_stats.counters['plan'] = summary
+        print("Plan executed{}: {} groups. Files removed: {}. Files linked: "
+              "{}. Skipped: {}. Errors: {}. Bytes freed: {}. "
+              "Time: {:.2f} s".format(
+                " (test mode)" if self.test_mode else "", summary['groups'],
+                summary['removed'], summary['linked'], summary['skipped'],
+                summary['failed'], summary['freed_bytes'], summary['wall']))
+        return summary
+
+    def get_hardlinks(self):
+        """
+        This function returns the sets of hard links found, the paths to
+        the same physical file. They are not reported as duplicated files.
+
+        :return: Dictionary using (st_dev, st_ino) as key and the list of
+                 paths as value
+        """
+        return {(self.files.dev[k], self.files.ino[k]):
+                [self.files.path(k)] + [self.files.path(x) for x in v]
+                for k, v in self.files.links.items()}
+
+    def get_reclaimable_bytes(self):
+        """
+        This function returns the bytes that can be freed removing the
+        duplicated files, all except one file per group. Hard links are
+        one physical file, so they are counted once. Using reference
+        indexes, all the files can be removed. The archive members and
+        the files of other hosts are never removed, and a group with them
+        does not need to keep any other file.
+
+        :return: Number of bytes
+        """
+        ret = 0
+        for v in self.checksums.values():
+            files = sum(1 for x in v.files
+                        if not self.files.is_read_only(x))
+            kept = 0 if self.index_inputs or files < len(v.files) else 1
+            ret += self.files.size[v.files[0]] * (files - kept)
+
+        return ret
+
+    def get_stats(self):
+        """
+        This function returns the statistics of the last run: wall and CPU
+        time, files, bytes and throughput for every phase, cache hits and
+        bytes not read.
+
+        :return: Dictionary with the statistics
+        """
+        return self.run_stats.report()
+
+    def write_stats(self, file_name=None):
+        """
+        This function writes the statistics of the last run as JSON.
+
+        :param file_name: Output file, self.stats_file by default
+        :return: None
+        """
+        with open(file_name or self.stats_file, 'w') as f:
+            json.dump(self.get_stats(), f, indent=2)
+            f.write('\n')
+
+    def print_ndjson(self, stream=None):
+        """
+        This function prints the duplicated files as NDJSON, one JSON
+        object per group, while the groups are found.
+
+        :param stream: Output stream, sys.stdout by default
+        :return: Number of groups printed
+        """
+        stream = stream or sys.stdout
+        groups = 0
+        for key, lst_files in self.iter_duplicates():
+            stream.write(json.dumps({
+                'key': self.__get_key_dict__(key),
+                'size': lst_files[0]['size'],
+                'files': lst_files}) + '\n')
+            stream.flush()
+            groups += 1
+
+        return groups
+
+    def __scan__(self):
+        """
+        Reset the results of the last run and get the list of files (all)
+        in the input files and folders.
+
+        :return: None
+        """
+        # Set the base folder for the input files/folders
+        self.__get_full_path__()
+        self.files = FileTable()
+        self.checksums = {}
+        self.saved_bytes = {'hardlinks': 0, 'size': 0, 'sample': 0}
+        self.pruned = {'folders': 0, 'files': 0, 'bytes': 0}
+        self.compare_bytes = [0, 0]
+        self.tree_bytes = [0, 0]
+        self.tree_leaves = {}
+        self.max_file_name_len = 0
+        self.run_stats = RunStats(self.progress,
+                                  callback=self.progress_callback)
+        with self.run_stats.phase('walk'):
+            for folder in self.in_folders:
+                self.__get_files__(folder)
+            self.run_stats.add('walk', len(self.files))
+
+    def __get_all_checksums__(self):
+        """
+        Get the list of files and calculate the checksums of all the files,
+        without the filtering stages. The hard links are not included,
+        only the primary file is used.
+
+        :return: Tuple, list of files (indexes) and list of checksums, in
+                 the same order
+        """
+        self.__scan__()
+        lst_files = [x for x in range(len(self.files))
+                     if x not in self.files.linked]
+
+        self.__open_cache__()
+        self.__open_executor__()
+        try:
+            self.run_stats.set_total(len(lst_files), sum(
+                self.files.size[x] for x in lst_files))
+            function = partial(file_digests, algorithms=self.algorithms,
+                               block_size=self.block_size,
+                               drop_cache=self.drop_page_cache)
+            with self.run_stats.phase('checksums'):
+                lst_checksums = self.__get_checksums__(
+                    'checksums', self.algorithms, function, lst_files)
+        finally:
+            self.run_stats.finish()
+            self.__close_executor__()
+            self.__close_cache__()
+
+        return lst_files, lst_checksums
+
+    def write_shard(self, file_name=None):
+        """
+        This function writes a shard file with the size, the checksums
+        and the path of all the files in the input folders, sorted. The
+        shard files of other folders or hosts are merged later
+        (shard_inputs) to get the duplicated files in all of them.
+
+        Every file is read, because the files in other shards are not
+        known. The checksums cache avoids reading them again in the next
+        runs. The hard links are written with the checksums of the
+        primary file, and the device and inode of every file are
+        written, so the hard links are detected across shards.
+
+        :param file_name: Shard file, self.shard_file by default
+        :return: Number of files written
+        """
+        lst_files, lst_checksums = self.__get_all_checksums__()
+        lst_records = []
+        for l_file, (key, _) in zip(lst_files, lst_checksums):
+            key = [x.hex() for x in key]
+            for x in [l_file] + list(self.files.links.get(l_file, [])):
+                lst_records.append([
+                    self.files.size[x], key, self.files.path(x),
+                    self.files.mtime_ns[x], self.files.ctime_ns[x],
+                    self.files.dev[x], self.files.ino[x]])
+        lst_records.sort()
+
+        with open(file_name or self.shard_file, 'w') as f:
+            f.write(json.dumps({'format': SHARD_FORMAT,
+                                'algorithms': list(self.algorithms),
+                                'host': socket.gethostname(),
+                                'folders': self.in_folders}) + '\n')
+            for record in lst_records:
+                f.write(json.dumps(record) + '\n')
+
+        self.run_stats.counters['files'] = len(self.files)
+        self.__info__("Shard written: {} files".format(len(lst_records)))
+        return len(lst_records)
+
+    def __merge_shards__(self):
+        """
+        Generator to get the duplicated files from the shard files. Only
+        the duplicated files are stored in self.files and self.checksums,
+        so the printing and action functions can use them.
+
+        The files with the same host, device and inode are hard links,
+        they are stored as links of the first file. The paths of the
+        files of other hosts include the host, like host:/path, and
+        they are read only.
+
+        :return: Iterator of tuples (key, list of files), like
+                 iter_duplicates
+        """
+        self.files = FileTable()
+        self.checksums = {}
+        self.saved_bytes = {'hardlinks': 0, 'size': 0, 'sample': 0}
+        self.max_file_name_len = 0
+        self.run_stats = RunStats(self.progress,
+                                  callback=self.progress_callback)
+        # (host, st_dev) -> device number used in self.files
+        devices = {}
+        local_host = socket.gethostname()
+        for records in merge_shards(self.shard_inputs):
+            key = tuple(bytes.fromhex(x) for x in records[0][1])
+            group = DupGroup(key, array('Q'))
+            inodes = set()
+            for l_size, _, l_path, l_mtime_ns, l_ctime_ns, l_dev, l_ino, \
+                    l_host in records:
+                l_dev = devices.setdefault((l_host, l_dev), len(devices))
+                if l_host != local_host:
+                    l_path = l_host + HOST_SEPARATOR + l_path
+                    l_ino |= REMOTE_INO
+                st = os.stat_result((0, l_ino, l_dev, 2, 0, 0, l_size, 0, 0,
+                                     0, 0, 0, 0, 0, l_mtime_ns, l_ctime_ns))
+                idx = self.files.add(l_path, st)
+                if (l_dev, l_ino) not in inodes:
+                    inodes.add((l_dev, l_ino))
+                    group.files.append(idx)
+                else:
+                    self.saved_bytes['hardlinks'] += l_size
+                self.run_stats.advance(1)
+            if len(group.files) < 2:
+                continue
+            self.checksums[key] = group
+            self.max_file_name_len = max(
+                self.max_file_name_len,
+                self.__get_max_file_name_len__(group.files))
+            yield key, [self.files.file_info(x) for x in group.files]
+
+        self.run_stats.finish()
+        self.run_stats.counters.update({
+            'files': len(self.files),
+            'groups': len(self.checksums),
+            'duplicated_files': sum(len(x.files)
+                                    for x in self.checksums.values()),
+            'hardlink_sets': len(self.files.links),
+            'reclaimable_bytes': self.get_reclaimable_bytes()})
+
+    def __external_checksums__(self, phase, algorithms, function, records,
+                                args=None):
+        """
+        Get the checksums for a batch of external records (see
+        __iter_external__), using the cache and the workers pool.
+
+        :param phase: Phase name, for the statistics
+        :param algorithms: List of checksum algorithm names
+        :param function: Function to calculate the checksums
+        :param records: List of records
+        :param args: Extra lists of arguments for the function, or None
+        :return: List of tuples (list of checksums, bytes read)
+        """
+        return self.__calc_checksums__(
+            phase, algorithms, function, len(records),
+            lambda x: records[x][2],
+            lambda x: (records[x][5], records[x][6], records[x][0],
+                       records[x][3]), *(args or []))
+
+    def __iter_external__(self):
+        """
+        Generator to get the duplicated files using bounded memory. The
+        same stages are used (size, sample, checksums), but the files are
+        not stored in self.files: every stage writes records to an
+        ExternalSorter, sorted runs on disk, and the next stage reads them
+        with a k-way merge:
+         - Walk: (size, id, path, mtime_ns, ctime_ns, st_dev, st_ino),
+           the id is the walk order
+         - Size: files with a repeated size, sorted by id (walk order)
+         - Sample: (size, sample, id, record)
+         - Checksums: (size, checksums, id, record)
+         - Group: (first id, id, checksums, record)
+        Only the duplicated files are stored in self.files and
+        self.checksums. The groups are sorted by their first file.
+
+        :return: Iterator of tuples (key, list of files), like
+                 iter_duplicates
+        """
+        self.__get_full_path__()
+        self.files = FileTable()
+        self.checksums = {}
+        self.saved_bytes = {'hardlinks': 0, 'size': 0, 'sample': 0}
+        self.pruned = {'folders': 0, 'files': 0, 'bytes': 0}
+        self.compare_bytes = [0, 0]
+        self.max_file_name_len = 0
+        self.run_stats = RunStats(self.progress,
+                                  callback=self.progress_callback)
+        # The memory limit is shared by the sorters. The hard links and
+        # up to three stage sorters keep records in memory at once
+        limit = max(self.memory_limit // 4, 1)
+        sorters = {x: ExternalSorter(limit) for x in
+                   ('walk', 'links', 'sample', 'samples', 'checksums',
+                    'digests', 'groups')}
+
+        self.__open_cache__()
+        self.__open_executor__()
+        try:
+            with self.run_stats.phase('walk'):
+                self.__walk_external__(sorters['walk'], sorters['links'])
+
+            with self.run_stats.phase('size'):
+                self.__size_external__(sorters['walk'], sorters['sample'],
+                                       sorters['checksums'])
+
+            with self.run_stats.phase('sample'):
+                self.__sample_external__(sorters['sample'],
+                                         sorters['samples'],
+                                         sorters['checksums'])
+
+            with self.run_stats.phase('checksums'):
+                self.__checksums_external__(sorters['checksums'],
+                                            sorters['digests'])
+
+            with self.run_stats.phase('group'):
+                self.__group_external__(sorters['digests'], sorters['groups'],
+                                        sorters['links'])
+        finally:
+            self.run_stats.finish()
+            self.__close_executor__()
+            self.__close_cache__()
+            for sorter in sorters.values():
+                sorter.close()
+
+        self.run_stats.counters.update({
+            'files': self.run_stats.phases['walk']['files'],
+            'groups': len(self.checksums),
+            'duplicated_files': sum(len(x.files)
+                                    for x in self.checksums.values()),
+            'hardlink_sets': len(self.files.links),
+            'reclaimable_bytes': self.get_reclaimable_bytes(),
+            'saved_bytes': dict(self.saved_bytes),
+            'external_runs': sum(x.written_runs for x in sorters.values())})
+        if self.walk_filter is not None:
+            self.run_stats.counters['pruned'] = dict(self.pruned)
+        if self.verbose:
+            self.__print_saved_bytes__()
+
+        for group in self.checksums.values():
+            yield group.key, [self.files.file_info(x) for x in group.files]
+
+    def __walk_external__(self, files, links):
+        """
+        Walk the input folders and store the files in the external
+        sorter. The files with more than one hard link are also stored in
+        the links sorter, with the id of the primary file (the first path
+        found), and only the primary file is stored in the files sorter.
+        Only the inodes of these files are stored in memory.
+
+        :param files: ExternalSorter for the files
+        :param links: ExternalSorter for the hard links
+        :return: None
+        """
+        inodes = {}
+        l_id = 0
+        for folder in self.in_folders:
+            for full_name, st in self.__walk__(folder):
+                record = (st.st_size, l_id, full_name, st.st_mtime_ns,
+                          st.st_ctime_ns, st.st_dev, st.st_ino)
+                primary = l_id
+                if st.st_nlink > 1:
+                    primary = inodes.setdefault((st.st_dev, st.st_ino), l_id)
+                    links.add((primary, ) + record)
+                if primary != l_id:
+                    self.saved_bytes['hardlinks'] += st.st_size
+                else:
+                    files.add(record)
+                l_id += 1
+                self.run_stats.advance(1)
+
+        self.run_stats.add('walk', l_id)
+
+    def __size_external__(self, files, sample, checksums):
+        """
+        First filtering stage, see __get_size_candidates__. The files with
+        a repeated size are stored in the sample sorter or, if they are
+        small, in the checksums sorter, sorted by id.
+
+        :param files: ExternalSorter with the files, sorted by size
+        :param sample: ExternalSorter for the sample stage
+        :param checksums: ExternalSorter for the checksums stage
+        :return: None
+        """
+        total = [0, 0]
+        for l_size, records in groupby(files, key=lambda x: x[0]):
+            _, records = split_group(records)
+            if records is None:
+                self.run_stats.add('size', 1)
+                self.saved_bytes['size'] += l_size
+                continue
+
+            count = 0
+            lst_sorter = sample if l_size > 2 * SAMPLE_SIZE else checksums
+            for record in records:
+                lst_sorter.add((record[1], record))
+                count += 1
+            self.run_stats.add('size', count)
+            total[0] += count
+            total[1] += l_size * count
+
+        self.run_stats.set_total(*total)
+
+    def __run_batches__(self, sorter, function):
+        """
+        Read the records of a sorter (tuples (id, record)) and apply the
+        function to every batch of records.
+
+        :param sorter: ExternalSorter sorted by id
+        :param function: Function using a list of records
+        :return: None
+        """
+        batch = []
+        for _, record in sorter:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                function(batch)
+                batch = []
+        if batch:
+            function(batch)
+
+    def __sample_external__(self, sample, samples, checksums):
+        """
+        Second filtering stage, see __get_sample_candidates__. The files
+        with a repeated sample checksum are stored in the checksums
+        sorter.
+
+        :param sample: ExternalSorter with the files to sample
+        :param samples: ExternalSorter for the sample checksums
+        :param checksums: ExternalSorter for the checksums stage
+        :return: None
+        """
+        def add_samples(batch):
+            lst_samples = self.__external_checksums__(
+                'sample', ('sample', ), partial(
+                    sample_digests, drop_cache=self.drop_page_cache), batch,
+                [[x[0] for x in batch]])
+            for record, (l_sample, l_read) in zip(batch, lst_samples):
+                samples.add((record[0], l_sample, l_read, record[1], record))
+
+        self.__run_batches__(sample, add_samples)
+
+        for (l_size, _), records in groupby(samples,
+                                            key=lambda x: (x[0], x[1])):
+            first, records = split_group(records)
+            if records is None:
+                self.saved_bytes['sample'] += l_size - first[2]
+                self.run_stats.advance(1, l_size)
+                continue
+            for record in records:
+                checksums.add((record[3], record[4]))
+
+    def __checksums_external__(self, checksums, digests):
+        """
+        Calculate the full checksums of the candidate files, in walk
+        order, and store them in the digests sorter.
+
+        :param checksums: ExternalSorter with the candidate files
+        :param digests: ExternalSorter for the checksums
+        :return: None
+        """
+        function = partial(file_digests, algorithms=self.algorithms,
+                           block_size=self.block_size,
+                           drop_cache=self.drop_page_cache)
+
+        def add_digests(batch):
+            lst_checksums = self.__external_checksums__(
+                'checksums', self.algorithms, function, batch)
+            for record, (key, _) in zip(batch, lst_checksums):
+                digests.add((record[0], key, record[1], record))
+                if self.verbose:
+                    self.__info__("Processing file. {} Name: {}".format(
+                        self.__format_key__(key), record[2]))
+
+        self.__run_batches__(checksums, add_digests)
+
+    def __group_external__(self, digests, groups, links):
+        """
+        Group the files with the same checksums and store the duplicated
+        files in self.files and self.checksums, sorted by their first
+        file. The sets of hard links are also stored in self.files.
+
+        :param digests: ExternalSorter with the checksums
+        :param groups: ExternalSorter for the groups
+        :param links: ExternalSorter with the hard links
+        :return: None
+        """
+        for _, records in groupby(digests, key=lambda x: (x[0], x[1])):
+            first, records = split_group(records)
+            if records is None:
+                continue
+            for record in records:
+                groups.add((first[2], record[2], record[1], record[3]))
+
+        ids = {}
+        for first_id, records in groupby(groups, key=lambda x: x[0]):
+            group = None
+            for _, l_id, key, record in records:
+                if group is None:
+                    group = DupGroup(key, array('Q'))
+                    self.checksums[key] = group
+                ids[l_id] = self.__add_external__(record)
+                group.files.append(ids[l_id])
+            self.max_file_name_len = max(
+                self.max_file_name_len,
+                self.__get_max_file_name_len__(group.files))
+
+        # The primary file is the first record, it has the lowest id
+        for primary_id, records in groupby(links, key=lambda x: x[0]):
+            first, records = split_group(records)
+            if records is None:
+                continue
+            primary = ids.get(primary_id)
+            if primary is None:
+                primary = self.__add_external__(first[1:])
+            next(records)
+            for record in records:
+                idx = self.__add_external__(record[1:])
+                self.files.links.setdefault(primary, array('Q')).append(idx)
+                self.files.linked.add(idx)
+
+    def __add_external__(self, record):
+        """
+        Include the file of an external record in self.files.
+
+        :param record: (size, id, path, mtime_ns, ctime_ns, st_dev, st_ino)
+        :return: Index of the file in self.files
+        """
+        l_size, _, l_path, l_mtime_ns, l_ctime_ns, l_dev, l_ino = record
+        return self.files.add(l_path, os.stat_result((
+            0, l_ino, l_dev, 1, 0, 0, l_size, 0, 0, 0, 0, 0, 0, 0,
+            l_mtime_ns, l_ctime_ns)))
+
+    def write_index(self, file_name=None):
+        """
+        This function writes a reference index file with the size and the
+        checksums of all the files in the input folders. Other folders
+        can be checked against the index later (index_inputs), without
+        reading these files again.
+
+        :param file_name: Index file, self.index_file by default
+        :return: Number of records written (files with the same content
+                 are stored once)
+        """
+        lst_files, lst_checksums = self.__get_all_checksums__()
+        count = DigestIndex.write(
+            file_name or self.index_file, self.algorithms,
+            ((self.files.size[x], y[0]) for x, y in zip(lst_files,
+                                                        lst_checksums)))
+        self.run_stats.counters.update({'files': len(self.files),
+                                        'index_records': count})
+        self.__info__("Index written: {} files, {} records".format(
+            len(lst_files), count))
+        return count
+
+    def iter_duplicates(self):
+        """
+        Generator to get the duplicated files. Every group of duplicated
+        files is returned as soon as it is found, and stored in the
+        self.checksums variable.
+
+        The files are walked first, then the files with the same size are
+        processed in batches. The groups are sorted by their first file
+        (walk order), so the order does not depend on the batches or on
+        the jobs: a group is returned when the next batches cannot find a
+        group with a previous first file. Using shard files, the groups
+        are read from the merged shards.
+
+        :return: Iterator of tuples (key, list of files). The key is the
+                 tuple of checksums (bytes), in the self.algorithms order.
+                 Every file is a dictionary with the path, size, mtime and
+                 ctime.
+        """
+        if self.shard_inputs:
+            yield from self.__merge_shards__()
+            return
+        if self.memory_limit:
+            yield from self.__iter_external__()
+            return
+
+        self.__scan__()
+
+        # Get the checksums for the files with the same size
+        self.__open_cache__()
+        self.__open_executor__()
+        self.__open_indexes__()
+        try:
+            batch = {}
+            batch_files = 0
+            # Heap of (first file, DupGroup) not returned yet
+            pending = []
+            with self.run_stats.phase('size'):
+                candidates = self.__get_index_candidates__() \
+                    if self.indexes else self.__get_size_candidates__()
+                self.run_stats.add('size', len(self.files))
+                self.run_stats.set_total(
+                    sum(len(x) for x in candidates.values()),
+                    sum(x * len(y) for x, y in candidates.items()))
+            # The sizes are sorted by their first file, so the first
+            # file of the next size is the lowest file of the next batches
+            lst_sizes = list(candidates.items())
+            for idx, (l_size, lst_files) in enumerate(lst_sizes):
+                batch[l_size] = lst_files
+                batch_files += len(lst_files)
+                if batch_files < self.batch_size and \
+                        idx < len(lst_sizes) - 1:
+                    continue
+
+                if self.__cancelled__():
+                    raise CancelledError
+                for group in self.__get_files_checksums__(batch):
+                    heapq.heappush(pending, (group.files[0], group))
+                batch = {}
+                batch_files = 0
+
+                next_file = lst_sizes[idx + 1][1][0] \
+                    if idx < len(lst_sizes) - 1 else len(self.files)
+                while pending and pending[0][0] < next_file:
+                    _, group = heapq.heappop(pending)
+                    self.checksums[group.key] = group
+                    yield group.key, [self.files.file_info(x)
+                                      for x in group.files]
+        finally:
+            self.run_stats.finish()
+            self.__close_indexes__()
+            self.__close_executor__()
+            self.__close_cache__()
+
+        self.run_stats.counters.update({
+            'files': len(self.files),
+            'groups': len(self.checksums),
+            'duplicated_files': sum(len(x.files)
+                                    for x in self.checksums.values()),
+            'hardlink_sets': len(self.files.links),
+            'reclaimable_bytes': self.get_reclaimable_bytes(),
+            'saved_bytes': dict(self.saved_bytes)})
+        if self.walk_filter is not None:
+            self.run_stats.counters['pruned'] = dict(self.pruned)
+        if self.compare == 'bytes':
+            self.run_stats.counters['compare_bytes'] = {
+                'read': self.compare_bytes[0], 'full': self.compare_bytes[1]}
+        if self.tree_threshold:
+            self.run_stats.counters['tree_bytes'] = {
+                'read': self.tree_bytes[0], 'full': self.tree_bytes[1]}
+        if self.verbose:
+            self.__print_saved_bytes__()
+
+    def find_copies(self, targets=None, folders=None, max_matches=None):
+        """
+        This function finds the copies of the target files in the folders,
+        without looking for other duplicated files. The targets are read
+        first. Then the folders are walked and only the files with the
+        size of a target are stored and read: the sample checksum and, if
+        it matches the sample of a target, the full checksums. The walk
+        stops when max_matches copies are found. The targets that are not
+        regular files are not included.
+
+        The groups (the targets and their copies) are stored in the
+        self.checksums variable, like get_duplicated.
+
+        :param targets: List of files, self.find_targets by default
+        :param folders: List of folders to search, the input folders by
+               default
+        :param max_matches: Stop after finding this number of copies,
+               self.max_matches by default. Zero to find all the copies.
+        :return: Dictionary using the target file as key and the list of
+                 its copies as value
+        """
+        targets = targets or self.find_targets
+        if folders is not None:
+            self.in_folders = folders
+        if max_matches is None:
+            max_matches = self.max_matches
+
+        self.__get_full_path__()
+        self.files = FileTable()
+        self.checksums = {}
+        self.saved_bytes = {'hardlinks': 0, 'size': 0, 'sample': 0}
+        self.pruned = {'folders': 0, 'files': 0, 'bytes': 0}
+        self.max_file_name_len = 0
+        self.run_stats = RunStats(self.progress,
+                                  callback=self.progress_callback)
+
+        self.__open_cache__()
+        self.__open_executor__()
+        try:
+            with self.run_stats.phase('targets'):
+                lst_targets = []
+                for l_file in targets:
+                    try:
+                        st = os.stat(l_file)
+                    except OSError:
+                        self.__info__("File {} not found".format(l_file))
+                        continue
+                    if not stat.S_ISREG(st.st_mode):
+                        self.__info__("File {} not included".format(l_file))
+                        continue
+                    lst_targets.append(self.files.add(abspath(l_file), st))
+                keys, samples = self.__get_target_keys__(lst_targets)
+
+            copies = {}
+            matches = 0
+            batch = []
+            candidates = self.__walk_candidates__(
+                {x: self.files.path(x) for x in lst_targets},
+                {x for x, _ in keys})
+            while True:
+                with self.run_stats.phase('walk'):
+                    idx = next(candidates, None)
+                if idx is None:
+                    break
+                batch.append(idx)
+                if len(batch) < self.batch_size:
+                    continue
+                matches += self.__find_batch__(batch, keys, samples, copies)
+                batch = []
+                if max_matches and matches >= max_matches:
+                    break
+            self.__find_batch__(batch, keys, samples, copies)
+            candidates.close()
+        finally:
+            self.run_stats.finish()
+            self.__close_executor__()
+            self.__close_cache__()
+
+        # Only the hard links of the targets are reported
+        for idx in [x for x in self.files.links if x not in lst_targets]:
+            self.files.linked.difference_update(self.files.links.pop(idx))
+
+        # Group the targets and the copies, in the walk order
+        found = sorted(x for y in copies.values() for x in y)
+        if max_matches:
+            found = found[:max_matches]
+        found = set(found)
+        ret = {}
+        for (l_size, key), lst_idx in keys.items():
+            lst_copies = [x for x in copies.get(key, []) if x in found]
+            for idx in lst_idx:
+                ret[self.files.path(idx)] = [self.files.path(x)
+                                             for x in lst_copies]
+            if len(lst_idx) + len(lst_copies) > 1:
+                group = DupGroup(key, array('Q', lst_idx + lst_copies))
+                self.checksums[key] = group
+                self.max_file_name_len = max(
+                    self.max_file_name_len,
+                    self.__get_max_file_name_len__(group.files))
+
+        self.run_stats.counters.update({
+            'files': len(self.files),
+            'groups': len(self.checksums),
+            'duplicated_files': sum(len(x.files)
+                                    for x in self.checksums.values()),
+            'copies': len(found),
+            'hardlink_sets': len(self.files.links),
+            'reclaimable_bytes': self.get_reclaimable_bytes(),
+            'saved_bytes': dict(self.saved_bytes)})
+        if self.walk_filter is not None:
+            self.run_stats.counters['pruned'] = dict(self.pruned)
+        if self.verbose:
+            self.__print_saved_bytes__()
+
+        return ret
+
+    def __get_target_keys__(self, lst_targets):
+        """
+        Get the full and the sample checksums of the targets of
+        find_copies.
+
+        :param lst_targets: List of target files (indexes)
+        :return: Tuple, dictionary using (size, checksums) as key and the
+                 list of targets as value, and set of (size, sample
+                 checksums) of the targets
+        """
+        function = partial(file_digests, algorithms=self.algorithms,
+                           block_size=self.block_size,
+                           drop_cache=self.drop_page_cache)
+        lst_checksums = self.__get_checksums__(
+            'checksums', self.algorithms, function, lst_targets)
+        lst_sample = [x for x in lst_targets
+                      if self.files.size[x] > 2 * SAMPLE_SIZE]
+        lst_samples = self.__get_checksums__(
+            'sample', ('sample', ), partial(
+                sample_digests, drop_cache=self.drop_page_cache), lst_sample,
+            [self.files.size[x] for x in lst_sample])
+
+        keys = {}
+        for idx, (l_key, _) in zip(lst_targets, lst_checksums):
+            keys.setdefault((self.files.size[idx], l_key), []).append(idx)
+            if self.verbose:
+                self.__info__("Processing file. {} Name: {}".format(
+                    self.__format_key__(l_key), self.files.path(idx)))
+        samples = {(self.files.size[x], y) for x, (y, _) in
+                   zip(lst_sample, lst_samples)}
+
+        return keys, samples
+
+    def __walk_candidates__(self, targets, sizes):
+        """
+        Generator to walk the input folders for find_copies. Only the files
+        with the size of a target are stored in self.files. The targets
+        and their hard links are not candidates.
+
+        :param targets: Dictionary using the target files (indexes) as key
+               and the target file names as value
+        :param sizes: Set of sizes of the targets
+        :return: Iterator of candidate files (indexes)
+        """
+        inodes = {(self.files.dev[x], self.files.ino[x]) for x in targets}
+        paths = set(targets.values())
+        for folder in self.in_folders:
+            for full_name, st in self.__walk__(folder):
+                self.run_stats.add('walk', 1)
+                if st.st_size not in sizes:
+                    self.saved_bytes['size'] += st.st_size
+                elif full_name in paths:
+                    continue
+                elif (st.st_dev, st.st_ino) in inodes:
+                    # Other path of a target, stored as its hard link
+                    self.files.add(full_name, st)
+                    self.saved_bytes['hardlinks'] += st.st_size
+                else:
+                    idx = self.files.add(full_name, st)
+                    if idx in self.files.linked:
+                        self.saved_bytes['hardlinks'] += st.st_size
+                    else:
+                        yield idx
+
+    def __find_batch__(self, batch, keys, samples, copies):
+        """
+        Check a batch of candidates of find_copies: the sample checksum
+        first and the full checksums if the sample matches a target.
+
+        :param batch: List of candidate files (indexes)
+        :param keys: Dictionary of the targets, see __get_target_keys__
+        :param samples: Set of sample checksums of the targets
+        :param copies: Dictionary to store the copies, using the checksums
+               as key and the list of files as value
+        :return: Number of copies found
+        """
+        lst_sample = [x for x in batch if self.files.size[x] > 2 * SAMPLE_SIZE]
+        lst_full = [x for x in batch if self.files.size[x] <= 2 * SAMPLE_SIZE]
+        with self.run_stats.phase('sample'):
+            lst_checksums = self.__get_checksums__(
+                'sample', ('sample', ), partial(
+                    sample_digests, drop_cache=self.drop_page_cache),
+                lst_sample, [self.files.size[x] for x in lst_sample])
+        for idx, (l_sample, read_bytes) in zip(lst_sample, lst_checksums):
+            if (self.files.size[idx], l_sample) in samples:
+                lst_full.append(idx)
+            else:
+                self.saved_bytes['sample'] += self.files.size[idx] - \
+                    read_bytes
+
+        lst_full.sort()
+        function = partial(file_digests, algorithms=self.algorithms,
+                           block_size=self.block_size,
+                           drop_cache=self.drop_page_cache)
+        with self.run_stats.phase('checksums'):
+            lst_checksums = self.__get_checksums__(
+                'checksums', self.algorithms, function, lst_full)
+
+        found = 0
+        for idx, (l_key, _) in zip(lst_full, lst_checksums):
+            if (self.files.size[idx], l_key) in keys:
+                copies.setdefault(l_key, []).append(idx)
+                found += 1
+                if self.verbose:
+                    self.__info__("Processing file. {} Name: {}".format(
+                        self.__format_key__(l_key), self.files.path(idx)))
+
+        return found
+
+    def get_duplicated(self):
+        """
+        This function get the duplicated files. Store it in the self.checksums
+        variable for this class and returns a copy of the list.
+
+        The keys are tuples with the checksums (bytes), in the
+        self.algorithms order. The values are the lists of file names,
+        built from the compact self.checksums groups.
+
+        :return: Copy of self.checksums with the duplicated files
+        """
+        for _ in self.iter_duplicates():
+            pass
+
+        # Return the duplicated files
+        return {k: [self.files.path(x) for x in v.files]
+                for k, v in self.checksums.items()}
+
+
+class DupDaemon:
+    def __init__(self, cleaner, socket_path, rescan_interval=DAEMON_RESCAN,
+                 delay=DAEMON_DELAY):
+        """
+        Init function for DupDaemon. Resident index with the checksums of
+        all the files in the DupCleaner folders, updated with the
+        filesystem changes (inotify, if available) and with a full rescan
+        every rescan_interval seconds. The queries are answered in a Unix
+        socket, one JSON object per line, like {"op": "groups"}:
+          - path: {"op": "path", "path": FILE}. If the file is not
+            indexed, its checksums are calculated in the background. Only
+            the regular files in the folders are read.
+          - key: {"op": "key", "key": {"md5": CHECKSUM}}, with all the
+            checksum algorithms
+          - groups: the current groups of duplicated files
+          - metrics: latency of the requests and of the index updates
+          - rescan: run a full rescan
+        The responses include "ok" and, if false, "error".
+
+        :param cleaner: DupCleaner with the folders and the options
+        :param socket_path: Unix socket file
+        :param rescan_interval: Seconds between two full rescans. Zero to
+               disable the periodic rescans.
+        :param delay: Seconds to wait after a change before updating the
+               index
+        """
+        self.cleaner = cleaner
+        self.socket_path = socket_path
+        self.rescan_interval = rescan_interval
+        self.delay = delay
+        # Path -> (key, size, st_dev, st_ino), and key -> set of paths
+        self.paths = {}
+        self.keys = {}
+        # Changed paths -> time of the first event, and paths read again
+        # after an error -> number of errors
+        self.pending = {}
+        self.retries = {}
+        # Input folders, and folders watched with inotify
+        self.folders = []
+        self.watched = set()
+        self.inotify = None
+        self.running = False
+        self.need_rescan = True
+        self.last_rescan = 0.0
+        self.start_time = time.perf_counter()
+        self.requests = {}
+        self.updates = LatencyStats()
+        self.rescans = LatencyStats()
+        # Workers reading the files of the path requests, client ->
+        # responses in the requests order, and socket pair to wake up the
+        # daemon when a file is read
+        self.executor = None
+        self.replies = {}
+        self.wakeup = None
+
+    def stop(self):
+        """
+        This function stops the daemon after the current request.
+
+        :return: None
+        """
+        self.running = False
+
+    def __add_path__(self, path, key, size, dev, ino):
+        """
+        Store a file in the index.
+
+        :return: None
+        """
+        self.paths[path] = key, size, dev, ino
+        self.keys.setdefault(key, set()).add(path)
+
+    def __remove_path__(self, path):
+        """
+        Remove a file from the index, with the archive members and the
+        files in the folder, if the path was a folder.
+
+        :param path: File or folder name
+        :return: None
+        """
+        lst_paths = [path] if path in self.paths else []
+        if path in self.watched:
+            prefix = path + os.sep
+            lst_paths.extend(x for x in self.paths if x.startswith(prefix))
+            self.watched.difference_update(
+                [x for x in self.watched if x.startswith(prefix)] + [path])
+        elif archive_type(path):
+            prefix = path + ARCHIVE_SEPARATOR
+            lst_paths.extend(x for x in self.paths if x.startswith(prefix))
+
+        for l_path in lst_paths:
+            key = self.paths.pop(l_path)[0]
+            self.keys[key].discard(l_path)
+            if not self.keys[key]:
+                del self.keys[key]
+
+    def rescan(self):
+        """
+        This function builds the index again, reading the checksums of
+        all the files (using the cache, if enabled), and watches all the
+        folders.
+
+        :return: None
+        """
+        start = time.perf_counter()
+        cleaner = self.cleaner
+        cleaner.in_folders = list(self.folders)
+        lst_files, lst_checksums = cleaner.__get_all_checksums__()
+        self.paths = {}
+        self.keys = {}
+        files = cleaner.files
+        for idx, (key, _) in zip(lst_files, lst_checksums):
+            for l_idx in [idx] + list(files.links.get(idx, [])):
+                self.__add_path__(files.path(l_idx), key, files.size[idx],
+                                  files.dev[idx], files.ino[idx])
+        cleaner.files = FileTable()
+        if cleaner.cache is not None:
+            cleaner.cache.evict()
+            cleaner.cache.save()
+
+        if self.inotify is not None:
+            for folder in cleaner.in_folders:
+                if folder.endswith(os.sep):
+                    self.__watch__(folder[:-1], folder)
+
+        self.need_rescan = False
+        self.last_rescan = time.perf_counter()
+        self.rescans.add(self.last_rescan - start)
+        cleaner.__info__("Index updated: {} files, {} checksums".format(
+            len(self.paths), len(self.keys)))
+
+    def __watch__(self, folder, root):
+        """
+        Watch a folder and its sub folders (recursive mode), using the
+        walk filters.
+
+        :param folder: Folder name
+        :param root: Input folder (ending with os.sep)
+        :return: None
+        """
+        walk_filter = self.cleaner.walk_filter
+        stack = [folder]
+        while stack:
+            folder = stack.pop()
+            try:
+                self.inotify.add(folder)
+                self.watched.add(folder)
+                with os.scandir(folder) as it:
+                    entries = [x for x in it
+                               if x.is_dir(follow_symlinks=False)]
+            except OSError as e:
+                self.cleaner.__info__("Folder {} not watched: {}".format(
+                    folder, e))
+                continue
 
-            self.in_folders = lst_ret
+            if not self.cleaner.recursive:
+                continue
+            for entry in entries:
+                path = entry.path[len(root):]
+                if walk_filter is None or not walk_filter.skip_folder(
+                        entry.name, path, path.count(os.sep) + 1):
+                    stack.append(entry.path)
 
-    def __get_files_checksums__(self):
+    def __get_root__(self, path):
         """
-        This function creates a dictionary of checksums
-        using the MD5 and SHA-1 algorithms
-        It stores the results in the dictionary self.checksums
-        using the MD5_SHA-1 as key and a list of files with
-        these checksums as value.
+        Return the input folder of a path.
 
-        :return: None
+        :param path: File or folder name
+        :return: Input folder (ending with os.sep), or None if the path is
+                 not in the input folders
         """
-        for k, _ in self.files.items():
-            l_md5 = md5(k) if self.md5 else ''
-            l_sha1 = sha1(k) if self.sha1 else ''
-            l_new_key = l_md5 + '_' + l_sha1
-            if self.checksums.get(l_new_key) is None:
-                self.checksums[l_new_key] = [k]
-            else:
-                self.checksums[l_new_key].append(k)
+        for folder in self.folders:
+            if path == folder or \
+                    self.cleaner.__is_included__(path, folder):
+                return folder
 
-            if self.verbose:
-                print("Processing file. MD5:{} SHA-1:{} Name: {}".format(
-                    l_md5, l_sha1, k))
+        return None
 
-    def __remove_not_dups__(self):
+    def __read_events__(self):
         """
-        Remove the not duplicated files in the self.checksums dictionary.
+        Read the inotify events and store the changed paths.
 
         :return: None
         """
-        new_dups = {}
-        for k, v in self.checksums.items():
-            if len(v) > 1:
-                new_dups[k] = v
-
-        self.checksums = new_dups
+        now = time.perf_counter()
+        for path, mask in self.inotify.read():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self.need_rescan = True
+            else:
+                self.pending.setdefault(path, now)
 
-    def __print_output_header__(self, l_md5, l_sha1):
+    def __update__(self):
         """
-        Print the output header for a set of files with the same
-        MD5 / SHA-1 checksum.
+        Update the index with the paths changed self.delay seconds ago
+        or more (first event of every path). The paths are removed from
+        the index and, if they still exist, read again. The files that
+        cannot be read are updated again later, at most DAEMON_RETRIES
+        times.
 
-        :param l_md5: MD5 checksum for the set of files.
-        :param l_sha1: SHA-1 checksum for the set of files.
         :return: None
         """
-        if self.machine_mode:
-            print("MD5|SHA-1|File|Creation|Last Modification|Size")
-        else:
-            print("Files with key [MD5:{} SHA-1:{}]:".format(l_md5, l_sha1))
+        now = time.perf_counter()
+        ready = [x for x, y in self.pending.items() if now - y >= self.delay]
+        if not ready:
+            return
 
-    def __get_max_file_name_len__(self, lst_files):
+        cleaner = self.cleaner
+        walk_filter = cleaner.walk_filter
+        lst_files = []
+        for path in ready:
+            self.__remove_path__(path)
+            root = self.__get_root__(path)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if root is None:
+                continue
+
+            if stat.S_ISDIR(st.st_mode) and root.endswith(os.sep):
+                if self.inotify is not None and cleaner.recursive:
+                    self.__watch__(path, root)
+                lst_files.extend(cleaner.__walk__(path + os.sep))
+            elif stat.S_ISREG(st.st_mode):
+                name = path[len(root):] if root.endswith(os.sep) else \
+                    os.path.basename(path)
+                if walk_filter is not None and (
+                        walk_filter.skip_file(os.path.basename(path), name)
+                        or walk_filter.skip_size(st.st_size)):
+                    continue
+                lst_files.append((path, st))
+                if cleaner.archives and archive_type(path):
+                    lst_files.extend(cleaner.__walk_archive__(
+                        path, st, len(path) - len(name)))
+
+        function = partial(file_digests, algorithms=cleaner.algorithms,
+                           block_size=cleaner.block_size,
+                           drop_cache=cleaner.drop_page_cache)
+        errors = {}
+        cleaner.__open_cache__()
+        try:
+            lst_checksums = cleaner.__calc_checksums__(
+                'checksums', cleaner.algorithms, function, len(lst_files),
+                lambda x: lst_files[x][0],
+                lambda x: (lst_files[x][1].st_dev, lst_files[x][1].st_ino,
+                           lst_files[x][1].st_size,
+                           lst_files[x][1].st_mtime_ns), errors=errors)
+        finally:
+            cleaner.__close_cache__()
+
+        now = time.perf_counter()
+        retries = {x: self.retries.pop(x, 0) for x in ready}
+        for path in ready:
+            self.updates.add(now - self.pending.pop(path))
+
+        for idx, ((path, st), ret) in enumerate(zip(lst_files,
+                                                    lst_checksums)):
+            if ret is not None:
+                self.__add_path__(path, ret[0], st.st_size, st.st_dev,
+                                  st.st_ino)
+                continue
+
+            # Changed again or not readable, only this file is updated
+            # again. The archive members are updated with the archive.
+            path = (split_member(path) or (path, ))[0]
+            cleaner.__info__("Error updating the index: {}".format(
+                errors[idx]))
+            if retries.get(path, 0) < DAEMON_RETRIES and \
+                    path not in self.pending:
+                self.retries[path] = retries.get(path, 0) + 1
+                self.pending[path] = now
+
+    def __check_path__(self, path):
         """
-        Return the longest filename in the lst_files list.
+        Check that a file not indexed can be read to answer a request: a
+        regular file in the input folders, not reached through a symbolic
+        link. The clients cannot get the checksums of other files.
 
-        :param lst_files: List of files.
-        :return: Numeric value of the longest file name
+        :param path: Absolute file name
+        :return: None. ValueError if the file cannot be read.
         """
-        if self.machine_mode:
-            return 0
+        root = self.__get_root__(path)
+        if root is None:
+            raise ValueError("File {} not in the folders".format(path))
 
-        txt_len = 0
-        for l_file in lst_files:
-            if len(l_file) > txt_len:
-                txt_len = len(l_file)
+        real_path = os.path.realpath(path)
+        real_root = os.path.realpath(root)
+        if root.endswith(os.sep):
+            real_root = os.path.join(real_root, path[len(root):])
+        if real_path != real_root:
+            raise ValueError("File {} not in the folders".format(path))
+        if not stat.S_ISREG(os.lstat(path).st_mode):
+            raise ValueError("File {} is not a regular file".format(path))
 
-        return txt_len
+    def __read_path__(self, request):
+        """
+        Start reading the file of a path request in the background, if
+        the path is not indexed.
 
-    def __get_max_file_name_len_full__(self):
+        :param request: Request dictionary, see DupDaemon
+        :return: Future of the file checksums (see file_digests), or None
+                 if the request is answered without reading a file
         """
-        Return the longest filename for all files in the values
-        of the self.checksums dictionary.
+        if self.executor is None or not isinstance(request, dict) or \
+                request.get('op') != 'path' or \
+                not isinstance(request.get('path'), str):
+            return None
 
-        :return: Numeric value of the longest file name
+        path = abspath(request['path'])
+        if path in self.paths:
+            return None
+        try:
+            self.__check_path__(path)
+        except (ValueError, OSError):
+            # Answered by handle
+            return None
+
+        future = self.executor.submit(file_digests, path,
+                                      self.cleaner.algorithms,
+                                      self.cleaner.block_size)
+        future.add_done_callback(self.__wake_up__)
+        return future
+
+    def __wake_up__(self, future):
         """
-        if self.machine_mode:
-            return 0
+        Wake up the daemon to send the response of a path request, called
+        when the file is read.
 
-        txt_len = 0
-        for _, v in self.checksums.items():
-            for l_file in v:
-                f_len = len(l_file)
-                if f_len > txt_len:
-                    txt_len = f_len
+        :param future: Future of the file checksums
+        :return: None
+        """
+        with suppress(OSError):
+            self.wakeup[1].send(b'\0')
 
-        return txt_len
+    def query_path(self, path, future=None):
+        """
+        This function checks if a file is stored in the index: the path
+        or, if the path is not indexed, its content. Only the regular
+        files in the input folders are read.
 
-    def __print_list_files__(self, l_md5, l_sha1, lst_files, max_file_name_len):
+        :param path: File name
+        :param future: Future of the file checksums (see file_digests), if
+               the file was read in the background
+        :return: Dictionary with "stored", "indexed" (the path is in the
+                 index), the key and the files with the same key
         """
-        This function prints the list of files included in the list "lst_files"
-        with the same MD5/SHA-1 checksum.
+        path = abspath(path)
+        indexed = path in self.paths
+        if indexed:
+            key = self.paths[path][0]
+        elif future is not None:
+            key = future.result()[0]
+        else:
+            self.__check_path__(path)
+            key = file_digests(path, self.cleaner.algorithms,
+                               self.cleaner.block_size)[0]
+        files = sorted(self.keys.get(key, set()) - {path})
+        return {'stored': bool(files) or indexed, 'indexed': indexed,
+                'key': self.cleaner.__get_key_dict__(key), 'files': files}
 
-        The output will align the extra data (Date of creation, last
-        modification date and the size) using the max_file_name_len
-        argument for a global (all files) alignment or only for this
-        set (list) if max_file_name_len is zero.
+    def query_key(self, key):
+        """
+        This function checks if a content is stored in the index.
 
-        :param l_md5: MD5 for the list of files
-        :param l_sha1: SHA-1 for the list of files
-        :param lst_files: List of files to print
-        :param max_file_name_len: Max file name length or zero
-        :return: None
+        :param key: Dictionary with the checksums in hexadecimal, for all
+               the algorithms, like {"md5": "..."}
+        :return: Dictionary with "stored" and the files with the key
         """
-        if not max_file_name_len and not self.machine_mode:
-            max_file_name_len = self.__get_max_file_name_len__(lst_files)
+        key = tuple(bytes.fromhex(key[x]) for x in self.cleaner.algorithms)
+        files = sorted(self.keys.get(key, set()))
+        return {'stored': bool(files), 'files': files}
 
-        for idx, l_file in enumerate(lst_files):
-            l_size = getsize(l_file)
-            l_last_mod = time.ctime(getmtime(l_file))
-            l_creation = time.ctime(getctime(l_file))
-            if not self.machine_mode:
-                print("[{}] ".format(idx + 1) +
-                      ("{:" + str(max_file_name_len + 2) + "} ").format(l_file)
-                      + "Created: {} Last Modification: {} Size: {}".format(
-                    l_last_mod, l_creation, l_size))
-            else:
-                print('{}|{}|{}|{}|{}|{}'.format(
-                    l_md5, l_sha1, l_file, l_creation, l_last_mod, l_size))
+    def get_groups(self):
+        """
+        This function returns the current groups of duplicated files. The
+        hard links are one physical file.
 
-    @staticmethod
-    def __print_help__():
+        :return: List of groups, dictionaries with the key, the size and
+                 the files
         """
-        Prints the help for the actions menu
+        ret = []
+        for key, paths in self.keys.items():
+            if len({self.paths[x][2:] for x in paths}) < 2:
+                continue
+            paths = sorted(paths)
+            ret.append({'key': self.cleaner.__get_key_dict__(key),
+                        'size': self.paths[paths[0]][1], 'files': paths})
 
-        :return: None
+        return ret
+
+    def get_metrics(self):
         """
-        print("  <number>: Delete file with index number")
-        print("  f<number: Delete file with index and select it's "
-              "directory to remove by default")
-        print("         n: Do not remove any file")
-        print("         A: Remove All files (WARNING, "
-              "you will lost all copies!!)")
-        print("         q: Quit!")
+        This function returns the metrics of the daemon: the latency of
+        the requests (by operation), the latency of the index updates
+        (from the first change event) and of the full rescans, and the
+        index size.
 
-    @staticmethod
-    def __print_action_menu__(lst_files):
+        :return: Dictionary with the metrics
         """
-        Print the action menu for the list of files "lst_files".
+        return {'uptime': time.perf_counter() - self.start_time,
+                'paths': len(self.paths), 'keys': len(self.keys),
+                'pending': len(self.pending),
+                'watches': len(self.inotify.folders) if self.inotify
+                else 0,
+                'requests': {x: y.report() for x, y in self.requests.items()},
+                'updates': self.updates.report(),
+                'rescans': self.rescans.report()}
 
-        The user will select the desired option:
-         - A number: Number of the file in the list
-         - f + number: Number of the file in the list and select the
-           directory as default directory for deletion.
-         - "A": All files
-         - "q": Quit
-         - "?": Help
+    def handle(self, request, future=None, start=None):
+        """
+        This function answers a request.
 
-        :param lst_files: List of files to apply the actions
-        :return: The selected option.
+        :param request: Request dictionary, see DupDaemon
+        :param future: Future of the file checksums of a path request, if
+               the file was read in the background (see __read_path__)
+        :param start: Time of the request (perf_counter), now by default
+        :return: Response dictionary
         """
-        lst_options = []
-        lst_folder_options = []
-        for idx, _ in enumerate(lst_files):
-            lst_options.append(idx + 1)
-            lst_folder_options.append('f{}'.format(idx + 1))
+        start = time.perf_counter() if start is None else start
+        op = request.get('op') if isinstance(request, dict) else None
+        try:
+            if op == 'path':
+                ret = self.query_path(request['path'], future)
+            elif op == 'key':
+                ret = self.query_key(request['key'])
+            elif op == 'groups':
+                ret = {'groups': self.get_groups()}
+            elif op == 'metrics':
+                ret = self.get_metrics()
+            elif op == 'rescan':
+                self.need_rescan = True
+                ret = {}
+            else:
+                raise ValueError("Operation {} not valid".format(op))
+            ret['ok'] = True
+        except (KeyError, ValueError, TypeError, OSError) as e:
+            ret = {'ok': False, 'error': str(e)}
 
-        lst_options.extend(lst_folder_options)
+        self.requests.setdefault(str(op), LatencyStats()).add(
+            time.perf_counter() - start)
+        return ret
 
-        opc = input('{}, n, A, q, ?. Option: '.format(lst_options))
-        return opc
+    def __timeout__(self):
+        """
+        Return the seconds until the next pending update or rescan, at
+        most DAEMON_DELAY seconds, so the daemon stops soon after a
+        signal.
 
-    def __delete_file__(self, l_file):
+        :return: Seconds
         """
-        This function is used to remove a file. If test-mode
-        is set, the file is not deleted.
+        now = time.perf_counter()
+        lst_times = [x + self.delay for x in self.pending.values()]
+        lst_times.append(now + DAEMON_DELAY)
+        if self.rescan_interval:
+            lst_times.append(self.last_rescan + self.rescan_interval)
 
-        :param l_file: File to be deleted.
-        :return: True if the file is removed. False if it fails.
+        return max(min(lst_times) - now, 0)
+
+    def serve(self):
         """
-        if self.test_mode:
-            print('File {} removed'.format(l_file))
-            return True
+        This function builds the index and answers the requests until the
+        daemon is stopped (stop, SIGTERM or SIGINT).
 
+        :return: None
+        """
+        cleaner = self.cleaner
+        cleaner.__get_full_path__()
+        self.folders = list(cleaner.in_folders)
+        # The cache is pruned once and kept open by the updates
+        cleaner.__open_cache__()
         try:
-            os.remove(l_file)
-            print('File {} removed'.format(l_file))
-            return True
+            self.inotify = Inotify()
         except OSError as e:
-            print("Error removing file: {}".format(e))
-            return False
+            cleaner.__info__("Inotify not available ({}), using the "
+                             "rescans only".format(e))
 
-    def __take_auto_action__(self, lst_files):
+        with suppress(FileNotFoundError):
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen()
+        server.setblocking(False)
+        self.wakeup = socket.socketpair()
+        self.wakeup[0].setblocking(False)
+        self.executor = ThreadPoolExecutor(max_workers=max(cleaner.jobs, 1))
+
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        selector.register(self.wakeup[0], selectors.EVENT_READ)
+        if self.inotify is not None:
+            selector.register(self.inotify.fd, selectors.EVENT_READ)
+        buffers = {}
+        self.running = True
+        try:
+            while self.running:
+                if self.need_rescan or (
+                        self.rescan_interval and time.perf_counter() -
+                        self.last_rescan >= self.rescan_interval):
+                    self.rescan()
+                for item, _ in selector.select(self.__timeout__()):
+                    if item.fileobj is server:
+                        conn, _ = server.accept()
+                        conn.settimeout(DAEMON_TIMEOUT)
+                        selector.register(conn, selectors.EVENT_READ)
+                        buffers[conn] = b''
+                        self.replies[conn] = deque()
+                    elif item.fileobj is self.wakeup[0]:
+                        with suppress(OSError):
+                            self.wakeup[0].recv(65536)
+                        for conn in list(self.replies):
+                            self.__send_replies__(conn, buffers, selector)
+                    elif self.inotify is not None and \
+                            item.fileobj == self.inotify.fd:
+                        self.__read_events__()
+                    else:
+                        self.__read_requests__(item.fileobj, buffers,
+                                               selector)
+                self.__update__()
+        finally:
+            for conn in buffers:
+                conn.close()
+            self.replies = {}
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+            selector.close()
+            server.close()
+            for item in self.wakeup:
+                item.close()
+            cleaner.__close_cache__()
+            with suppress(OSError):
+                os.remove(self.socket_path)
+            if self.inotify is not None:
+                self.inotify.close()
+
+    def __read_requests__(self, conn, buffers, selector):
         """
-        This function apply auto deletion for the list of files.
-        This function checks if the files are in the default action
-        folders to delete their files.
+        Read the requests of a client and send the responses.
 
-        If all folders for all files are in the default action list,
-        the function also checks that at least one file is not deleted.
+        :param conn: Client socket
+        :param buffers: Dictionary with the data not processed of every
+               client
+        :param selector: Selector, the client is removed when the
+               connection is closed
+        :return: None
+        """
+        replies = self.replies[conn]
+        try:
+            data = conn.recv(65536)
+            buffers[conn] += data
+            while b'\n' in buffers[conn]:
+                line, buffers[conn] = buffers[conn].split(b'\n', 1)
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    replies.append({'ok': False, 'error': str(e)})
+                    continue
+                future = self.__read_path__(request)
+                if future is None:
+                    replies.append(self.handle(request))
+                else:
+                    replies.append((request, future, time.perf_counter()))
+        except OSError:
+            data = b''
 
-        :param lst_files: List of files to delete.
-        :return: Remaining files
+        if not data:
+            self.__close_client__(conn, buffers, selector)
+        else:
+            self.__send_replies__(conn, buffers, selector)
+
+    def __send_replies__(self, conn, buffers, selector):
         """
-        ret_list = []
-        changed = False
+        Send the responses of a client, in the requests order, until a
+        response waits for a file being read.
 
-        # Avoid remove all files, at least hold one.
-        max_deletion = len(lst_files) - 1
-        deleted_files = 0
+        :param conn: Client socket
+        :param buffers: Dictionary with the data not processed of every
+               client
+        :param selector: Selector, the client is removed if the response
+               cannot be sent
+        :return: None
+        """
+        replies = self.replies[conn]
+        try:
+            while replies:
+                if isinstance(replies[0], tuple):
+                    request, future, start = replies[0]
+                    if not future.done():
+                        break
+                    response = self.handle(request, future, start)
+                else:
+                    response = replies[0]
+                replies.popleft()
+                conn.sendall(json.dumps(response).encode() + b'\n')
+        except OSError:
+            self.__close_client__(conn, buffers, selector)
 
-        for l_file in lst_files:
-            l_path = dirname(l_file)
-            if self.def_action_folder.get(l_path) \
-                    and deleted_files < max_deletion:
-                print("Removing file automatically: {}".format(l_file))
-                removed = self.__delete_file__(l_file)
-                if removed:
-                    deleted_files += 1
-                    changed = True
-            else:
-                ret_list.append(l_file)
+    def __close_client__(self, conn, buffers, selector):
+        """
+        Close the connection of a client. The files being read for it are
+        not waited.
+
+        :param conn: Client socket
+        :param buffers: Dictionary with the data not processed of every
+               client
+        :param selector: Selector, the client is removed
+        :return: None
+        """
+        selector.unregister(conn)
+        del buffers[conn]
+        del self.replies[conn]
+        conn.close()
 
-        return ret_list, changed
 
-    def __take_action__(self, l_md5, l_sha1, lst_files, max_length):
+class AsyncDupCleaner(DupCleaner):
+    def __init__(self, folders, on_progress=None, on_message=None,
+                 **kwargs):
         """
-        This function takes actions (deletion) about the "lst_files" list.
+        Init function for AsyncDupCleaner. DupCleaner for asyncio
+        applications: the stages run in a worker thread and the files are
+        read by the self.jobs workers, so the event loop is not blocked
+        and several scans can run in the same process. The groups are
+        returned by an async iterator. Nothing is printed, the messages
+        and the progress are sent to the callbacks, called in the event
+        loop thread. Only the list mode is supported.
 
-        :param l_md5: MD5 checksum for the "lst_files" list
-        :param l_sha1: SHA-1 checksum for the "lst_files" list
-        :param lst_files: List of files to apply actions.
-        :param max_length: Output max file name length
-        :return: Tuple, three elements:
-                 * Remaining files list,
-                 * More action needed boolean flag,
-                 * Quit selected flag.
+        Example:
+          async for key, lst_files in AsyncDupCleaner(['/srv'], jobs=4):
+              ...
+
+        :param folders: List of folders or files to check
+        :param on_progress: Function called with the progress dictionary
+               (see RunStats.get_progress), once per second
+        :param on_message: Function called with the informative messages
+               and the warnings (text)
+        :param kwargs: Other DupCleaner arguments
         """
-        # Apply automatic deletion
-        lst_files, changed = self.__take_auto_action__(lst_files)
+        self.on_progress = on_progress
+        self.on_message = on_message
+        # Event loop of the running iteration
+        self.loop = None
+        super().__init__(folders, **kwargs)
+        if self.write_mode or self.plan_input:
+            raise ValueError("AsyncDupCleaner only supports the list mode")
 
-        # For the remaining files, get the options for the menu
-        file_valid_options = [str(x + 1) for x, _ in enumerate(lst_files)]
-        folder_valid_options = ['f' + str(x+1) for x, _ in enumerate(lst_files)]
-        if changed:
-            self.__print_list_files__(l_md5, l_sha1, lst_files, max_length)
+        self.progress = on_progress is not None
+        if on_progress is not None:
+            self.progress_callback = partial(self.__notify__, on_progress)
+        self.cancel_event = threading.Event()
 
-        while 1:
-            # Only one file remaining, exit
-            if len(lst_files) < 2:
-                return lst_files, False, False
+    def __notify__(self, callback, value):
+        """
+        Call a callback in the event loop thread or, if the groups are not
+        being iterated, in the current thread.
 
-            # Print the action menu and get the selected option
-            opc = self.__print_action_menu__(lst_files)
+        :param callback: Function to call, or None
+        :param value: Argument for the function
+        :return: None
+        """
+        if callback is None:
+            return
 
-            # Option is "No delete any files"
-            if opc.lower() == 'n':
-                # Return the remaining list, do not continue
-                return lst_files, False, False
-            elif opc == '?':
-                # Help request. Print the help, print the file list, ask again.
-                self.__print_help__()
-                self.__print_list_files__(
-                    l_md5, l_sha1, lst_files, max_length)
-            elif opc.lower() == 'q':
-                # Quit selected!
-                return lst_files, False, True
-            elif opc in file_valid_options:
-                # File option selected. Delete the file
-                removed = self.__delete_file__(lst_files[int(opc) - 1])
-                if removed:
-                    # Remove the file from the list
-                    lst_files.pop(int(opc) - 1)
-                # Print the new list. If only one file, will exist in next loop
-                if len(lst_files) > 1:
-                    self.__print_list_files__(
-                        l_md5, l_sha1, lst_files, max_length)
-            elif opc in folder_valid_options:
-                # File option selected and folder selected by default
-                # Get the file to delete
-                idx = int(opc.replace('f', '')) - 1
-                # Get the folder name and include it in the default folder list
-                folder = dirname(lst_files[idx])
-                self.def_action_folder[folder] = 1
-                # Delete the file, remove it from the list
-                removed = self.__delete_file__(lst_files[idx])
-                if removed:
-                    lst_files.pop(idx)
-                    # Print the new list. If only one, will exist in next loop
-                if len(lst_files) > 1:
-                    self.__print_list_files__(
-                        l_md5, l_sha1, lst_files, max_length)
-            elif opc == 'A':
-                # Remove all files
-                re_check = input('SURE? (type "YES" to confirm or '
-                                 'any key to cancel) ')
-                if re_check == 'YES':
-                    new_lst_files = []
-                    for lf in lst_files:
-                        removed = self.__delete_file__(lf)
-                        if not removed:
-                            new_lst_files.append(lf)
-                    lst_files = new_lst_files
-            else:
-                print("No valid option")
+        if self.loop is None:
+            callback(value)
+        else:
+            self.loop.call_soon_threadsafe(callback, value)
 
-    def __process_duplicated__(self, write_mode=False):
+    def __info__(self, text):
         """
-        Function to process the duplicated files, in read only (for printing)
-        or write mode (for deletion)
+        Send an informative message to the on_message callback.
 
-        :param write_mode: Flag to write mode, False by default.
-        :return: Cancel by user flag (True if canceled)
+        :param text: Message
+        :return: None
         """
-        if not len(self.checksums):
-            return False
+        self.__notify__(self.on_message, text)
 
-        # Get the filename max length to align the output
-        max_length = self.__get_max_file_name_len_full__() if \
-            self.full_list_align else 0
+    def __warning__(self, text):
+        """
+        Send a warning about the parameters to the on_message callback.
 
-        print("Duplicated files found.")
-        for k, v in self.checksums.items():
-            l_md5 = k.split('_')[0]
-            l_sha1 = k.split('_')[1]
-            self.__print_output_header__(l_md5, l_sha1)
+        :param text: Message, without the "WARNING: " prefix
+        :return: None
+        """
+        self.__notify__(self.on_message, "WARNING: " + text)
 
-            lst_work = v.copy()
-            again = True
-            while again:
-                self.__print_list_files__(l_md5, l_sha1, lst_work, max_length)
-                if write_mode:
-                    lst_files, again, quit_flag = self.__take_action__(
-                        l_md5, l_sha1, lst_work, max_length)
-                    self.checksums[k] = lst_files
-                    if quit_flag:
-                        return True
-                else:
-                    again = False
+    def cancel(self):
+        """
+        This function cancels the running iteration, and it can be called
+        from any thread. The iteration raises asyncio.CancelledError when
+        the files being read are done, the pending files are not read.
+        Cancelling the task running the iteration has the same effect.
 
-    def print_duplicated(self):
+        :return: None
         """
-        This function prints the duplicated files on the screen
-        :return: Cancel by user flag. In this case, always is false.
+        self.cancel_event.set()
+
+    async def iter_groups(self):
         """
-        return self.__process_duplicated__()
+        Async generator to get the duplicated files, like iter_duplicates.
+        Every group is returned as soon as it is found. The stages run in
+        a worker thread, one group at a time, so the files are not read
+        while the caller does not ask for the next group. To stop before
+        the end, close the iterator (contextlib.aclosing) or cancel the
+        iteration, so the files and the workers are released.
 
-    def remove_duplicated(self):
+        :return: Async iterator of tuples (key, list of files), see
+                 iter_duplicates
         """
-        This function removes the duplicated files (using a menu).
+        if self.loop is not None:
+            raise RuntimeError("The scan is already running")
 
-        :return: Cancel by user flag (True if canceled)
+        self.loop = asyncio.get_running_loop()
+        self.cancel_event.clear()
+        groups = self.iter_duplicates()
+        driver = ThreadPoolExecutor(max_workers=1)
+        try:
+            while True:
+                try:
+                    group = await self.loop.run_in_executor(
+                        driver, next, groups, None)
+                except CancelledError:
+                    raise asyncio.CancelledError from None
+                if group is None:
+                    return
+                yield group
+        finally:
+            # Stop the stages (cancelled or not fully iterated), wait for
+            # the worker thread and release the files and the workers
+            self.cancel_event.set()
+            await self.loop.run_in_executor(driver, groups.close)
+            driver.shutdown()
+            self.loop = None
+
+    def __aiter__(self):
         """
-        l_mode = self.write_mode
-        return self.__process_duplicated__(l_mode)
+        Iterate the groups using "async for", see iter_groups.
 
-    def get_duplicated(self):
+        :return: Async iterator of tuples (key, list of files)
         """
-        This function get the duplicated files. Store it in the self.checksums
-        variable for this class and returns a copy of the list.
+        return self.iter_groups()
+
+    async def get_duplicated(self):
+        """
+        This function gets the duplicated files, like
+        DupCleaner.get_duplicated, without blocking the event loop.
 
         :return: Copy of self.checksums with the duplicated files
         """
-        # Set the base folder for the input files/folders
-        self.__get_full_path__()
-        # Get the list of files (all)
-        for folder in self.in_folders:
-            self.__get_files__(folder)
-        # Get the checksums for the files (all)
-        self.__get_files_checksums__()
-        # Remove files without duplicates
-        self.__remove_not_dups__()
-        # Return the duplicated files
-        return self.checksums.copy()
+        async for _ in self.iter_groups():
+            pass
+
+        return {k: [self.files.path(x) for x in v.files]
+                for k, v in self.checksums.items()}
 
 
 # Main function example
@@ -579,9 +5717,48 @@ if __name__ == '__main__':
     sys.stdout = io.TextIOWrapper(sys.stdout.detach(), encoding='utf-8')
     sys.stderr = io.TextIOWrapper(sys.stderr.detach(), encoding='utf-8')
 
-    ret = dupcleaner_menu()
+    arguments = dupcleaner_arguments()
+    ret = dupcleaner_menu(arguments)
     cleaner = DupCleaner(*ret)
-    cleaner.get_duplicated()
-    # cleaner.print_duplicated()
-    if cleaner.remove_duplicated():
-        print("Canceled by user.")
+    profiler = cProfile.Profile() if cleaner.profile_file else None
+    if profiler:
+        profiler.enable()
+
+    if arguments.daemon:
+        if cleaner.write_mode:
+            cleaner.__warning__("Parameter write_mode "
+                                "does not have effect in daemon mode.")
+            cleaner.write_mode = False
+        daemon = DupDaemon(cleaner, arguments.daemon,
+                           arguments.rescan_interval)
+        signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+        signal.signal(signal.SIGINT, lambda *_: daemon.stop())
+        daemon.serve()
+    elif cleaner.plan_input:
+        cleaner.execute_plan(cleaner.plan_input)
+    elif cleaner.index_file:
+        cleaner.write_index()
+    elif cleaner.shard_file:
+        cleaner.write_shard()
+    elif cleaner.output_format == 'ndjson':
+        cleaner.print_ndjson()
+    else:
+        if cleaner.find_targets:
+            cleaner.find_copies()
+        else:
+            cleaner.get_duplicated()
+        # cleaner.print_duplicated()
+        if cleaner.plan_file:
+            cleaner.write_plan()
+        elif cleaner.write_mode and cleaner.keep:
+            cleaner.execute_plan()
+        elif cleaner.write_mode and cleaner.link_all:
+            cleaner.link_duplicated()
+        elif cleaner.remove_duplicated():
+            print("Canceled by user.")
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(cleaner.profile_file)
+    if cleaner.stats_file:
+        cleaner.write_stats()